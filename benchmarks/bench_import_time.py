@@ -0,0 +1,71 @@
+"""
+Measures cold-start import time of the Django app with `python -X importtime`.
+
+Runs a fresh interpreter that sets up Django and imports research_app.views (what a
+web worker does before serving its first request), then reports the total import
+time, the slowest top-level imports and whether any of the heavy document/LLM
+modules were loaded eagerly.
+
+Usage:
+    python benchmarks/bench_import_time.py [--top 15] [--max-ms 1500]
+
+With --max-ms the script exits with status 1 when the cold start exceeds the limit,
+so it can guard startup time in CI.
+"""
+import argparse
+import os
+import re
+import subprocess
+import sys
+
+PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+COLD_START_CODE = "import django; django.setup(); import research_app.urls, research_app.views"
+HEAVY_MODULES = ('fitz', 'docx', 'pptx', 'lxml', 'numpy')
+IMPORTTIME_RE = re.compile(r'^import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)$')
+
+
+def run_importtime(code):
+    env = dict(os.environ, DJANGO_SETTINGS_MODULE='desk_research_project.settings')
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', code],
+        cwd=PROJECT_DIR, env=env, capture_output=True, text=True, check=True,
+    )
+    imports = []
+    for line in result.stderr.splitlines():
+        match = IMPORTTIME_RE.match(line)
+        if match:
+            self_us, cumulative_us, indent, name = match.groups()
+            imports.append((name, int(self_us), int(cumulative_us), len(indent) // 2))
+    return imports
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--top', type=int, default=15)
+    parser.add_argument('--max-ms', type=float, default=None)
+    args = parser.parse_args()
+
+    imports = run_importtime(COLD_START_CODE)
+    top_level = [entry for entry in imports if entry[3] == 0]
+    total_ms = sum(entry[2] for entry in top_level) / 1000
+    loaded = {entry[0] for entry in imports}
+    eager_heavy = [name for name in HEAVY_MODULES if name in loaded]
+
+    print(f"cold start imports: {total_ms:.0f} ms ({len(imports)} modules)")
+    print(f"heavy modules loaded eagerly: {', '.join(eager_heavy) or 'none'}")
+    print(f"\n{'cumulative (ms)':>16}  module")
+    for name, _, cumulative_us, _ in sorted(top_level, key=lambda e: -e[2])[:args.top]:
+        print(f"{cumulative_us / 1000:>16.1f}  {name}")
+
+    # Reference: what the heavy modules would add if they were imported eagerly
+    heavy_code = "import " + ", ".join(HEAVY_MODULES)
+    heavy_ms = sum(e[2] for e in run_importtime(heavy_code) if e[3] == 0) / 1000
+    print(f"\nheavy modules on their own: {heavy_ms:.0f} ms")
+
+    if args.max_ms is not None and total_ms > args.max_ms:
+        print(f"FAIL: cold start {total_ms:.0f} ms exceeds limit of {args.max_ms:.0f} ms")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,406 @@
+"""
+End-to-end load test: many simulated users running research sessions against one
+in-process ASGI instance of the app, with a latency-injecting fake LLM.
+
+Each simulated user loads the upload page (for the CSRF token), posts a synthetic
+document mix to start_research_session, and polls get_session_status the way the
+HTMX page does until the session completes or fails, then starts its next session.
+Admission control, the session thread pool, extraction, the fair-share LLM
+scheduler and report generation all run for real. Only Gemini is replaced, by a
+coroutine that sleeps for a log-normally distributed latency (plus an optional
+per-character cost) and can fail a fraction of calls.
+
+Per concurrency level the script reports session throughput, p50/p95/p99
+session completion time, start and status-poll latency, 429 rejections, and DB
+write timings from a wrapper on every connection. Writes slower than
+--lock-threshold-ms are counted as lock waits: on SQLite that is time spent
+waiting for the database lock. Run it before and after a change (same arguments,
+--json to keep the numbers) to see how capacity moved.
+
+By default it uses a throwaway SQLite database; --use-configured-db runs against
+the database from settings (e.g. a staging PostgreSQL) instead. Admission and
+concurrency limits come from the usual settings/environment variables.
+
+Usage:
+    python benchmarks/bench_load.py [--users 5 20 50] [--sessions-per-user 3]
+        [--docs-per-session 1-5] [--doc-kb 20-200] [--mix txt=4,docx=3,pdf=2,pptx=1]
+        [--llm-latency-ms 800] [--llm-jitter 0.5] [--llm-ms-per-kchar 5] [--llm-error-rate 0]
+        [--poll-interval 1] [--json results.json]
+"""
+import argparse
+import asyncio
+import io
+import json
+import math
+import os
+import random
+import re
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+
+import django
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'desk_research_project.settings')
+
+CSRF_RE = re.compile(r'name="csrfmiddlewaretoken" value="([^"]+)"')
+SESSION_ID_RE = re.compile(r'session_status/([0-9a-f-]{36})/')
+STATUS_RE = re.compile(r'Overall Status:</strong>\s*([^<]+?)\s*<')
+WRITE_SQL = ('INSERT', 'UPDATE', 'DELETE')
+CONTENT_TYPES = {
+    'txt': 'text/plain',
+    'pdf': 'application/pdf',
+    'docx': 'application/vnd.openxmlformats-officedocument.wordprocessingml.document',
+    'pptx': 'application/vnd.openxmlformats-officedocument.presentationml.presentation',
+}
+WORDS = (
+    "market revenue growth region policy budget committee report analysis customer survey quarter "
+    "cost risk strategy supply demand forecast investment energy transport health education data "
+    "results method sample trend share price contract regulation impact study evidence"
+).split()
+
+
+def percentile(values, p):
+    """Nearest-rank percentile of a list (None if empty)."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(p / 100 * len(ordered)) - 1)]
+
+
+def parse_range(value):
+    low, _, high = value.partition('-')
+    return int(low), int(high or low)
+
+
+def parse_mix(value):
+    mix = {}
+    for part in value.split(','):
+        kind, _, weight = part.partition('=')
+        if kind not in CONTENT_TYPES:
+            raise argparse.ArgumentTypeError(f"Unknown document type in mix: {kind}")
+        mix[kind] = float(weight or 1)
+    return mix
+
+
+# --- Synthetic documents ---
+
+def _paragraphs(rng, size):
+    """Random sentences totalling about size characters, in paragraphs."""
+    paragraphs, total = [], 0
+    while total < size:
+        sentences = [
+            ' '.join(rng.choice(WORDS) for _ in range(rng.randint(8, 20))).capitalize() + '.'
+            for _ in range(rng.randint(3, 6))
+        ]
+        paragraphs.append(' '.join(sentences))
+        total += len(paragraphs[-1])
+    return paragraphs
+
+
+def make_document(kind, rng, size):
+    paragraphs = _paragraphs(rng, size)
+    if kind == 'txt':
+        return '\n\n'.join(paragraphs).encode()
+    buffer = io.BytesIO()
+    if kind == 'docx':
+        import docx
+
+        document = docx.Document()
+        for paragraph in paragraphs:
+            document.add_paragraph(paragraph)
+        document.save(buffer)
+    elif kind == 'pptx':
+        import pptx
+        from pptx.util import Inches
+
+        presentation = pptx.Presentation()
+        for start in range(0, len(paragraphs), 3):
+            slide = presentation.slides.add_slide(presentation.slide_layouts[6])
+            box = slide.shapes.add_textbox(Inches(0.5), Inches(0.5), Inches(9), Inches(6))
+            box.text_frame.text = '\n'.join(paragraphs[start:start + 3])
+        presentation.save(buffer)
+    else:
+        from reportlab.lib.pagesizes import A4
+        from reportlab.pdfgen import canvas
+
+        pdf = canvas.Canvas(buffer, pagesize=A4)
+        y = 800
+        for paragraph in paragraphs:
+            for start in range(0, len(paragraph), 95):
+                if y < 40:
+                    pdf.showPage()
+                    y = 800
+                pdf.drawString(40, y, paragraph[start:start + 95])
+                y -= 14
+        pdf.save()
+    return buffer.getvalue()
+
+
+def make_file_pool(args, rng):
+    """Pre-generated documents (generation time stays out of the measurements)."""
+    kinds, weights = zip(*args.mix.items())
+    low, high = args.doc_kb
+    pool = []
+    for i in range(args.file_pool):
+        kind = rng.choices(kinds, weights)[0]
+        pool.append((f'doc{i}.{kind}', make_document(kind, rng, rng.randint(low, high) * 1024), CONTENT_TYPES[kind]))
+    return pool
+
+
+# --- Fake LLM ---
+
+def install_fake_llm(args, calls):
+    from research_app import utils
+    from research_app.llm import LocalStreamingLLM
+
+    rng = random.Random(args.seed)
+    rng_lock = threading.Lock()
+
+    async def fake_generate_async(prompt, model):
+        with rng_lock:
+            latency = args.llm_latency_ms * rng.lognormvariate(0, args.llm_jitter)
+            fails = rng.random() < args.llm_error_rate
+        latency += len(prompt) / 1000 * args.llm_ms_per_kchar
+        await asyncio.sleep(latency / 1000)
+        calls['total'] += 1
+        if fails:
+            calls['failed'] += 1
+            raise RuntimeError("Simulated LLM failure")
+        return 'The documents mention "market revenue growth" among other things.'
+
+    utils.gemini_generate_async = fake_generate_async
+    # Streamed back a few words at a time, so partial answers are saved like in production
+    utils.gemini_stream_async = LocalStreamingLLM(fake_generate_async, delay=args.llm_chunk_delay_ms / 1000).stream
+
+
+# --- DB instrumentation ---
+
+class QueryTimer:
+    """Execute wrapper timing every query on every connection."""
+
+    def __init__(self, threshold_ms):
+        self.threshold_ms = threshold_ms
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.queries = 0
+            self.write_seconds = []
+            self.locked_errors = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        except Exception as e:
+            if 'locked' in str(e):
+                with self.lock:
+                    self.locked_errors += 1
+            raise
+        finally:
+            elapsed = time.perf_counter() - started
+            with self.lock:
+                self.queries += 1
+                if sql.lstrip()[:6].upper() in WRITE_SQL:
+                    self.write_seconds.append(elapsed)
+
+    def install(self):
+        from django.db.backends.signals import connection_created
+
+        def add_wrapper(sender, connection, **kwargs):
+            if self not in connection.execute_wrappers:
+                connection.execute_wrappers.append(self)
+
+        connection_created.connect(add_wrapper, weak=False)
+
+
+# --- Simulated users ---
+
+class LevelResults:
+    def __init__(self):
+        self.completion = []
+        self.start_latency = []
+        self.poll_latency = []
+        self.statuses = Counter()
+        self.rejected = 0
+        self.documents = 0
+
+
+async def run_session(client, args, rng, pool, results):
+    response = await client.get('/')
+    token = CSRF_RE.search(response.text).group(1)
+    picked = rng.sample(pool, min(len(pool), rng.randint(*args.docs_per_session)))
+    files = [('documents', (name, content, content_type)) for name, content, content_type in picked]
+
+    started = time.perf_counter()
+    while True:
+        request_started = time.perf_counter()
+        response = await client.post(
+            '/start_research/', data={'query': args.query}, files=files, headers={'X-CSRFToken': token},
+        )
+        results.start_latency.append(time.perf_counter() - request_started)
+        if response.status_code != 429:
+            break
+        results.rejected += 1
+        await asyncio.sleep(min(float(response.headers.get('Retry-After', 1)), args.max_retry_delay))
+    if response.status_code != 200:
+        results.statuses[f'http {response.status_code}'] += 1
+        return
+    session_id = SESSION_ID_RE.search(response.text).group(1)
+
+    while time.perf_counter() - started < args.session_timeout:
+        await asyncio.sleep(args.poll_interval)
+        request_started = time.perf_counter()
+        response = await client.get(f'/session_status/{session_id}/')
+        results.poll_latency.append(time.perf_counter() - request_started)
+        if 'hx-get=' not in response.text: # The page stops polling once the session is finished
+            if '/download_report/' in response.text: # Completed sessions get the results partial
+                results.statuses['Completed'] += 1
+            else:
+                status = STATUS_RE.search(response.text)
+                results.statuses[status.group(1) if status else 'unknown'] += 1
+            results.completion.append(time.perf_counter() - started)
+            results.documents += len(picked)
+            return
+    results.statuses['timed out'] += 1
+
+
+async def simulated_user(app, user, args, pool, results):
+    import httpx
+
+    rng = random.Random(args.seed * 1000 + user)
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url='http://testserver', timeout=None) as client:
+        await asyncio.sleep(rng.uniform(0, args.ramp_up)) # Users don't all arrive at once
+        for _ in range(args.sessions_per_user):
+            await run_session(client, args, rng, pool, results)
+
+
+async def run_level(app, users, args, pool):
+    results = LevelResults()
+    started = time.perf_counter()
+    await asyncio.gather(*(simulated_user(app, user, args, pool, results) for user in range(users)))
+    return results, time.perf_counter() - started
+
+
+def _ms(seconds):
+    return None if seconds is None else round(seconds * 1000, 1)
+
+
+def summarize(users, results, elapsed, timer, calls):
+    completed = results.statuses.get('Completed', 0)
+    writes = timer.write_seconds
+    lock_waits = [s for s in writes if s * 1000 > timer.threshold_ms]
+    return {
+        'users': users,
+        'seconds': round(elapsed, 1),
+        'sessions': dict(results.statuses),
+        'sessions_per_minute': round(completed / elapsed * 60, 2),
+        'documents_per_second': round(results.documents / elapsed, 2),
+        'rejected_429': results.rejected,
+        'completion_s': {f'p{p}': round(percentile(results.completion, p) or 0, 2) for p in (50, 95, 99)},
+        'start_ms': {f'p{p}': _ms(percentile(results.start_latency, p)) for p in (50, 95, 99)},
+        'poll_ms': {f'p{p}': _ms(percentile(results.poll_latency, p)) for p in (50, 95, 99)},
+        'db': {
+            'queries': timer.queries,
+            'writes': len(writes),
+            'write_ms': {f'p{p}': _ms(percentile(writes, p)) for p in (50, 95, 99)},
+            'lock_waits': len(lock_waits),
+            'lock_wait_s': round(sum(lock_waits), 2),
+            'locked_errors': timer.locked_errors,
+        },
+        'llm_calls': dict(calls),
+    }
+
+
+def print_row(row, out):
+    c, p, d = row['completion_s'], row['poll_ms'], row['db']
+    print(
+        f"{row['users']:>5} {row['sessions_per_minute']:>8} {row['documents_per_second']:>7} "
+        f"{c['p50']:>7} {c['p95']:>7} {c['p99']:>7} {p['p50']:>7} {p['p95']:>7} {p['p99']:>7} "
+        f"{row['rejected_429']:>5} {d['write_ms']['p99']:>8} {d['lock_waits']:>6} {d['lock_wait_s']:>7} {d['locked_errors']:>6}  "
+        f"{', '.join(f'{k}: {v}' for k, v in row['sessions'].items())}",
+        file=out, flush=True,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, nargs='+', default=[5, 20, 50], help="Concurrency levels to run")
+    parser.add_argument('--sessions-per-user', type=int, default=3)
+    parser.add_argument('--docs-per-session', type=parse_range, default=(1, 5))
+    parser.add_argument('--doc-kb', type=parse_range, default=(20, 200))
+    parser.add_argument('--mix', type=parse_mix, default=parse_mix('txt=4,docx=3,pdf=2,pptx=1'))
+    parser.add_argument('--file-pool', type=int, default=40, help="Distinct synthetic files to draw uploads from")
+    parser.add_argument('--query', default="What do the documents say about market growth?")
+    parser.add_argument('--llm-latency-ms', type=float, default=800, help="Median fake LLM latency")
+    parser.add_argument('--llm-jitter', type=float, default=0.5, help="Sigma of the log-normal latency")
+    parser.add_argument('--llm-ms-per-kchar', type=float, default=5, help="Extra latency per 1000 prompt characters")
+    parser.add_argument('--llm-error-rate', type=float, default=0.0)
+    parser.add_argument('--llm-chunk-delay-ms', type=float, default=20, help="Delay between streamed chunks")
+    parser.add_argument('--poll-interval', type=float, default=1.0)
+    parser.add_argument('--ramp-up', type=float, default=2.0, help="Users start spread over this many seconds")
+    parser.add_argument('--max-retry-delay', type=float, default=2.0, help="Cap on Retry-After after a 429")
+    parser.add_argument('--session-timeout', type=float, default=600)
+    parser.add_argument('--lock-threshold-ms', type=float, default=50, help="Writes slower than this count as lock waits")
+    parser.add_argument('--use-configured-db', action='store_true', help="Use the settings database, not a temp SQLite file")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--json', help="Also write the results to this file")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        from django.conf import settings
+        if not args.use_configured_db:
+            settings.DATABASES['default'].update(ENGINE='django.db.backends.sqlite3', NAME=os.path.join(tmp_dir, 'bench.sqlite3'))
+        settings.MEDIA_ROOT = tmp_dir
+        settings.DEBUG = False # DEBUG keeps every query in memory
+        settings.ALLOWED_HOSTS = ['testserver']
+        settings.PROCESSING_MODE = 'inprocess'
+        django.setup()
+
+        from django.core.asgi import get_asgi_application
+        from django.core.management import call_command
+
+        call_command('migrate', verbosity=0)
+        timer = QueryTimer(args.lock_threshold_ms)
+        timer.install()
+        calls = Counter()
+        install_fake_llm(args, calls)
+        pool = make_file_pool(args, random.Random(args.seed))
+        app = get_asgi_application()
+        out = sys.stdout
+        sys.stdout = open(os.devnull, 'w') # The app prints per document; keep the table readable
+
+        print(
+            f"database: {settings.DATABASES['default']['ENGINE'].rsplit('.', 1)[-1]}, running sessions: "
+            f"{settings.ADMISSION_MAX_RUNNING_SESSIONS}, LLM concurrency: {settings.LLM_MAX_CONCURRENCY}, "
+            f"fake LLM: {args.llm_latency_ms:g} ms median",
+            file=out,
+        )
+        print(
+            f"{'users':>5} {'sess/min':>8} {'docs/s':>7} {'done p50':>7} {'p95':>7} {'p99':>7} "
+            f"{'poll p50':>7} {'p95':>7} {'p99':>7} {'429s':>5} {'write p99':>8} {'locks':>6} {'lock s':>7} {'errors':>6}  sessions",
+            file=out,
+        )
+        rows = []
+        for users in args.users:
+            timer.reset()
+            calls.clear()
+            results, elapsed = asyncio.run(run_level(app, users, args, pool))
+            rows.append(summarize(users, results, elapsed, timer, calls))
+            print_row(rows[-1], out)
+        print("(completion times in s, latencies in ms; 'locks' = writes slower than "
+              f"{args.lock_threshold_ms:g} ms, 'errors' = 'database is locked' failures)", file=out)
+
+        if args.json:
+            with open(args.json, 'w') as f:
+                json.dump({'arguments': {k: v for k, v in vars(args).items() if k != 'json'}, 'levels': rows}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+"""
+Benchmarks the streaming (lxml iterparse) DOCX/PPTX extractors against the
+python-docx / python-pptx object-model extractors.
+
+Usage:
+    python benchmarks/bench_ooxml_extraction.py [--paragraphs 20000] [--slides 300]
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+import django
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'desk_research_project.settings')
+django.setup()
+
+from docx import Document as DocxDocument
+from pptx import Presentation
+
+from research_app.utils import (
+    extract_text_from_docx,
+    extract_text_from_docx_fast,
+    extract_text_from_pptx,
+    extract_text_from_pptx_fast,
+)
+
+
+def build_docx(path, paragraphs):
+    doc = DocxDocument()
+    for i in range(paragraphs):
+        if i % 100 == 0:
+            doc.add_heading(f"Chapter {i // 100}", level=1)
+        doc.add_paragraph(f"Paragraph {i} with some representative body text for the benchmark.")
+    table = doc.add_table(rows=paragraphs // 20, cols=4)
+    for row_idx, row in enumerate(table.rows):
+        for col_idx, cell in enumerate(row.cells):
+            cell.text = f"r{row_idx}c{col_idx}"
+    doc.save(path)
+
+
+def build_pptx(path, slides):
+    prs = Presentation()
+    for i in range(slides):
+        slide = prs.slides.add_slide(prs.slide_layouts[1])
+        slide.shapes.title.text = f"Slide title {i}"
+        slide.placeholders[1].text = "\n".join(f"Bullet {i}.{j}" for j in range(8))
+        slide.notes_slide.notes_text_frame.text = f"Speaker notes for slide {i}"
+    prs.save(path)
+
+
+def timed(func, path, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        text, _ = func(path)
+        best = min(best, time.perf_counter() - start)
+    return best, len(text or '')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--paragraphs', type=int, default=20000)
+    parser.add_argument('--slides', type=int, default=300)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        docx_path = os.path.join(tmp_dir, 'bench.docx')
+        pptx_path = os.path.join(tmp_dir, 'bench.pptx')
+        build_docx(docx_path, args.paragraphs)
+        build_pptx(pptx_path, args.slides)
+
+        rows = [
+            ('docx object model', extract_text_from_docx, docx_path),
+            ('docx streaming', extract_text_from_docx_fast, docx_path),
+            ('pptx object model', extract_text_from_pptx, pptx_path),
+            ('pptx streaming', extract_text_from_pptx_fast, pptx_path),
+        ]
+        print(f"{'extractor':<20} {'best (s)':>10} {'chars':>10}")
+        for name, func, path in rows:
+            seconds, chars = timed(func, path, args.repeat)
+            print(f"{name:<20} {seconds:>10.3f} {chars:>10}")
+
+
+if __name__ == '__main__':
+    main()
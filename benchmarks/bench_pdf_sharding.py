@@ -0,0 +1,63 @@
+"""
+Benchmarks sharded PDF extraction against the number of worker processes.
+
+Usage:
+    python benchmarks/bench_pdf_sharding.py [--pages 2000] [--shard-pages 200]
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+import django
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'desk_research_project.settings')
+django.setup()
+
+import fitz
+from django.conf import settings
+
+from research_app.utils import extract_text_from_pdf
+
+
+def build_pdf(path, pages):
+    doc = fitz.open()
+    for i in range(pages):
+        page = doc.new_page()
+        for line in range(40):
+            page.insert_text((50, 50 + line * 18), f"Page {i + 1}, line {line}: representative body text for extraction.")
+    doc.save(path)
+    doc.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--pages', type=int, default=2000)
+    parser.add_argument('--shard-pages', type=int, default=200)
+    args = parser.parse_args()
+
+    cpu_count = os.cpu_count() or 1
+    worker_counts = sorted({1, *[n for n in (2, 4, 8, 16, 32) if n <= cpu_count], cpu_count})
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        pdf_path = os.path.join(tmp_dir, 'bench.pdf')
+        build_pdf(pdf_path, args.pages)
+        settings.PDF_SHARD_PAGES = args.shard_pages
+
+        baseline = None
+        print(f"{args.pages} pages, {args.shard_pages} pages per shard, {cpu_count} CPUs")
+        print(f"{'workers':>8} {'seconds':>10} {'speedup':>8}")
+        for workers in worker_counts:
+            settings.PDF_SHARD_WORKERS = workers
+            start = time.perf_counter()
+            text, _ = extract_text_from_pdf(pdf_path)
+            seconds = time.perf_counter() - start
+            baseline = baseline or seconds
+            assert f"--- Page {args.pages} ---" in text
+            print(f"{workers:>8} {seconds:>10.3f} {baseline / seconds:>7.2f}x")
+
+
+if __name__ == '__main__':
+    main()
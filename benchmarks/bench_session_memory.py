@@ -0,0 +1,87 @@
+"""
+Runs process_research_sync over a synthetic multi-GB TXT corpus with a fake LLM and
+reports peak RSS against SESSION_MEMORY_BUDGET_BYTES.
+
+Usage:
+    python benchmarks/bench_session_memory.py [--corpus-mb 2048] [--doc-mb 64] [--budget-mb 256]
+"""
+import argparse
+import os
+import resource
+import sys
+import tempfile
+import time
+
+import django
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'desk_research_project.settings')
+
+
+def peak_rss_mb():
+    # ru_maxrss is in KiB on Linux and bytes on macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / (1024 * 1024) if sys.platform == 'darwin' else rss / 1024
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--corpus-mb', type=int, default=2048)
+    parser.add_argument('--doc-mb', type=int, default=64)
+    parser.add_argument('--budget-mb', type=int, default=256)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        from django.conf import settings
+        settings.DATABASES['default']['NAME'] = os.path.join(tmp_dir, 'bench.sqlite3')
+        settings.MEDIA_ROOT = tmp_dir
+        settings.DEBUG = False # DEBUG keeps every SQL query (and its text parameters) in memory
+        settings.SESSION_MEMORY_BUDGET_BYTES = args.budget_mb * 1024 * 1024
+        django.setup()
+
+        from django.core.management import call_command
+        from research_app import utils
+        from research_app.llm import LocalStreamingLLM
+        from research_app.models import ResearchSession, UploadedDocument
+        from research_app.views import process_research_sync
+
+        call_command('migrate', verbosity=0)
+        # Processing calls the async LLM entry points; answer locally instead
+        async def fake_generate_async(prompt, model):
+            return 'Synthetic answer.'
+
+        utils.gemini_generate_async = fake_generate_async
+        utils.gemini_stream_async = LocalStreamingLLM(fake_generate_async).stream
+
+        # Filler text shares no terms with any query; send every document to the (fake) LLM anyway
+        session = ResearchSession.objects.create(query='Benchmark query', analyze_all=True)
+        upload_dir = os.path.join(tmp_dir, 'uploads', str(session.session_id))
+        os.makedirs(upload_dir)
+        line = ('lorem ipsum dolor sit amet ' * 15).strip() + '\n'
+        lines_per_doc = args.doc_mb * 1024 * 1024 // len(line)
+        doc_count = max(1, args.corpus_mb // args.doc_mb)
+        for i in range(doc_count):
+            with open(os.path.join(upload_dir, f'doc{i}.txt'), 'w') as f:
+                f.write(f'Document {i}\n')
+                for _ in range(lines_per_doc // 1000):
+                    f.write(line * 1000)
+            UploadedDocument.objects.create(
+                session=session,
+                file=f'uploads/{session.session_id}/doc{i}.txt',
+                original_filename=f'doc{i}.txt',
+            )
+
+        baseline_mb = peak_rss_mb()
+        start = time.perf_counter()
+        process_research_sync(session.session_id)
+        seconds = time.perf_counter() - start
+        session.refresh_from_db()
+
+        print(f"corpus: {doc_count} x {args.doc_mb} MB, budget: {args.budget_mb} MB, status: {session.status}")
+        if session.status != 'completed':
+            print(f"error: {session.error_message}")
+        print(f"time: {seconds:.1f}s, peak RSS: {peak_rss_mb():.0f} MB (before processing: {baseline_mb:.0f} MB)")
+
+
+if __name__ == '__main__':
+    main()
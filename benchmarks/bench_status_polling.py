@@ -0,0 +1,105 @@
+"""
+Load-tests status polling against one in-process ASGI application instance.
+
+Simulates N concurrent HTMX pollers hitting the session status endpoint and reports
+throughput and latency percentiles for the async view, and for a copy of the
+previous sync view (served through Django's sync_to_async thread) for comparison.
+
+Usage:
+    python benchmarks/bench_status_polling.py [--pollers 10 50 200] [--polls 20]
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+import django
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'desk_research_project.settings')
+
+def legacy_get_session_status(request, session_id):
+    """The status view as it was before it became async."""
+    from django.shortcuts import render
+    from research_app.models import ResearchSession
+
+    session = ResearchSession.objects.get(pk=session_id)
+    documents = session.documents.all().order_by('original_filename')
+    return render(request, 'research_app/_progress_area.html', {'session': session, 'documents': documents})
+
+
+urlpatterns = [] # Filled in main() once Django is set up; this module is the ROOT_URLCONF
+
+
+async def poll(client, url, polls, latencies):
+    for _ in range(polls):
+        start = time.perf_counter()
+        response = await client.get(url)
+        latencies.append(time.perf_counter() - start)
+        assert response.status_code == 200, response.status_code
+
+
+async def run(app, url, pollers, polls):
+    import httpx
+
+    latencies = []
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url='http://testserver') as client:
+        start = time.perf_counter()
+        await asyncio.gather(*(poll(client, url, polls, latencies) for _ in range(pollers)))
+        elapsed = time.perf_counter() - start
+    latencies.sort()
+    p50 = statistics.median(latencies)
+    p95 = latencies[int(len(latencies) * 0.95) - 1]
+    return len(latencies) / elapsed, p50, p95
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--pollers', type=int, nargs='+', default=[10, 50, 200])
+    parser.add_argument('--polls', type=int, default=20)
+    parser.add_argument('--documents', type=int, default=10)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        from django.conf import settings
+        settings.DATABASES['default']['NAME'] = os.path.join(tmp_dir, 'bench.sqlite3')
+        settings.ROOT_URLCONF = __name__
+        settings.DEBUG = False
+        settings.ALLOWED_HOSTS = ['testserver']
+        django.setup()
+
+        from django.core.asgi import get_asgi_application
+        from django.core.management import call_command
+        from django.urls import include, path
+        from research_app.models import ResearchSession, UploadedDocument
+
+        urlpatterns.extend([
+            path('legacy_status/<uuid:session_id>/', legacy_get_session_status),
+            path('', include('research_app.urls')),
+        ])
+
+        call_command('migrate', verbosity=0)
+        session = ResearchSession.objects.create(query='Benchmark query', status='processing')
+        for i in range(args.documents):
+            UploadedDocument.objects.create(
+                session=session, file=f'uploads/doc{i}.txt', original_filename=f'doc{i}.txt', status='processing'
+            )
+
+        app = get_asgi_application()
+        urls = {
+            'sync (before)': f'/legacy_status/{session.session_id}/',
+            'async (after)': f'/session_status/{session.session_id}/',
+        }
+        print(f"{'view':<15} {'pollers':>8} {'req/s':>9} {'p50 ms':>8} {'p95 ms':>8}")
+        for pollers in args.pollers:
+            for name, url in urls.items():
+                throughput, p50, p95 = asyncio.run(run(app, url, pollers, args.polls))
+                print(f"{name:<15} {pollers:>8} {throughput:>9.0f} {p50 * 1000:>8.1f} {p95 * 1000:>8.1f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -16,6 +16,18 @@ def enable_db_access_for_all_tests(db):
     """
     pass
 
+@pytest.fixture(autouse=True)
+def local_llm_stream(monkeypatch):
+    """
+    Streams whatever research_app.utils.gemini_generate_async returns (tests
+    monkeypatch it with fakes) instead of calling the Gemini streaming API.
+    """
+    from research_app import utils
+    from research_app.llm import LocalStreamingLLM
+    stand_in = LocalStreamingLLM(lambda prompt, model: utils.gemini_generate_async(prompt, model))
+    monkeypatch.setattr("research_app.utils.gemini_stream_async", stand_in.stream)
+    return stand_in
+
 @pytest.fixture
 def client_user():
     """A logged-in user client."""
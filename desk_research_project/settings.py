@@ -78,12 +78,23 @@ WSGI_APPLICATION = 'desk_research_project.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/5.2/ref/settings/#databases
 
+# SQLite by default; point every web/worker node at one shared database (e.g. Postgres)
+# with the DB_* environment variables to run workers on several machines.
 DATABASES = {
     'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': BASE_DIR / 'db.sqlite3',
+        'ENGINE': os.getenv('DB_ENGINE', 'django.db.backends.sqlite3'),
+        'NAME': os.getenv('DB_NAME', BASE_DIR / 'db.sqlite3'),
+        'USER': os.getenv('DB_USER', ''),
+        'PASSWORD': os.getenv('DB_PASSWORD', ''),
+        'HOST': os.getenv('DB_HOST', ''),
+        'PORT': os.getenv('DB_PORT', ''),
     }
 }
+if DATABASES['default']['ENGINE'] == 'django.db.backends.sqlite3':
+    # Several worker processes write concurrently; wait for locks instead of failing
+    DATABASES['default']['OPTIONS'] = {'timeout': 30}
+    # Tests use a file as well; the in-memory test database fails on a lock instead of waiting
+    DATABASES['default']['TEST'] = {'NAME': BASE_DIR / 'test_db.sqlite3'}
 
 
 # Password validation
@@ -137,9 +148,119 @@ STATICFILES_DIRS = [
 
 # Media files
 MEDIA_URL = '/media/'
-MEDIA_ROOT = BASE_DIR / 'media'
+MEDIA_ROOT = Path(os.getenv('MEDIA_ROOT', BASE_DIR / 'media')) # Must be shared storage for multi-node workers
 if not os.path.exists(MEDIA_ROOT):
     os.makedirs(MEDIA_ROOT)
 
 # Gemini
 GEMINI_API_KEY = os.getenv('GEMINI_API_KEY')
+
+# PDF extraction
+# PDFs with more pages than this are split into page ranges extracted in parallel processes
+PDF_SHARD_PAGES = int(os.getenv('PDF_SHARD_PAGES', 200))
+# Worker processes in the pool shared by all sharded PDF extractions (0 = one per CPU core)
+PDF_SHARD_WORKERS = int(os.getenv('PDF_SHARD_WORKERS', 0))
+
+# Processing memory
+# Extracted text a session may keep in RAM; larger texts are spilled to memory-mapped temp files
+SESSION_MEMORY_BUDGET_BYTES = int(os.getenv('SESSION_MEMORY_BUDGET_BYTES', 256 * 1024 * 1024))
+
+# LLM transport (pooled async HTTP client shared by all Gemini calls)
+LLM_MAX_CONCURRENCY = int(os.getenv('LLM_MAX_CONCURRENCY', 8)) # In-flight document queries across all sessions
+GEMINI_HTTP_MAX_CONNECTIONS = int(os.getenv('GEMINI_HTTP_MAX_CONNECTIONS', 32))
+GEMINI_HTTP_MAX_KEEPALIVE = int(os.getenv('GEMINI_HTTP_MAX_KEEPALIVE', 16))
+GEMINI_HTTP_KEEPALIVE_EXPIRY = float(os.getenv('GEMINI_HTTP_KEEPALIVE_EXPIRY', 60))
+GEMINI_HTTP_CONNECT_TIMEOUT = float(os.getenv('GEMINI_HTTP_CONNECT_TIMEOUT', 10))
+GEMINI_HTTP_READ_TIMEOUT = float(os.getenv('GEMINI_HTTP_READ_TIMEOUT', 180))
+GEMINI_HTTP2 = os.getenv('GEMINI_HTTP2', 'false').lower() == 'true' # Requires 'pip install h2'
+
+# Streaming LLM responses: partial text is shown while it is generated, and a stream that
+# stops producing output is cancelled (and retried) instead of waiting for the read timeout
+LLM_STREAMING = os.getenv('LLM_STREAMING', 'true').lower() == 'true'
+LLM_STREAM_FIRST_CHUNK_TIMEOUT = float(os.getenv('LLM_STREAM_FIRST_CHUNK_TIMEOUT', 90)) # Long prompts take a while to start
+LLM_STREAM_STALL_TIMEOUT = float(os.getenv('LLM_STREAM_STALL_TIMEOUT', 20)) # Max gap between chunks
+LLM_STREAM_SAVE_INTERVAL = float(os.getenv('LLM_STREAM_SAVE_INTERVAL', 0.5)) # How often partial text is saved
+
+# Deadlines (research_app/deadlines.py). Each LLM call attempt is cut off after
+# LLM_CALL_TIMEOUT seconds and retried; with LLM_HEDGING, a call slower than the
+# LLM_HEDGE_PERCENTILE latency of similar calls gets a duplicate request and the first answer wins
+LLM_CALL_TIMEOUT = float(os.getenv('LLM_CALL_TIMEOUT', 300)) # 0 = no limit
+LLM_HEDGING = os.getenv('LLM_HEDGING', '').lower() in ('1', 'true')
+LLM_HEDGE_PERCENTILE = float(os.getenv('LLM_HEDGE_PERCENTILE', 95))
+LLM_HEDGE_MIN_SAMPLES = int(os.getenv('LLM_HEDGE_MIN_SAMPLES', 20)) # Calls of a prompt size seen before hedging them
+LLM_HEDGE_MAX_IN_FLIGHT = int(os.getenv('LLM_HEDGE_MAX_IN_FLIGHT', 4)) # Duplicate requests running at once
+# Whole-session budget in seconds from the start of processing (0 = none). Documents still
+# unanswered SESSION_SUMMARY_RESERVE seconds before it are reported as timed out
+SESSION_TIME_BUDGET = float(os.getenv('SESSION_TIME_BUDGET', 0))
+SESSION_SUMMARY_RESERVE = float(os.getenv('SESSION_SUMMARY_RESERVE', 60))
+
+# Model routing (research_app/routing.py). Empty model settings mean LLM_MODEL
+LLM_MODEL = os.getenv('LLM_MODEL', 'gemini-2.0-flash')
+LLM_SMALL_MODEL = os.getenv('LLM_SMALL_MODEL', '') # Document prompts up to LLM_SMALL_PROMPT_CHARS
+LLM_SMALL_PROMPT_CHARS = int(os.getenv('LLM_SMALL_PROMPT_CHARS', 20_000))
+LLM_SUMMARY_MODEL = os.getenv('LLM_SUMMARY_MODEL', '') # Summaries and partial-summary merges
+LLM_FALLBACK_MODEL = os.getenv('LLM_FALLBACK_MODEL', '') # Retries, and calls while the routed model is unhealthy ('' = none)
+# A model is unhealthy while over this share of its recent calls failed, or (if set) its
+# mean latency for the prompt size is over LLM_ROUTE_MAX_SECONDS
+LLM_ROUTE_MAX_ERROR_RATE = float(os.getenv('LLM_ROUTE_MAX_ERROR_RATE', 0.5))
+LLM_ROUTE_MAX_SECONDS = float(os.getenv('LLM_ROUTE_MAX_SECONDS', 0)) # 0 = latency doesn't reroute
+LLM_ROUTE_MIN_SAMPLES = int(os.getenv('LLM_ROUTE_MIN_SAMPLES', 5)) # Recent calls needed to judge a model
+LLM_ROUTE_WINDOW_SECONDS = float(os.getenv('LLM_ROUTE_WINDOW_SECONDS', 300)) # How far back "recent" goes
+
+# Fair-share scheduling of document queries across sessions (deficit round-robin)
+SCHEDULER_QUANTUM = int(os.getenv('SCHEDULER_QUANTUM', 200_000)) # Prompt characters credited per session per round
+# Sessions with at most this many documents are scheduled ahead of larger batch sessions (0 = off)
+SCHEDULER_INTERACTIVE_MAX_DOCUMENTS = int(os.getenv('SCHEDULER_INTERACTIVE_MAX_DOCUMENTS', 5))
+
+# Incremental summary (research_app/summary.py): answers are summarized in chunks while the
+# rest of the session is still querying, and partials are merged SUMMARY_MERGE_FANIN at a time
+SUMMARY_PARTIAL_DOCUMENTS = int(os.getenv('SUMMARY_PARTIAL_DOCUMENTS', 8)) # Answers per partial summary (0 = off)
+SUMMARY_PARTIAL_CHARS = int(os.getenv('SUMMARY_PARTIAL_CHARS', 40_000)) # ...or fewer answers once they are this long
+SUMMARY_MERGE_FANIN = int(os.getenv('SUMMARY_MERGE_FANIN', 4))
+
+# Relevance pre-screen (research_app/relevance.py): documents in which no query term occurs
+# skip the LLM and are reported as not relevant
+RELEVANCE_SCREEN = os.getenv('RELEVANCE_SCREEN', 'true').lower() == 'true'
+# Opt-in: also skip documents whose score against the query is below this (0 = only "no terms").
+# 'manage.py relevance_report' shows how other cutoffs would have done.
+RELEVANCE_MIN_SCORE = float(os.getenv('RELEVANCE_MIN_SCORE', 0))
+
+# Passage selection (research_app/passages.py): documents longer than this many characters
+# are cut down to the chunks most similar to the query instead of their first part (0 = off).
+# The default is the prompt's text limit (PROMPT_TEXT_CHARS), so every text that fits goes in whole.
+PASSAGE_SELECTION_CHARS = int(os.getenv('PASSAGE_SELECTION_CHARS', 1_000_000))
+PASSAGE_CHUNK_CHARS = int(os.getenv('PASSAGE_CHUNK_CHARS', 2000)) # Indexed chunk size
+PASSAGE_EMBED_BATCH = int(os.getenv('PASSAGE_EMBED_BATCH', 256)) # Chunks embedded and written per batch
+PASSAGE_SEARCH_BATCH_ROWS = int(os.getenv('PASSAGE_SEARCH_BATCH_ROWS', 4096)) # Index rows scored per batch
+
+# Admission control (work in flight across all active sessions)
+ADMISSION_MAX_OUTSTANDING_DOCUMENTS = int(os.getenv('ADMISSION_MAX_OUTSTANDING_DOCUMENTS', 500))
+ADMISSION_MAX_OUTSTANDING_BYTES = int(os.getenv('ADMISSION_MAX_OUTSTANDING_BYTES', 2 * 1024 ** 3))
+ADMISSION_MAX_OUTSTANDING_TOKENS = int(os.getenv('ADMISSION_MAX_OUTSTANDING_TOKENS', 50_000_000))
+ADMISSION_MAX_QUEUED_SESSIONS = int(os.getenv('ADMISSION_MAX_QUEUED_SESSIONS', 20)) # Beyond this: 429
+ADMISSION_RETRY_AFTER_SECONDS = int(os.getenv('ADMISSION_RETRY_AFTER_SECONDS', 30))
+ADMISSION_MAX_RUNNING_SESSIONS = int(os.getenv('ADMISSION_MAX_RUNNING_SESSIONS', 4)) # Background threads
+
+# Processing mode: 'inprocess' runs admitted sessions on the web process thread pool;
+# 'workers' leaves documents in the DB for 'manage.py run_worker' processes to claim.
+PROCESSING_MODE = os.getenv('PROCESSING_MODE', 'inprocess')
+WORKER_LEASE_SECONDS = int(os.getenv('WORKER_LEASE_SECONDS', 120)) # Heartbeats renew it every third
+WORKER_BATCH_SIZE = int(os.getenv('WORKER_BATCH_SIZE', 4)) # Documents claimed at a time
+WORKER_POLL_INTERVAL = float(os.getenv('WORKER_POLL_INTERVAL', 2))
+
+# Retention, enforced by 'manage.py gc_storage' (run it from cron). Only completed and
+# failed sessions are ever removed; 0 disables a limit.
+RETENTION_MAX_AGE_DAYS = int(os.getenv('RETENTION_MAX_AGE_DAYS', 30)) # Since the last update/download
+RETENTION_EXTRACTED_TEXT_DAYS = int(os.getenv('RETENTION_EXTRACTED_TEXT_DAYS', 1)) # Not needed once the report exists
+RETENTION_MAX_BYTES = int(os.getenv('RETENTION_MAX_BYTES', 10 * 1024 * 1024 * 1024)) # Blobs + uploads + reports
+RETENTION_BATCH_SIZE = int(os.getenv('RETENTION_BATCH_SIZE', 100)) # Rows per delete/update transaction
+RETENTION_ORPHAN_GRACE_SECONDS = int(os.getenv('RETENTION_ORPHAN_GRACE_SECONDS', 3600)) # Spares in-flight uploads
+
+# Profiling of session processing (research_app/profiling.py). Single sessions can opt in
+# with the 'profile' flag; PROFILE_SESSIONS profiles every session.
+PROFILE_SESSIONS = os.getenv('PROFILE_SESSIONS', '').lower() in ('1', 'true')
+SESSION_PROFILER = os.getenv('SESSION_PROFILER', 'sampling') # 'sampling' (collapsed stacks) or 'cprofile' (pstats)
+PROFILE_SAMPLE_INTERVAL = float(os.getenv('PROFILE_SAMPLE_INTERVAL', 0.005)) # Seconds between stack samples
+
+# Bearer token required by the JSON API (research_app/api.py); unset leaves it open like the UI
+API_TOKEN = os.getenv('API_TOKEN')
@@ -1,3 +1,64 @@
+import os
+
 from django.contrib import admin
+from django.http import FileResponse, Http404
+from django.shortcuts import get_object_or_404
+from django.urls import path, reverse
+from django.utils.html import format_html
+
+from .models import ResearchSession, ThroughputStat
+from .profiling import profile_path, summarize_profile
+
+
+@admin.register(ResearchSession)
+class ResearchSessionAdmin(admin.ModelAdmin):
+    """Sessions, with the stored profile of profiled ones (see profiling.py)."""
+    list_display = ('session_id', 'query', 'status', 'created_at', 'has_profile')
+    list_filter = ('status', 'profile_requested')
+    search_fields = ('query',)
+    ordering = ('-created_at',)
+    exclude = ('lease_owner', 'lease_expires_at', 'profile_filename')
+    readonly_fields = ('profile_download', 'profile_summary')
+
+    @admin.display(boolean=True, description='Profile')
+    def has_profile(self, session):
+        return bool(session.profile_filename)
+
+    @admin.display(description='Profile file')
+    def profile_download(self, session):
+        if not session.profile_filename:
+            return "-"
+        url = reverse('admin:research_app_researchsession_profile', args=[session.pk])
+        return format_html('<a href="{}">{}</a>', url, session.profile_filename)
+
+    @admin.display(description='Hottest functions')
+    def profile_summary(self, session):
+        if not session.profile_filename:
+            return "Not profiled. Set PROFILE_SESSIONS, or start the session with the 'profile' flag."
+        return format_html('<pre style="white-space: pre; overflow-x: auto">{}</pre>', summarize_profile(session.profile_filename))
+
+    def get_urls(self):
+        return [
+            path(
+                '<uuid:session_id>/profile/',
+                self.admin_site.admin_view(self.download_profile),
+                name='research_app_researchsession_profile',
+            ),
+        ] + super().get_urls()
+
+    def download_profile(self, request, session_id):
+        session = get_object_or_404(ResearchSession, pk=session_id)
+        if not session.profile_filename or not os.path.exists(profile_path(session.profile_filename)):
+            raise Http404("No profile stored for this session")
+        return FileResponse(
+            open(profile_path(session.profile_filename), 'rb'), as_attachment=True, filename=session.profile_filename,
+        )
+
 
-# Register your models here.
+@admin.register(ThroughputStat)
+class ThroughputStatAdmin(admin.ModelAdmin):
+    """Rolling throughput averages - the capacity-planning view of the processing pipeline."""
+    list_display = ('stage', 'bucket', 'value', 'samples', 'updated_at')
+    list_filter = ('stage',)
+    ordering = ('stage', 'bucket')
+    readonly_fields = ('stage', 'bucket', 'value', 'samples', 'updated_at')
@@ -0,0 +1,166 @@
+"""
+Admission control and backpressure for research submissions.
+
+Before a session is created, its documents, bytes and estimated tokens are added
+to the work already in flight (read from the database, so every web process sees
+the same numbers). If that stays under the ADMISSION_MAX_* limits the session is
+started at once. Otherwise it waits in a bounded FIFO queue (status 'queued'), and
+once the queue is full new submissions are rejected with 429 and Retry-After.
+
+The decision and the insert of the session and its documents happen in one
+transaction (admit_session) that first writes the AdmissionLock row: a row lock
+on Postgres/MySQL, the database write lock on SQLite. Concurrent submissions are
+so counted one after another and can't together overrun the limits or the queue.
+
+Admitted sessions are processed on a small background thread pool, so the
+submission request returns immediately and the progress partial polls for status.
+With PROCESSING_MODE = 'workers' they are left to the lease-based workers instead.
+"""
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.db import close_old_connections, transaction
+from django.db.models import Count, Sum
+from django.utils import timezone
+
+from .models import AdmissionLock, ResearchSession, UploadedDocument
+
+logger = logging.getLogger(__name__)
+
+ADMIT = 'admit'
+QUEUE = 'queue'
+REJECT = 'reject'
+
+# Session statuses whose documents count as in-flight work
+ACTIVE_SESSION_STATUSES = ('pending', 'processing', 'summarizing')
+# Rough LLM tokens per file byte; binary containers carry far less text than plain text
+TOKENS_PER_BYTE = {'.txt': 0.25, '.docx': 0.1, '.pdf': 0.05, '.pptx': 0.02}
+
+_executor = None
+
+
+def estimate_tokens(filename, size):
+    """Rough estimate of the prompt tokens a file of this type and size produces."""
+    extension = os.path.splitext(filename)[1].lower()
+    return int(size * TOKENS_PER_BYTE.get(extension, 0.25))
+
+
+def outstanding_work():
+    """Documents, bytes and estimated tokens not yet finished in active sessions."""
+    totals = UploadedDocument.objects.filter(
+        session__status__in=ACTIVE_SESSION_STATUSES,
+    ).exclude(status__in=UploadedDocument.FINISHED_STATUSES).aggregate(
+        documents=Count('id'), bytes=Sum('file_size'), tokens=Sum('estimated_tokens'),
+    )
+    return {key: value or 0 for key, value in totals.items()}
+
+
+def _fits(work, documents, size, tokens):
+    if work['documents'] == 0:
+        return True # An idle system always takes the next session, however large
+    return (
+        work['documents'] + documents <= settings.ADMISSION_MAX_OUTSTANDING_DOCUMENTS
+        and work['bytes'] + size <= settings.ADMISSION_MAX_OUTSTANDING_BYTES
+        and work['tokens'] + tokens <= settings.ADMISSION_MAX_OUTSTANDING_TOKENS
+    )
+
+
+def decide_admission(uploaded_files):
+    """Returns ADMIT, QUEUE or REJECT for a submission with these files."""
+    size = sum(f.size for f in uploaded_files)
+    tokens = sum(estimate_tokens(f.name, f.size) for f in uploaded_files)
+    waiting = ResearchSession.objects.filter(status='queued').count()
+
+    # Nobody may overtake sessions that are already waiting
+    if waiting == 0 and _fits(outstanding_work(), len(uploaded_files), size, tokens):
+        return ADMIT
+    if waiting < settings.ADMISSION_MAX_QUEUED_SESSIONS:
+        return QUEUE
+    logger.info(f"Rejecting submission of {len(uploaded_files)} file(s): {waiting} session(s) already queued")
+    return REJECT
+
+
+def admit_session(uploaded_files, create_session):
+    """
+    Decides on a submission under the admission lock and, unless it is rejected,
+    calls create_session(decision) to insert the session and its documents in the
+    same transaction. Returns (decision, session); session is None when rejected.
+    """
+    lock, _ = AdmissionLock.objects.get_or_create(pk=1)
+    with transaction.atomic():
+        # A write as the transaction's first statement, so the other admissions wait here
+        AdmissionLock.objects.filter(pk=lock.pk).update(locked_at=timezone.now())
+        decision = decide_admission(uploaded_files)
+        if decision == REJECT:
+            return decision, None
+        return decision, create_session(decision)
+
+
+def queue_position(session):
+    """1-based position of a queued session in the waiting queue."""
+    return ResearchSession.objects.filter(status='queued', created_at__lt=session.created_at).count() + 1
+
+
+async def aqueue_position(session):
+    """Async version of queue_position."""
+    return await ResearchSession.objects.filter(status='queued', created_at__lt=session.created_at).acount() + 1
+
+
+def _get_executor():
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(
+            max_workers=settings.ADMISSION_MAX_RUNNING_SESSIONS, thread_name_prefix='research-session',
+        )
+    return _executor
+
+
+def _run_session(session_id):
+    from .views import process_research_sync # Avoid a circular import
+
+    try:
+        process_research_sync(session_id)
+    finally:
+        try:
+            dispatch_queued_sessions()
+        except Exception as e:
+            logger.error(f"Error dispatching queued sessions: {e}")
+        close_old_connections()
+
+
+def processes_in_process():
+    """
+    Whether sessions started here run on this process's thread pool. Those take no
+    leases, so they are marked (ResearchSession.in_process) for run_worker processes
+    sharing the database to leave alone.
+    """
+    return settings.PROCESSING_MODE != 'workers'
+
+
+def start_session_processing(session_id):
+    """Processes an admitted session on the background thread pool."""
+    if settings.PROCESSING_MODE == 'workers':
+        return # 'manage.py run_worker' processes pick up pending sessions from the DB
+    _get_executor().submit(_run_session, session_id)
+
+
+def dispatch_queued_sessions():
+    """Starts queued sessions in FIFO order while the in-flight work limits allow."""
+    while True:
+        session = ResearchSession.objects.filter(status='queued').order_by('created_at').first()
+        if session is None:
+            return
+        pending = session.documents.exclude(status__in=UploadedDocument.FINISHED_STATUSES).aggregate(
+            documents=Count('id'), bytes=Sum('file_size'), tokens=Sum('estimated_tokens'),
+        )
+        if not _fits(outstanding_work(), pending['documents'], pending['bytes'] or 0, pending['tokens'] or 0):
+            return
+        # Conditional update, so two processes can't both start the same session
+        claimed = ResearchSession.objects.filter(pk=session.pk, status='queued').update(
+            status='pending', in_process=processes_in_process(),
+        )
+        if claimed:
+            logger.info(f"Starting queued session {session.session_id}")
+            start_session_processing(session.session_id)
@@ -0,0 +1,360 @@
+"""
+JSON API for automation: bulk session creation, bulk status and document answers.
+
+Every endpoint runs a fixed number of queries however many sessions or documents
+it returns (document counts come from one grouped aggregate), and long lists use
+cursor pagination, so no request renders templates or walks documents one by one.
+If API_TOKEN is set, requests must send 'Authorization: Bearer <token>'.
+"""
+import base64
+import binascii
+import functools
+import json
+import logging
+import uuid
+from datetime import datetime
+from types import SimpleNamespace
+
+from django.conf import settings
+from django.db.models import Count, Q
+from django.db.models.functions import Substr
+from django.http import JsonResponse
+from django.urls import reverse
+from django.utils.crypto import constant_time_compare
+from django.utils.datastructures import MultiValueDict
+from django.views.decorators.csrf import csrf_exempt
+
+from .forms import ResearchForm
+from .models import ResearchSession, UploadedDocument
+from .offsets import NOTES, PAGE, SECTION, SLIDE, TextOffsets
+from .progress import aload_throughput_stats, estimate_progress
+from .views import acreate_research_session
+
+logger = logging.getLogger(__name__)
+
+MAX_BULK_SESSIONS = 50 # Sessions created per request
+MAX_BULK_IDS = 1000 # Session ids per status request
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+
+SESSION_FIELDS = ('session_id', 'query', 'status', 'report_filename', 'error_message', 'created_at', 'updated_at')
+PROGRESS_FIELDS = ('id', 'session_id', 'original_filename', 'status', 'file_size', 'estimated_tokens', 'stage_started_at')
+DOCUMENT_COUNTS = {
+    'documents_total': Count('documents'),
+    'documents_processed': Count('documents', filter=Q(documents__status='processed')),
+    'documents_skipped': Count('documents', filter=Q(documents__status='skipped')),
+    'documents_timed_out': Count('documents', filter=Q(documents__status='timed_out')),
+    'documents_failed': Count('documents', filter=Q(documents__status='error')),
+}
+
+
+class ApiError(Exception):
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+
+def api_view(methods):
+    """Async JSON view: method check, optional bearer token, ApiError -> JSON error."""
+    def decorator(view):
+        @csrf_exempt # Token-authenticated automation, not browser forms
+        @functools.wraps(view)
+        async def wrapper(request, *args, **kwargs):
+            if request.method not in methods:
+                return JsonResponse({'error': f"Method {request.method} not allowed"}, status=405)
+            token = settings.API_TOKEN
+            if token and not constant_time_compare(request.headers.get('Authorization', ''), f'Bearer {token}'):
+                return JsonResponse({'error': "Invalid or missing API token"}, status=401)
+            try:
+                return await view(request, *args, **kwargs)
+            except ApiError as e:
+                return JsonResponse({'error': str(e)}, status=e.status)
+        return wrapper
+    return decorator
+
+
+# --- Serialization ---
+
+def _session_json(session, counts, queue_positions):
+    return {
+        'session_id': str(session['session_id']),
+        'query': session['query'],
+        'status': session['status'],
+        'queue_position': queue_positions.get(session['session_id']),
+        'documents': {
+            'total': counts.get('documents_total', 0),
+            'processed': counts.get('documents_processed', 0),
+            'skipped': counts.get('documents_skipped', 0),
+            'timed_out': counts.get('documents_timed_out', 0),
+            'failed': counts.get('documents_failed', 0),
+        },
+        'report_url': (
+            reverse('research_app:download_report', args=[session['session_id']])
+            if session['status'] == 'completed' and session['report_filename'] else None
+        ),
+        'error_message': session['error_message'],
+        'created_at': session['created_at'].isoformat(),
+        'updated_at': session['updated_at'].isoformat(),
+    }
+
+
+async def _queue_positions():
+    """Positions of all queued sessions in one query (the queue is bounded)."""
+    queued = ResearchSession.objects.filter(status='queued').order_by('created_at').values_list('pk', flat=True)
+    return {pk: position async for position, pk in _aenumerate(queued, 1)}
+
+
+async def _aenumerate(queryset, start=0):
+    position = start
+    async for item in queryset:
+        yield position, item
+        position += 1
+
+
+# --- Cursor pagination ---
+
+def _encode_cursor(values):
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode().rstrip('=')
+
+
+def _decode_cursor(cursor, *parsers):
+    """Decodes a cursor made by _encode_cursor, parsing each value with its parser."""
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+        if not isinstance(values, list) or len(values) != len(parsers):
+            raise ValueError(cursor)
+        return [parse(value) for parse, value in zip(parsers, values)]
+    except (binascii.Error, TypeError, ValueError):
+        raise ApiError("Invalid cursor")
+
+
+def _page_size(request):
+    try:
+        limit = int(request.GET.get('limit', DEFAULT_PAGE_SIZE))
+    except ValueError:
+        raise ApiError("limit must be an integer")
+    return max(1, min(limit, MAX_PAGE_SIZE))
+
+
+def _parse_session_ids(values):
+    try:
+        return [uuid.UUID(str(value)) for value in values]
+    except ValueError:
+        raise ApiError("Session ids must be UUIDs")
+
+
+# --- Endpoints ---
+
+@api_view(['GET', 'POST'])
+async def sessions(request):
+    """GET: sessions, newest first, with cursor pagination. POST: create sessions in bulk."""
+    if request.method == 'POST':
+        return await _create_sessions(request)
+
+    limit = _page_size(request)
+    queryset = ResearchSession.objects.annotate(**DOCUMENT_COUNTS).order_by('-created_at', '-pk')
+    if request.GET.get('status'):
+        queryset = queryset.filter(status=request.GET['status'])
+    if request.GET.get('cursor'):
+        created_at, pk = _decode_cursor(request.GET['cursor'], datetime.fromisoformat, uuid.UUID)
+        queryset = queryset.filter(Q(created_at__lt=created_at) | Q(created_at=created_at, pk__lt=pk))
+
+    rows = [row async for row in queryset.values(*SESSION_FIELDS, *DOCUMENT_COUNTS)[:limit + 1]]
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    queue_positions = await _queue_positions()
+    next_cursor = None
+    if has_more:
+        last = rows[-1]
+        next_cursor = _encode_cursor([last['created_at'].isoformat(), str(last['session_id'])])
+    return JsonResponse({
+        'sessions': [_session_json(row, row, queue_positions) for row in rows],
+        'next_cursor': next_cursor,
+    })
+
+
+async def _create_sessions(request):
+    """
+    Multipart body: a 'sessions' field with a JSON list of {"query": ..., "files": [...]},
+    where files are the names of file fields in the same request ("profile": true
+    runs that session under the profiler, "analyze_all": true sends every document
+    to the LLM without the relevance pre-screen). Each session gets its
+    own admission decision; rejected ones are reported with status 'rejected'.
+    """
+    try:
+        manifest = json.loads(request.POST.get('sessions', ''))
+    except ValueError:
+        raise ApiError("'sessions' must be a JSON list of {\"query\": ..., \"files\": [...]} objects")
+    if not isinstance(manifest, list) or not manifest:
+        raise ApiError("'sessions' must be a non-empty list")
+    if len(manifest) > MAX_BULK_SESSIONS:
+        raise ApiError(f"At most {MAX_BULK_SESSIONS} sessions per request")
+
+    # Validate everything before creating anything
+    forms = []
+    for index, item in enumerate(manifest):
+        if not isinstance(item, dict) or not isinstance(item.get('files'), list):
+            raise ApiError(f"sessions[{index}] must have a 'query' and a 'files' list")
+        missing = [name for name in item['files'] if name not in request.FILES]
+        if missing:
+            raise ApiError(f"sessions[{index}] refers to missing file fields: {', '.join(missing)}")
+        files = MultiValueDict({'documents': [request.FILES[name] for name in item['files']]})
+        form = ResearchForm({
+            'query': item.get('query', ''),
+            'profile': bool(item.get('profile')),
+            'analyze_all': bool(item.get('analyze_all')),
+        }, files)
+        if not form.is_valid():
+            raise ApiError(f"sessions[{index}]: {form.errors.as_text()}")
+        forms.append(form)
+
+    results = []
+    for form in forms:
+        uploaded_files = form.cleaned_data['documents']
+        session, queue_position = await acreate_research_session(
+            form.cleaned_data['query'], uploaded_files,
+            profile=form.cleaned_data['profile'], analyze_all=form.cleaned_data['analyze_all'],
+        )
+        if session is None:
+            results.append({'session_id': None, 'status': 'rejected'})
+            continue
+        results.append({
+            'session_id': str(session.session_id),
+            'status': session.status,
+            'queue_position': queue_position,
+            'documents': len(uploaded_files),
+        })
+
+    created = sum(1 for result in results if result['session_id'])
+    response = JsonResponse({'sessions': results}, status=201 if created else 429)
+    if created < len(results):
+        response['Retry-After'] = str(settings.ADMISSION_RETRY_AFTER_SECONDS)
+    return response
+
+
+@api_view(['GET', 'POST'])
+async def session_status(request):
+    """Compact status of many sessions: GET ?ids=a,b,c or POST {"session_ids": [...]}."""
+    if request.method == 'POST':
+        try:
+            ids = json.loads(request.body or b'{}').get('session_ids', [])
+        except (ValueError, AttributeError):
+            raise ApiError("Body must be {\"session_ids\": [...]}")
+    else:
+        ids = [value for value in request.GET.get('ids', '').split(',') if value]
+    if not isinstance(ids, list) or len(ids) > MAX_BULK_IDS:
+        raise ApiError(f"Pass a list of at most {MAX_BULK_IDS} session ids")
+    ids = _parse_session_ids(ids)
+
+    rows = {
+        row['session_id']: row
+        async for row in ResearchSession.objects.filter(pk__in=ids).values(*SESSION_FIELDS)
+    }
+    counts = {
+        row['session']: row
+        async for row in UploadedDocument.objects.filter(session_id__in=rows).values('session').annotate(
+            documents_total=Count('id'),
+            documents_processed=Count('id', filter=Q(status='processed')),
+            documents_skipped=Count('id', filter=Q(status='skipped')),
+            documents_timed_out=Count('id', filter=Q(status='timed_out')),
+            documents_failed=Count('id', filter=Q(status='error')),
+        )
+    }
+    queue_positions = await _queue_positions() if any(r['status'] == 'queued' for r in rows.values()) else {}
+
+    # Progress needs the documents of running sessions only; one query for all of them
+    running = [pk for pk, row in rows.items() if row['status'] in ('pending', 'processing', 'summarizing')]
+    running_documents = {pk: [] for pk in running}
+    async for doc in UploadedDocument.objects.filter(session_id__in=running).only(*PROGRESS_FIELDS):
+        running_documents[doc.session_id].append(doc)
+    stats = await aload_throughput_stats() if running else {}
+
+    sessions = []
+    for pk in ids:
+        if pk not in rows:
+            continue
+        data = _session_json(rows[pk], counts.get(pk, {}), queue_positions)
+        if pk in running_documents:
+            progress = estimate_progress(SimpleNamespace(**rows[pk]), running_documents[pk], stats)
+            data['progress'] = {key: progress[key] for key in ('fraction', 'eta_seconds')}
+        else:
+            data['progress'] = {'fraction': 1.0 if rows[pk]['status'] in ('completed', 'failed') else 0.0, 'eta_seconds': None}
+        sessions.append(data)
+    return JsonResponse({
+        'sessions': sessions,
+        'missing': [str(pk) for pk in ids if pk not in rows],
+    })
+
+
+@api_view(['GET'])
+async def session_documents(request, session_id):
+    """Per-document status and answers of one session, with cursor pagination."""
+    if not await ResearchSession.objects.filter(pk=session_id).aexists():
+        raise ApiError("Session not found", status=404)
+    limit = _page_size(request)
+    queryset = UploadedDocument.objects.filter(session_id=session_id).order_by('id')
+    if request.GET.get('cursor'):
+        (last_id,) = _decode_cursor(request.GET['cursor'], uuid.UUID)
+        queryset = queryset.filter(id__gt=last_id)
+
+    rows = [row async for row in queryset.values(
+        'id', 'original_filename', 'status', 'answer', 'partial_answer', 'quote_check', 'relevance_score', 'processing_log',
+        'file_size',
+    )[:limit + 1]]
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    return JsonResponse({
+        'documents': [
+            {
+                'id': str(row['id']),
+                'filename': row['original_filename'],
+                'status': row['status'],
+                'answer': row['answer'],
+                'partial_answer': row['partial_answer'], # Streamed so far, while the status is 'processing'
+                'quotes': row['quote_check'],
+                'relevance_score': row['relevance_score'], # Pre-screen score; 'skipped' documents fell below the threshold
+                'error': row['processing_log'] if row['status'] == 'error' else None,
+                'file_size': row['file_size'],
+            }
+            for row in rows
+        ],
+        'next_cursor': _encode_cursor([str(rows[-1]['id'])]) if has_more else None,
+    })
+
+
+@api_view(['GET'])
+async def document_text(request, session_id, document_id):
+    """
+    One page, slide, slide notes or section of a document's extracted text
+    (?page=3, ?slide=2, ?notes=2, ?section=Title), or the unit holding a
+    character offset (?at=12345). Found in the stored offsets index; only that
+    range of the text is read from the database.
+    """
+    row = await UploadedDocument.objects.filter(pk=document_id, session_id=session_id).values('text_offsets').afirst()
+    if row is None:
+        raise ApiError("Document not found", status=404)
+    offsets = TextOffsets.from_bytes(row['text_offsets'])
+    if offsets is None:
+        raise ApiError("Document has no extracted text index", status=404)
+
+    if request.GET.get('at'):
+        try:
+            index = offsets.unit_at(int(request.GET['at']))
+        except ValueError:
+            raise ApiError("'at' must be a character offset")
+    else:
+        kind = next((kind for kind in (PAGE, SLIDE, NOTES, SECTION) if request.GET.get(kind)), None)
+        if kind is None:
+            raise ApiError("Pass one of page, slide, notes, section or at")
+        index = offsets.find(kind, request.GET[kind])
+        if index is None:
+            raise ApiError(f"No {kind} {request.GET[kind]!r} in this document", status=404)
+    if index < 0: # Before the first marker
+        start, end, label = 0, (offsets.starts[0] if len(offsets) else offsets.length), None
+    else:
+        (start, end), label = offsets.span(index), offsets.labels[index]
+
+    text = await UploadedDocument.objects.filter(pk=document_id).annotate(
+        unit_text=Substr('extracted_text', start + 1, max(1, end - start)), # SQL strings count from 1
+    ).values_list('unit_text', flat=True).afirst()
+    return JsonResponse({'label': label, 'start': start, 'end': end, 'text': (text or '')[:end - start]})
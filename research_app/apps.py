@@ -4,3 +4,6 @@ from django.apps import AppConfig
 class ResearchAppConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'research_app'
+
+    def ready(self):
+        from . import storage # noqa: F401 (connects the blob release signal)
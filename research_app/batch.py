@@ -0,0 +1,232 @@
+"""
+Headless batch research over a directory of files ('manage.py research_batch').
+
+Files are extracted in a process pool with the same extract_text used by the web
+app, and their prompts go to the shared LLM event loop through aquery_documents,
+so the fair-share scheduler and LLM_MAX_CONCURRENCY cap apply. --llm-concurrency
+is the batch's own cap within that (the scheduler's max_running). Both stages are
+bounded, so only a few documents' text is in memory at a time however large the
+corpus. Each answer is appended to a JSONL file as soon as it arrives; that file
+is also the checkpoint - a rerun skips every file already in it. The DOCX report
+(answers plus summary) is built from the JSONL at the end if requested.
+"""
+import asyncio
+import json
+import os
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from types import SimpleNamespace
+
+from django.conf import settings
+
+from .llm import get_llm_loop, run_llm_coroutine
+from .passages import prompt_text
+from .quotes import unverified_quotes, verify_quotes
+from .summary import format_answer
+from .utils import (
+    SpilledText,
+    add_answer_to_report,
+    add_summary_to_report,
+    add_unverified_quotes_to_report,
+    aquery_documents,
+    aquery_gemini_summary,
+    extract_text,
+    initialize_report,
+)
+
+SUPPORTED_EXTENSIONS = ('.pdf', '.docx', '.pptx', '.txt')
+BATCH_SESSION_KEY = 'research_batch'
+
+
+class _FileDocument:
+    """Stands in for an UploadedDocument so extract_text works on a plain file."""
+
+    def __init__(self, path):
+        self.file = SimpleNamespace(path=path)
+        self.original_filename = os.path.basename(path)
+        self.extracted_text = None
+        self.status = 'uploaded'
+        self.processing_log = ""
+
+    def save(self, *args, **kwargs):
+        pass
+
+
+def find_documents(root):
+    """Relative paths of all supported files under root, in a stable order."""
+    found = []
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames.sort()
+        for name in sorted(filenames):
+            if os.path.splitext(name)[1].lower() in SUPPORTED_EXTENSIONS:
+                found.append(os.path.relpath(os.path.join(dirpath, name), root))
+    return found
+
+
+def load_checkpoint(output_path):
+    """Paths already recorded in the JSONL output. Drops a half-written last line."""
+    done = set()
+    if not os.path.exists(output_path):
+        return done
+    with open(output_path, 'rb+') as f:
+        data = f.read()
+        complete = data.rfind(b'\n') + 1
+        if complete < len(data):
+            f.truncate(complete) # Interrupted mid-write
+    for line in data[:complete].decode('utf-8').splitlines():
+        if line.strip():
+            done.add(json.loads(line)['path'])
+    return done
+
+
+def read_records(output_path):
+    with open(output_path, encoding='utf-8') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def _init_extract_worker():
+    import django
+
+    django.setup()
+    sys.stdout = open(os.devnull, 'w') # extract_text prints per file; keep the progress line readable
+
+
+def _extract(root, rel_path, query):
+    """Runs in an extraction process; returns only the text that goes into the prompt (see passages.py)."""
+    started = time.perf_counter()
+    doc = _FileDocument(os.path.join(root, rel_path))
+    text, metadata = extract_text(doc)
+    elapsed = time.perf_counter() - started
+    if doc.status != 'converted':
+        return None, None, doc.processing_log or "Extraction failed", elapsed, 0
+    return prompt_text(text, query), metadata, None, elapsed, len(text)
+
+
+class BatchRunner:
+    """Runs one query over every supported file in a directory."""
+
+    def __init__(self, root, query, output_path, extract_workers=None, llm_concurrency=None,
+                 restart=False, progress=sys.stderr):
+        self.root = root
+        self.query = query
+        self.output_path = output_path
+        self.extract_workers = extract_workers or os.cpu_count() or 1
+        self.llm_concurrency = min(llm_concurrency or settings.LLM_MAX_CONCURRENCY, settings.LLM_MAX_CONCURRENCY)
+        self.restart = restart
+        self.progress = progress
+        self.stats = {'total': 0, 'skipped': 0, 'processed': 0, 'errors': 0, 'chars': 0}
+
+    # --- Progress ---
+
+    def _report_progress(self, extracting, querying, final=False):
+        now = time.monotonic()
+        if not final and now - self._last_progress < 0.5:
+            return
+        self._last_progress = now
+        finished = self.stats['processed'] + self.stats['errors']
+        remaining = self.stats['total'] - self.stats['skipped'] - finished
+        elapsed = max(now - self._started, 1e-9)
+        rate = finished / elapsed
+        eta = f"{remaining / rate:.0f}s" if rate and remaining else "-"
+        self.progress.write(
+            f"\r{finished + self.stats['skipped']}/{self.stats['total']} docs | {rate:.2f} docs/s | "
+            f"{self.stats['chars'] / elapsed / 1e6:.2f} M chars/s | extracting {extracting} | "
+            f"querying {querying} | errors {self.stats['errors']} | ETA {eta}   "
+        )
+        if final:
+            self.progress.write("\n")
+        self.progress.flush()
+
+    # --- Pipeline ---
+
+    def _write(self, out, record):
+        out.write(json.dumps(record, ensure_ascii=False) + "\n")
+        out.flush()
+        self.stats['errors' if record['status'] == 'error' else 'processed'] += 1
+
+    def run(self):
+        """Processes every file not yet in the output. Returns the stats dict."""
+        paths = find_documents(self.root)
+        if self.restart and os.path.exists(self.output_path):
+            os.remove(self.output_path)
+        done = load_checkpoint(self.output_path)
+        pending = [path for path in paths if path not in done]
+        self.stats.update(total=len(paths), skipped=len(paths) - len(pending))
+        todo = iter(pending)
+
+        loop = get_llm_loop()
+        self._started = self._last_progress = time.monotonic()
+        # Bounded stages: extract a little ahead of the LLM, never the whole corpus
+        max_extracting = self.extract_workers * 2
+        max_querying = self.llm_concurrency * 2
+        extracting = {} # future -> path
+        querying = {} # future -> (path, text, extract_seconds, started)
+
+        with ProcessPoolExecutor(self.extract_workers, initializer=_init_extract_worker) as pool, \
+                open(self.output_path, 'a', encoding='utf-8') as out:
+            while True:
+                while len(extracting) < max_extracting and len(querying) < max_querying:
+                    path = next(todo, None)
+                    if path is None:
+                        break
+                    extracting[pool.submit(_extract, self.root, path, self.query)] = path
+                if not extracting and not querying:
+                    break
+
+                finished, _ = wait(list(extracting) + list(querying), timeout=0.5, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    if future in extracting:
+                        path = extracting.pop(future)
+                        try:
+                            text, metadata, error, seconds, chars = future.result()
+                        except Exception as e:
+                            text, metadata, error, seconds, chars = None, None, f"Extraction crashed: {e}", 0, 0
+                        if error:
+                            self._write(out, {'path': path, 'status': 'error', 'answer': None, 'error': error})
+                            continue
+                        self.stats['chars'] += chars
+                        query = asyncio.run_coroutine_threadsafe(aquery_documents(
+                            [(text, os.path.basename(path), metadata)], self.query, session_key=BATCH_SESSION_KEY,
+                            max_running=self.llm_concurrency,
+                        ), loop)
+                        querying[query] = (path, text, seconds, time.perf_counter())
+                    else:
+                        path, text, extract_seconds, started = querying.pop(future)
+                        try:
+                            answer, quotes = future.result()[0]
+                        except Exception as e:
+                            answer, quotes = f"Error: {e}", []
+                        failed = "Error:" in answer
+                        self._write(out, {
+                            'path': path,
+                            'status': 'error' if failed else 'processed',
+                            'answer': answer,
+                            'error': answer if failed else None,
+                            'quotes': verify_quotes(text, quotes),
+                            'extract_seconds': round(extract_seconds, 3),
+                            'llm_seconds': round(time.perf_counter() - started, 3),
+                        })
+                self._report_progress(len(extracting), len(querying))
+        self._report_progress(0, 0, final=True)
+        return self.stats
+
+    # --- Report ---
+
+    def write_report(self, docx_path):
+        """Builds the DOCX report, with a summary, from every record in the output."""
+        report = initialize_report(self.query)
+        answers_for_summary = SpilledText()
+        for record in sorted(read_records(self.output_path), key=lambda r: r['path']):
+            if record['answer'] is not None:
+                add_answer_to_report(report, record['path'], record['answer'])
+                if unverified_quotes(record.get('quotes')):
+                    add_unverified_quotes_to_report(report, unverified_quotes(record['quotes']))
+                answers_for_summary.append(format_answer(record['path'], record['answer']))
+            else:
+                add_answer_to_report(report, record['path'], f"Error processing document: {record['error']}")
+        summary = run_llm_coroutine(aquery_gemini_summary(answers_for_summary, self.query))
+        answers_for_summary.close()
+        add_summary_to_report(report, summary)
+        report.save(docx_path)
+        return summary
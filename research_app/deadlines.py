@@ -0,0 +1,122 @@
+"""
+Deadlines for LLM work: per-call timeouts, hedged requests and session time budgets.
+
+- Every LLM call attempt is cut off after LLM_CALL_TIMEOUT seconds and goes to
+  the normal retry path, so one hung request can't hold a document forever.
+- With LLM_HEDGING on, a call still running after the LLM_HEDGE_PERCENTILE
+  latency of recent calls with similar prompt sizes gets a duplicate request.
+  Whichever answers first wins and the other is cancelled. Latencies are kept
+  in-process per prompt size bucket (as in progress.py); until a bucket has
+  LLM_HEDGE_MIN_SAMPLES calls nothing is hedged. At most LLM_HEDGE_MAX_IN_FLIGHT
+  duplicates run at once, so a slow backend doesn't get twice the load.
+- SESSION_TIME_BUDGET caps a whole session, from the start of processing to the
+  report. The deadline is stored on the session (deadline_at), so every worker
+  sees the same one. Documents still unanswered SESSION_SUMMARY_RESERVE seconds
+  before it are marked 'timed_out'. The summary gets the rest, and if that runs
+  out too the report keeps whatever summary text had streamed in. Either way the
+  session ends with a report that says what is missing instead of blocking.
+"""
+import asyncio
+import logging
+from collections import defaultdict, deque
+from datetime import timedelta
+
+from django.conf import settings
+from django.utils import timezone
+
+from .progress import llm_size_bucket
+
+logger = logging.getLogger(__name__)
+
+TIMED_OUT = "Error: Timed out" # Stands in for an answer or summary when the session budget ran out
+LATENCY_WINDOW = 200 # Recent calls kept per prompt size bucket
+
+# Report texts
+DOCUMENT_TIMED_OUT_NOTE = "Nie przeanalizowano: skończył się limit czasu sesji, zanim dokument otrzymał odpowiedź."
+SUMMARY_TIMED_OUT_NOTE = "Synteza niekompletna: skończył się limit czasu sesji."
+
+_latencies = defaultdict(lambda: deque(maxlen=LATENCY_WINDOW)) # Only touched on the LLM event loop
+_hedges_in_flight = 0
+
+
+# --- Session budget ---
+
+def session_deadline():
+    """Deadline for a session starting now, or None without a budget."""
+    if not settings.SESSION_TIME_BUDGET:
+        return None
+    return timezone.now() + timedelta(seconds=settings.SESSION_TIME_BUDGET)
+
+
+def seconds_left(deadline_at, reserve=0):
+    """Seconds until deadline_at minus reserve (may be negative), or None without a deadline."""
+    if deadline_at is None:
+        return None
+    return (deadline_at - timezone.now()).total_seconds() - reserve
+
+
+def documents_seconds_left(deadline_at):
+    """Time left for document queries; the last SESSION_SUMMARY_RESERVE seconds are kept for the summary."""
+    return seconds_left(deadline_at, settings.SESSION_SUMMARY_RESERVE)
+
+
+async def within(coro, timeout):
+    """Awaits coro, or gives up after timeout seconds (None = no limit) and returns TIMED_OUT."""
+    if timeout is None:
+        return await coro
+    try:
+        return await asyncio.wait_for(coro, max(0, timeout))
+    except TimeoutError:
+        return TIMED_OUT
+
+
+# --- Hedged calls ---
+
+def note_latency(prompt_chars, seconds):
+    _latencies[llm_size_bucket(prompt_chars)].append(seconds)
+
+
+def hedge_delay(prompt_chars):
+    """How long a call may run before it is hedged, or None to not hedge it."""
+    if not settings.LLM_HEDGING:
+        return None
+    samples = _latencies.get(llm_size_bucket(prompt_chars))
+    if not samples or len(samples) < settings.LLM_HEDGE_MIN_SAMPLES:
+        return None
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * settings.LLM_HEDGE_PERCENTILE / 100))]
+
+
+async def hedged(call, prompt_chars):
+    """
+    Awaits call(True). If it runs past hedge_delay(), also starts call(False), a
+    duplicate that must not report partial output, and returns the first success.
+    """
+    global _hedges_in_flight
+    loop = asyncio.get_running_loop()
+    started = loop.time()
+    primary = asyncio.ensure_future(call(True))
+    tasks = {primary}
+    hedge = None
+    try:
+        delay = hedge_delay(prompt_chars)
+        if delay is not None:
+            await asyncio.wait(tasks, timeout=delay)
+            if not primary.done() and _hedges_in_flight < settings.LLM_HEDGE_MAX_IN_FLIGHT:
+                logger.info(f"Hedging an LLM call still running after {delay:.1f}s ({prompt_chars} prompt chars)")
+                _hedges_in_flight += 1
+                hedge = asyncio.ensure_future(call(False))
+                tasks.add(hedge)
+        pending = set(tasks)
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if not task.cancelled() and task.exception() is None:
+                    note_latency(prompt_chars, loop.time() - started)
+                    return task.result()
+        return primary.result() # Both failed: raise the primary's error
+    finally:
+        for task in tasks:
+            task.cancel()
+        if hedge is not None:
+            _hedges_in_flight -= 1
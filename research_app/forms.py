@@ -27,6 +27,12 @@ class ResearchForm(forms.Form):
         label='Research Query',
         required=True
     )
+    # Opt-in profiling of this session's processing (see profiling.py); not shown on the form
+    profile = forms.BooleanField(required=False)
+    analyze_all = forms.BooleanField(
+        label='Analyze every document (skip the relevance pre-screen)',
+        required=False
+    )
 
     def clean_documents(self):
         files = self.cleaned_data['documents']  # Now this will be a list of files
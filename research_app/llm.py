@@ -0,0 +1,176 @@
+"""
+Async HTTP transport for Gemini calls.
+
+All async LLM traffic goes through one pooled httpx.AsyncClient living on a
+dedicated event loop thread. Connections are kept alive and reused across
+documents and sessions, the number of sockets is capped, and connect/read
+timeouts are explicit. Sync code (views, the processing function) hands
+coroutines to that loop with run_llm_coroutine(), or submit_llm_coroutine() to
+keep working while they run.
+
+Answers are streamed (gemini_stream_async), so partial text can be shown while
+a response is still being generated. guard_stalls() cancels a stream that stops
+producing output after LLM_STREAM_FIRST_CHUNK_TIMEOUT / LLM_STREAM_STALL_TIMEOUT
+seconds, well before the HTTP read timeout. LocalStreamingLLM stands in for the
+streaming endpoint in tests and local runs.
+"""
+import asyncio
+import concurrent.futures
+import json
+import re
+import threading
+
+from django.conf import settings
+
+GEMINI_API_BASE_URL = 'https://generativelanguage.googleapis.com/v1beta/'
+
+_llm_loop = None
+_llm_loop_lock = threading.Lock()
+_http_client = None
+
+
+def get_llm_loop():
+    """Returns the shared LLM event loop, starting its thread on first use."""
+    global _llm_loop
+    with _llm_loop_lock:
+        if _llm_loop is None or _llm_loop.is_closed():
+            _llm_loop = asyncio.new_event_loop()
+            thread = threading.Thread(target=_llm_loop.run_forever, name='llm-event-loop', daemon=True)
+            thread.start()
+    return _llm_loop
+
+
+def submit_llm_coroutine(coro):
+    """Starts a coroutine on the shared LLM event loop without waiting; returns a concurrent.futures.Future."""
+    return asyncio.run_coroutine_threadsafe(coro, get_llm_loop())
+
+
+def wait_llm_futures(futures, tick=None, tick_seconds=0.5):
+    """
+    Blocks until every future from submit_llm_coroutine() is done and returns their results.
+    tick(), if given, runs on the calling thread every tick_seconds while it waits
+    and once at the end (e.g. to save streamed text, which the loop can't do itself).
+    """
+    if tick is not None:
+        while not all(future.done() for future in futures):
+            concurrent.futures.wait(futures, timeout=tick_seconds)
+            tick()
+    return [future.result() for future in futures]
+
+
+def run_llm_coroutine(coro, tick=None, tick_seconds=0.5):
+    """Runs a coroutine on the shared LLM event loop and blocks until it finishes (tick as in wait_llm_futures)."""
+    return wait_llm_futures([submit_llm_coroutine(coro)], tick, tick_seconds)[0]
+
+
+def get_async_http_client():
+    """Returns the shared pooled HTTP client. Must be called on the LLM event loop."""
+    global _http_client
+    if _http_client is None or _http_client.is_closed:
+        import httpx
+
+        _http_client = httpx.AsyncClient(
+            base_url=GEMINI_API_BASE_URL,
+            headers={'x-goog-api-key': settings.GEMINI_API_KEY or ''},
+            http2=settings.GEMINI_HTTP2, # Needs the optional 'h2' package
+            limits=httpx.Limits(
+                max_connections=settings.GEMINI_HTTP_MAX_CONNECTIONS,
+                max_keepalive_connections=settings.GEMINI_HTTP_MAX_KEEPALIVE,
+                keepalive_expiry=settings.GEMINI_HTTP_KEEPALIVE_EXPIRY,
+            ),
+            timeout=httpx.Timeout(
+                connect=settings.GEMINI_HTTP_CONNECT_TIMEOUT,
+                read=settings.GEMINI_HTTP_READ_TIMEOUT,
+                write=settings.GEMINI_HTTP_CONNECT_TIMEOUT,
+                pool=settings.GEMINI_HTTP_READ_TIMEOUT, # Waiting for a free connection
+            ),
+        )
+    return _http_client
+
+
+async def gemini_generate_async(prompt, model):
+    """Sends one generateContent request and returns the response text."""
+    client = get_async_http_client()
+    response = await client.post(
+        f'models/{model}:generateContent',
+        json={'contents': [{'role': 'user', 'parts': [{'text': prompt}]}]},
+    )
+    response.raise_for_status()
+    candidates = response.json().get('candidates') or []
+    if not candidates:
+        raise ValueError(f"Gemini returned no candidates: {response.text[:200]}")
+    parts = candidates[0].get('content', {}).get('parts', [])
+    return ''.join(part.get('text', '') for part in parts)
+
+
+async def gemini_stream_async(prompt, model):
+    """Sends one streamGenerateContent request and yields the text chunks as they arrive."""
+    client = get_async_http_client()
+    async with client.stream(
+        'POST',
+        f'models/{model}:streamGenerateContent',
+        params={'alt': 'sse'},
+        json={'contents': [{'role': 'user', 'parts': [{'text': prompt}]}]},
+    ) as response:
+        if response.is_error:
+            await response.aread()
+            response.raise_for_status()
+        async for line in response.aiter_lines():
+            if not line.startswith('data:'):
+                continue # Blank separators between server-sent events
+            candidates = json.loads(line[len('data:'):]).get('candidates') or []
+            if candidates:
+                text = ''.join(part.get('text', '') for part in candidates[0].get('content', {}).get('parts', []))
+                if text:
+                    yield text
+
+
+class LLMStreamStalled(TimeoutError):
+    pass
+
+
+async def guard_stalls(chunks, first_chunk_timeout=None, stall_timeout=None):
+    """
+    Re-yields the chunks of an async iterator, raising LLMStreamStalled (and closing
+    the stream) when the first chunk or the gap between two chunks takes too long.
+    """
+    first_chunk_timeout = first_chunk_timeout or settings.LLM_STREAM_FIRST_CHUNK_TIMEOUT
+    stall_timeout = stall_timeout or settings.LLM_STREAM_STALL_TIMEOUT
+    iterator = chunks.__aiter__()
+    timeout = first_chunk_timeout
+    try:
+        while True:
+            try:
+                chunk = await asyncio.wait_for(iterator.__anext__(), timeout)
+            except StopAsyncIteration:
+                return
+            except asyncio.TimeoutError:
+                raise LLMStreamStalled(f"LLM stream stalled: no output for {timeout:g}s")
+            yield chunk
+            timeout = stall_timeout
+    finally:
+        if hasattr(iterator, 'aclose'):
+            await iterator.aclose() # Ends the HTTP response, freeing the connection
+
+
+class LocalStreamingLLM:
+    """
+    Stand-in for gemini_stream_async in tests and local runs. Gets the full text from
+    generate(prompt, model) and streams it back a few words at a time. With
+    stall_after=n it stops sending after n chunks without closing, like a hung connection.
+    """
+
+    def __init__(self, generate, words_per_chunk=3, delay=0.0, stall_after=None):
+        self.generate = generate
+        self.words_per_chunk = words_per_chunk
+        self.delay = delay
+        self.stall_after = stall_after
+
+    async def stream(self, prompt, model):
+        pieces = re.split(r'(?<=\s)(?=\S)', await self.generate(prompt, model)) # Words with their trailing space
+        for number, start in enumerate(range(0, len(pieces), self.words_per_chunk)):
+            if self.stall_after is not None and number >= self.stall_after:
+                await asyncio.Event().wait() # Never set
+            if self.delay:
+                await asyncio.sleep(self.delay)
+            yield ''.join(pieces[start:start + self.words_per_chunk])
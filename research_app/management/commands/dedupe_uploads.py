@@ -0,0 +1,73 @@
+import os
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from research_app.models import UploadedDocument
+from research_app.storage import adopt_file, hash_file
+
+
+class Command(BaseCommand):
+    help = "Moves legacy uploads (media/uploads/<session_id>/...) into content-addressed blob storage, keeping one copy per content."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=200, help="Documents loaded per query")
+        parser.add_argument('--dry-run', action='store_true', help="Only report how much space deduplication would save")
+
+    def handle(self, *args, **options):
+        dry_run = options['dry_run']
+        seen = set() # Content hashes, for the dry run
+        documents = moved = duplicates = missing = saved_bytes = 0
+
+        last_pk = None
+        while True:
+            batch = UploadedDocument.objects.filter(blob__isnull=True).exclude(file='').order_by('pk')
+            if last_pk is not None:
+                batch = batch.filter(pk__gt=last_pk)
+            batch = list(batch.only('pk', 'file')[:options['batch_size']])
+            if not batch:
+                break
+            last_pk = batch[-1].pk
+
+            for doc in batch:
+                documents += 1
+                path = doc.file.path
+                if not os.path.exists(path):
+                    missing += 1
+                    continue
+                size = os.path.getsize(path)
+                if dry_run:
+                    key = (hash_file(path), os.path.splitext(path)[1].lower())
+                    if key in seen:
+                        duplicates += 1
+                        saved_bytes += size
+                    else:
+                        moved += 1
+                    seen.add(key)
+                    continue
+
+                blob, reused = adopt_file(path)
+                if reused:
+                    os.remove(path) # Same content is already stored
+                    duplicates += 1
+                    saved_bytes += size
+                else:
+                    moved += 1
+                doc.blob = blob
+                doc.file.name = blob.file.name
+                doc.save(update_fields=['blob', 'file'])
+
+        if not dry_run:
+            self._remove_empty_dirs(os.path.join(settings.MEDIA_ROOT, 'uploads'))
+        would = "would be " if dry_run else ""
+        self.stdout.write(
+            f"{documents} legacy document(s): {moved} {would}moved to blob storage, {duplicates} duplicate(s) "
+            f"{would}removed ({saved_bytes / (1024 * 1024):.1f} MB), {missing} missing file(s)"
+        )
+
+    def _remove_empty_dirs(self, root):
+        if not os.path.isdir(root):
+            return
+        for dirpath, dirnames, filenames in os.walk(root, topdown=False):
+            if dirpath != root and not os.listdir(dirpath):
+                os.rmdir(dirpath)
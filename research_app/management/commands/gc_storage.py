@@ -0,0 +1,38 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from research_app import retention
+
+
+class Command(BaseCommand):
+    help = "Applies the retention policy: expires old sessions, evicts LRU sessions over the size budget, clears extracted text, sweeps orphaned files and expires unused passage indexes."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--max-age-days', type=int, default=settings.RETENTION_MAX_AGE_DAYS)
+        parser.add_argument('--text-days', type=int, default=settings.RETENTION_EXTRACTED_TEXT_DAYS)
+        parser.add_argument('--max-bytes', type=int, default=settings.RETENTION_MAX_BYTES)
+        parser.add_argument('--batch-size', type=int, default=settings.RETENTION_BATCH_SIZE)
+        parser.add_argument('--pause', type=float, default=0.05, help="Seconds between batches, leaving the DB to other writers")
+        parser.add_argument('--vacuum', action='store_true', help="VACUUM the SQLite database afterwards (locks it while running)")
+
+    def handle(self, *args, **options):
+        batch_size, pause = options['batch_size'], options['pause']
+        usage_before = retention.storage_usage()
+
+        expired = evicted = cleared = indexes = 0
+        if options['max_age_days']:
+            expired = retention.expire_old_sessions(options['max_age_days'], batch_size, pause)
+            indexes = retention.expire_vector_indexes(options['max_age_days'])
+        if options['max_bytes']:
+            evicted = retention.evict_to_budget(options['max_bytes'], batch_size, pause)
+        if options['text_days']:
+            cleared = retention.clear_extracted_text(options['text_days'], batch_size, pause)
+        orphans = retention.sweep_orphans(settings.RETENTION_ORPHAN_GRACE_SECONDS, batch_size)
+        if options['vacuum']:
+            retention.vacuum_database()
+
+        usage_after = retention.storage_usage()
+        self.stdout.write(
+            f"Expired {expired} session(s), evicted {evicted} over budget, cleared text of {cleared} document(s), "
+            f"removed {orphans} orphaned file(s) and {indexes} unused passage index file(s). Storage: {usage_before / (1024 * 1024):.1f} MB -> {usage_after / (1024 * 1024):.1f} MB"
+        )
@@ -0,0 +1,73 @@
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from research_app.models import UploadedDocument
+from research_app.relevance import query_terms, relevance_score
+
+NO_INFORMATION = "nie zawiera informacji" # What the prompt asks the LLM to say when a document has nothing
+
+
+class Command(BaseCommand):
+    help = "Re-scores stored documents with the relevance pre-screen and shows skip rates and misses at several cutoffs."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--threshold', type=float, action='append', dest='thresholds',
+            help="RELEVANCE_MIN_SCORE to evaluate; repeat for several (default: 0, 0.02, 0.05, 0.1, 0.2 and the current one). "
+                 "Documents with no query term (score 0) are skipped at every cutoff, 0 included",
+        )
+        parser.add_argument('--days', type=int, default=30, help="Only documents of sessions created this recently")
+        parser.add_argument('--batch-size', type=int, default=200, help="Documents loaded per query")
+
+    def handle(self, *args, **options):
+        thresholds = sorted(set(options['thresholds'] or [0, 0.02, 0.05, 0.1, 0.2, settings.RELEVANCE_MIN_SCORE]))
+        since = timezone.now() - timedelta(days=options['days'])
+        documents = (
+            UploadedDocument.objects
+            .filter(session__created_at__gte=since, status__in=('processed', 'skipped'), extracted_text__isnull=False)
+            .select_related('session').only('status', 'answer', 'extracted_text', 'session__query')
+        )
+
+        terms_by_query = {}
+        rows = [] # (score, status, the LLM found something)
+        seconds, slowest = 0.0, 0.0
+        for doc in documents.iterator(chunk_size=options['batch_size']):
+            query = doc.session.query
+            if query not in terms_by_query:
+                terms_by_query[query] = query_terms(query)
+            started = time.perf_counter()
+            score = relevance_score(doc.extracted_text, terms_by_query[query])
+            elapsed = time.perf_counter() - started
+            seconds += elapsed
+            slowest = max(slowest, elapsed)
+            if score is not None:
+                rows.append((score, doc.status, doc.status == 'processed' and NO_INFORMATION not in (doc.answer or '')))
+
+        if not rows:
+            self.stdout.write("No scored documents with stored text in that period.")
+            return
+        answered = [row for row in rows if row[1] == 'processed']
+        self.stdout.write(
+            f"{len(rows)} document(s) re-scored in {seconds * 1000:.0f} ms "
+            f"({seconds * 1000 / len(rows):.1f} ms mean, {slowest * 1000:.1f} ms max); "
+            f"{len(rows) - len(answered)} were skipped by the pre-screen at the time"
+        )
+        self.stdout.write(f"{'threshold':>9}  {'skip rate':>9}  {'LLM agreed':>10}  {'missed':>6}")
+        for threshold in thresholds:
+            below = [row for row in rows if row[0] == 0 or row[0] < threshold]
+            # Of the documents the LLM did see, the ones this cutoff would have skipped
+            answered_below = [row for row in answered if row[0] == 0 or row[0] < threshold]
+            missed = sum(1 for row in answered_below if row[2])
+            marker = " (current)" if threshold == settings.RELEVANCE_MIN_SCORE else ""
+            self.stdout.write(
+                f"{threshold:>9g}  {100 * len(below) / len(rows):>8.1f}%  "
+                f"{len(answered_below) - missed:>10}  {missed:>6}{marker}"
+            )
+        self.stdout.write(
+            "'LLM agreed': answered documents below the threshold whose answer said they had no information; "
+            "'missed': ones where the LLM found something."
+        )
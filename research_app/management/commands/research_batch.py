@@ -0,0 +1,40 @@
+import os
+
+from django.core.management.base import BaseCommand, CommandError
+
+from research_app.batch import BatchRunner
+
+
+class Command(BaseCommand):
+    help = "Runs a research query over every PDF/DOCX/PPTX/TXT file in a directory, streaming answers to JSONL."
+
+    def add_arguments(self, parser):
+        parser.add_argument('directory')
+        parser.add_argument('--query', required=True)
+        parser.add_argument('--output', required=True, help="JSONL file for per-document answers; also the resume checkpoint")
+        parser.add_argument('--docx', help="Write a DOCX report with a summary here when done")
+        parser.add_argument('--extract-workers', type=int, help="Extraction processes (default: CPU count)")
+        parser.add_argument('--llm-concurrency', type=int, help="In-flight LLM calls (default and maximum: LLM_MAX_CONCURRENCY)")
+        parser.add_argument('--restart', action='store_true', help="Discard the existing output instead of resuming")
+
+    def handle(self, *args, **options):
+        if not os.path.isdir(options['directory']):
+            raise CommandError(f"Not a directory: {options['directory']}")
+
+        runner = BatchRunner(
+            options['directory'],
+            options['query'],
+            options['output'],
+            extract_workers=options['extract_workers'],
+            llm_concurrency=options['llm_concurrency'],
+            restart=options['restart'],
+            progress=self.stderr,
+        )
+        stats = runner.run()
+        self.stdout.write(
+            f"{stats['processed']} processed, {stats['errors']} error(s), "
+            f"{stats['skipped']} already done, {stats['total']} file(s) in total"
+        )
+        if options['docx']:
+            runner.write_report(options['docx'])
+            self.stdout.write(f"Report written to {options['docx']}")
@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand
+
+from research_app.workers import DocumentWorker
+
+
+class Command(BaseCommand):
+    help = "Runs a document worker that claims and processes documents under a lease (PROCESSING_MODE = 'workers')."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, help="Documents claimed at a time (default: WORKER_BATCH_SIZE)")
+        parser.add_argument('--lease-seconds', type=int, help="Lease length (default: WORKER_LEASE_SECONDS)")
+        parser.add_argument('--poll-interval', type=float, help="Seconds to wait when idle (default: WORKER_POLL_INTERVAL)")
+        parser.add_argument('--owner', help="Worker id (default: host:pid:random)")
+        parser.add_argument('--once', action='store_true', help="Exit when there is nothing left to claim")
+
+    def handle(self, *args, **options):
+        worker = DocumentWorker(
+            owner=options['owner'],
+            batch_size=options['batch_size'],
+            lease_seconds=options['lease_seconds'],
+            poll_interval=options['poll_interval'],
+        )
+        self.stdout.write(f"Worker {worker.owner} running")
+        try:
+            worker.run(once=options['once'])
+        except KeyboardInterrupt:
+            worker.stop()
@@ -0,0 +1,28 @@
+# Generated by Django 5.2 on 2026-10-19 07:37
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('research_app', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='uploadeddocument',
+            name='estimated_tokens',
+            field=models.PositiveBigIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='uploadeddocument',
+            name='file_size',
+            field=models.PositiveBigIntegerField(default=0),
+        ),
+        migrations.AlterField(
+            model_name='researchsession',
+            name='status',
+            field=models.CharField(choices=[('queued', 'Waiting in Queue'), ('pending', 'Pending'), ('processing', 'Processing Documents'), ('summarizing', 'Generating Summary'), ('completed', 'Completed'), ('failed', 'Failed')], default='pending', max_length=20),
+        ),
+    ]
@@ -0,0 +1,38 @@
+# Generated by Django 5.2 on 2026-10-19 07:39
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('research_app', '0002_admission_control'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='researchsession',
+            name='lease_expires_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='researchsession',
+            name='lease_owner',
+            field=models.CharField(blank=True, max_length=100, null=True),
+        ),
+        migrations.AddField(
+            model_name='uploadeddocument',
+            name='answer',
+            field=models.TextField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='uploadeddocument',
+            name='lease_expires_at',
+            field=models.DateTimeField(blank=True, db_index=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='uploadeddocument',
+            name='lease_owner',
+            field=models.CharField(blank=True, max_length=100, null=True),
+        ),
+    ]
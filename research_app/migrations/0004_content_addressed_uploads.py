@@ -0,0 +1,42 @@
+# Generated by Django 5.2 on 2026-10-19 07:43
+
+import django.db.models.deletion
+import django.utils.timezone
+import research_app.models
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('research_app', '0003_document_leases'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='uploadeddocument',
+            name='file',
+            field=models.FileField(max_length=255, upload_to=research_app.models.get_upload_path),
+        ),
+        migrations.CreateModel(
+            name='StoredBlob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('sha256', models.CharField(max_length=64)),
+                ('extension', models.CharField(blank=True, max_length=16)),
+                ('file', models.FileField(max_length=255, upload_to='')),
+                ('size', models.PositiveBigIntegerField(default=0)),
+                ('ref_count', models.PositiveIntegerField(default=0)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('last_used_at', models.DateTimeField(default=django.utils.timezone.now)),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('sha256', 'extension'), name='unique_blob_content')],
+            },
+        ),
+        migrations.AddField(
+            model_name='uploadeddocument',
+            name='blob',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.PROTECT, related_name='documents', to='research_app.storedblob'),
+        ),
+    ]
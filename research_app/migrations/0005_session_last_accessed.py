@@ -0,0 +1,18 @@
+# Generated by Django 5.2 on 2026-10-19 07:45
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('research_app', '0004_content_addressed_uploads'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='researchsession',
+            name='last_accessed_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2 on 2026-10-19 07:50
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('research_app', '0005_session_last_accessed'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='uploadeddocument',
+            name='quote_check',
+            field=models.JSONField(blank=True, null=True),
+        ),
+    ]
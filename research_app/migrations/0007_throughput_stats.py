@@ -0,0 +1,32 @@
+# Generated by Django 5.2 on 2026-10-19 07:54
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('research_app', '0006_document_quote_check'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='uploadeddocument',
+            name='stage_started_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.CreateModel(
+            name='ThroughputStat',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('stage', models.CharField(choices=[('extract', 'Extraction (bytes/s by file type)'), ('llm', 'LLM call (seconds by prompt size)')], max_length=20)),
+                ('bucket', models.CharField(max_length=32)),
+                ('value', models.FloatField()),
+                ('samples', models.PositiveBigIntegerField(default=0)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('stage', 'bucket'), name='unique_throughput_bucket')],
+            },
+        ),
+    ]
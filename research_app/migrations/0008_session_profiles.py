@@ -0,0 +1,23 @@
+# Generated by Django 5.2 on 2026-10-19 08:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('research_app', '0007_throughput_stats'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='researchsession',
+            name='profile_filename',
+            field=models.CharField(blank=True, max_length=255, null=True),
+        ),
+        migrations.AddField(
+            model_name='researchsession',
+            name='profile_requested',
+            field=models.BooleanField(default=False),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.2 on 2026-10-19 08:09
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('research_app', '0008_session_profiles'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='researchsession',
+            name='partial_summary',
+            field=models.TextField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='uploadeddocument',
+            name='partial_answer',
+            field=models.TextField(blank=True, null=True),
+        ),
+    ]
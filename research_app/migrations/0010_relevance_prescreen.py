@@ -0,0 +1,28 @@
+# Generated by Django 5.2 on 2026-10-19 08:14
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('research_app', '0009_streamed_text'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='researchsession',
+            name='analyze_all',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddField(
+            model_name='uploadeddocument',
+            name='relevance_score',
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.AlterField(
+            model_name='uploadeddocument',
+            name='status',
+            field=models.CharField(choices=[('uploaded', 'Uploaded'), ('converting', 'Converting'), ('converted', 'Converted'), ('processing', 'Querying LLM'), ('processed', 'Processed'), ('skipped', 'Skipped (not relevant)'), ('error', 'Error')], default='uploaded', max_length=20),
+        ),
+    ]
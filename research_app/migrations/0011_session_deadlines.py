@@ -0,0 +1,23 @@
+# Generated by Django 5.2 on 2026-10-19 08:23
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('research_app', '0010_relevance_prescreen'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='researchsession',
+            name='deadline_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AlterField(
+            model_name='uploadeddocument',
+            name='status',
+            field=models.CharField(choices=[('uploaded', 'Uploaded'), ('converting', 'Converting'), ('converted', 'Converted'), ('processing', 'Querying LLM'), ('processed', 'Processed'), ('skipped', 'Skipped (not relevant)'), ('timed_out', 'Timed out'), ('error', 'Error')], default='uploaded', max_length=20),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.2 on 2026-10-19 08:29
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('research_app', '0011_session_deadlines'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='throughputstat',
+            name='bucket',
+            field=models.CharField(max_length=100),
+        ),
+        migrations.AlterField(
+            model_name='throughputstat',
+            name='stage',
+            field=models.CharField(choices=[('extract', 'Extraction (bytes/s by file type)'), ('llm', 'LLM call (seconds by prompt size)'), ('model', 'LLM call (seconds by model and prompt size)'), ('model_errors', 'LLM call failure rate by model')], max_length=20),
+        ),
+    ]
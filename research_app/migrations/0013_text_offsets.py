@@ -0,0 +1,18 @@
+# Generated by Django 5.2 on 2026-10-19 08:31
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('research_app', '0012_model_routing_stats'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='uploadeddocument',
+            name='text_offsets',
+            field=models.BinaryField(blank=True, null=True),
+        ),
+    ]
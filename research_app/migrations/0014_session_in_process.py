@@ -0,0 +1,18 @@
+# Generated by Django 5.2 on 2026-10-19 09:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('research_app', '0013_text_offsets'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='researchsession',
+            name='in_process',
+            field=models.BooleanField(default=False),
+        ),
+    ]
@@ -3,9 +3,11 @@ import os
 
 from django.db import models
 from django.conf import settings
+from django.utils import timezone
 
 class ResearchSession(models.Model):
     STATUS_CHOICES = [
+        ('queued', 'Waiting in Queue'),
         ('pending', 'Pending'),
         ('processing', 'Processing Documents'),
         ('summarizing', 'Generating Summary'),
@@ -19,6 +21,16 @@ class ResearchSession(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
     error_message = models.TextField(blank=True, null=True)
+    last_accessed_at = models.DateTimeField(blank=True, null=True) # Last report download, for LRU retention
+    profile_requested = models.BooleanField(default=False) # Run processing under the profiler, see profiling.py
+    profile_filename = models.CharField(max_length=255, blank=True, null=True) # In MEDIA_ROOT/profiles
+    partial_summary = models.TextField(blank=True, null=True) # Summary text so far while it streams, see streaming.py
+    analyze_all = models.BooleanField(default=False) # Send every document to the LLM, skipping the relevance pre-screen
+    deadline_at = models.DateTimeField(blank=True, null=True) # End of the session's time budget, see deadlines.py
+    in_process = models.BooleanField(default=False) # Processed on a web process's thread pool; workers leave it alone
+    # Lease held by the worker that finalizes (summarizes) the session, see workers.py
+    lease_owner = models.CharField(max_length=100, blank=True, null=True)
+    lease_expires_at = models.DateTimeField(blank=True, null=True)
 
     def __str__(self):
         return f"Session {self.session_id} - {self.status}"
@@ -29,9 +41,27 @@ class ResearchSession(models.Model):
         return None
 
 def get_upload_path(instance, filename):
-    # Files will be uploaded to MEDIA_ROOT/uploads/<session_id>/<filename>
+    # Legacy layout: MEDIA_ROOT/uploads/<session_id>/<filename>. New uploads go to blobs, see storage.py
     return f'uploads/{instance.session.session_id}/{filename}'
 
+class StoredBlob(models.Model):
+    """One stored copy of an uploaded file's content, shared by every document with that content."""
+    sha256 = models.CharField(max_length=64)
+    extension = models.CharField(max_length=16, blank=True) # Extraction dispatches on it
+    file = models.FileField(max_length=255) # MEDIA_ROOT/blobs/<sha[:2]>/<sha>-<suffix><ext>
+    size = models.PositiveBigIntegerField(default=0)
+    ref_count = models.PositiveIntegerField(default=0) # Documents pointing here
+    created_at = models.DateTimeField(auto_now_add=True)
+    last_used_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['sha256', 'extension'], name='unique_blob_content'),
+        ]
+
+    def __str__(self):
+        return f"{self.sha256[:12]}{self.extension} ({self.ref_count} refs)"
+
 class UploadedDocument(models.Model):
     STATUS_CHOICES = [
         ('uploaded', 'Uploaded'),
@@ -39,18 +69,63 @@ class UploadedDocument(models.Model):
         ('converted', 'Converted'),
         ('processing', 'Querying LLM'),
         ('processed', 'Processed'),
+        ('skipped', 'Skipped (not relevant)'),
+        ('timed_out', 'Timed out'),
         ('error', 'Error'),
     ]
+    # Statuses a document never leaves; everything else is still work in flight
+    FINISHED_STATUSES = ('processed', 'skipped', 'timed_out', 'error')
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
     session = models.ForeignKey(ResearchSession, related_name='documents', on_delete=models.CASCADE)
-    file = models.FileField(upload_to=get_upload_path)
+    file = models.FileField(upload_to=get_upload_path, max_length=255)
+    blob = models.ForeignKey(StoredBlob, related_name='documents', on_delete=models.PROTECT, blank=True, null=True)
     original_filename = models.CharField(max_length=255)
     status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='uploaded')
     extracted_text = models.TextField(blank=True, null=True) # Store extracted text if needed, or extract on the fly
+    text_offsets = models.BinaryField(blank=True, null=True) # Page/section/slide ranges in extracted_text, see offsets.py
     processing_log = models.TextField(blank=True, null=True) # Store errors or info
+    file_size = models.PositiveBigIntegerField(default=0) # Bytes, for admission control
+    estimated_tokens = models.PositiveBigIntegerField(default=0) # Rough LLM input size estimate
+    answer = models.TextField(blank=True, null=True) # LLM answer for this document
+    partial_answer = models.TextField(blank=True, null=True) # Answer text so far while it streams
+    quote_check = models.JSONField(blank=True, null=True) # verify_quotes() results for the answer
+    relevance_score = models.FloatField(blank=True, null=True) # Pre-screen score against the query, see relevance.py
+    stage_started_at = models.DateTimeField(blank=True, null=True) # When converting/processing began, for ETAs
+    # Lease held by the worker processing this document, see workers.py
+    lease_owner = models.CharField(max_length=100, blank=True, null=True)
+    lease_expires_at = models.DateTimeField(blank=True, null=True, db_index=True)
 
     def __str__(self):
         return f"{self.original_filename} ({self.session.session_id})"
 
     def get_simple_filename(self):
         return os.path.basename(self.original_filename)
+
+class ThroughputStat(models.Model):
+    """Rolling average of one throughput measure, see progress.py."""
+    STAGE_CHOICES = [
+        ('extract', 'Extraction (bytes/s by file type)'),
+        ('llm', 'LLM call (seconds by prompt size)'),
+        ('model', 'LLM call (seconds by model and prompt size)'),
+        ('model_errors', 'LLM call failure rate by model'),
+    ]
+    stage = models.CharField(max_length=20, choices=STAGE_CHOICES)
+    bucket = models.CharField(max_length=100) # File extension, prompt size bucket in characters, or model (and size)
+    value = models.FloatField() # Exponentially weighted average
+    samples = models.PositiveBigIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['stage', 'bucket'], name='unique_throughput_bucket'),
+        ]
+
+    def __str__(self):
+        return f"{self.stage} {self.bucket}: {self.value:.2f} ({self.samples} samples)"
+
+class AdmissionLock(models.Model):
+    """A single row that admission decisions write first, so concurrent submissions are counted in turn (see admission.py)."""
+    locked_at = models.DateTimeField(null=True, blank=True) # Last admission decision
+
+    def __str__(self):
+        return f"Admission lock (last taken {self.locked_at})"
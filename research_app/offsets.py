@@ -0,0 +1,125 @@
+"""
+Offsets index of an extracted text: where each page, section and slide starts.
+
+The extractors mark units with lines such as "--- Page 3 ---", "--- Section: Intro ---",
+"--- Slide 2: Agenda ---" or "--- Notes for Slide 2 ---". Instead of every
+consumer scanning the text for them again, extract_text() finds them once (one
+regex pass) and stores a TextOffsets next to the text (UploadedDocument.text_offsets).
+It holds the character offset of each marker line as a packed uint32 array, the
+labels, and the text length, in a few bytes per unit.
+
+From there, finding the unit a character belongs to (where a quote or passage
+is) is a binary search over the starts. Jumping to a page, slide or section is a
+dict lookup that gives the (start, end) range, and the API reads just that
+substring from the database. Passage chunking (passages.py) cuts at unit starts
+and labels each passage with its unit.
+"""
+import bisect
+import re
+import struct
+import sys
+from array import array
+
+# A marker line; the group is the label, as in quote locations (quotes.py)
+MARKER_RE = re.compile(r'^--- (.+) ---$', re.MULTILINE)
+# Page, slide, notes or section, and its number or title
+LABEL_RE = re.compile(r'^(?:(Page|Slide) (\d+)(?::.*)?|Section: (.*)|Notes for Slide (\d+)(?::.*)?)$')
+
+PAGE = 'page'
+SLIDE = 'slide'
+NOTES = 'notes'
+SECTION = 'section'
+
+FORMAT_MAGIC = b'TOF1'
+HEADER = struct.Struct('<4sII') # magic, unit count, text length
+
+
+def label_key(label):
+    """(kind, number or title) of a marker label, or None for other markers."""
+    match = LABEL_RE.match(label)
+    if not match:
+        return None
+    kind, number, title, notes = match.groups()
+    if kind:
+        return kind.lower(), number
+    if notes:
+        return NOTES, notes
+    return SECTION, title
+
+
+class TextOffsets:
+    """Character ranges of the pages, sections and slides of one text."""
+
+    def __init__(self, starts, labels, length):
+        self.starts = starts # array('I'), ascending
+        self.labels = labels
+        self.length = length
+        self._by_key = None
+
+    def __len__(self):
+        return len(self.starts)
+
+    # --- Storage ---
+
+    def to_bytes(self):
+        starts = array('I', self.starts)
+        if sys.byteorder == 'big':
+            starts.byteswap()
+        return HEADER.pack(FORMAT_MAGIC, len(starts), self.length) + starts.tobytes() + '\n'.join(self.labels).encode('utf-8')
+
+    @classmethod
+    def from_bytes(cls, data):
+        """The index stored by to_bytes(), or None for documents extracted before it existed."""
+        if not data:
+            return None
+        data = bytes(data) # The database may hand back a memoryview
+        magic, count, length = HEADER.unpack_from(data)
+        if magic != FORMAT_MAGIC:
+            return None
+        starts = array('I')
+        starts.frombytes(data[HEADER.size:HEADER.size + 4 * count])
+        if sys.byteorder == 'big':
+            starts.byteswap()
+        labels = data[HEADER.size + 4 * count:].decode('utf-8').split('\n') if count else []
+        return cls(starts, labels, length)
+
+    # --- Lookups ---
+
+    def unit_at(self, offset):
+        """Index of the unit that character offset falls in, or -1 before the first marker."""
+        return bisect.bisect_right(self.starts, offset) - 1
+
+    def label_at(self, offset):
+        index = self.unit_at(offset)
+        return self.labels[index] if index >= 0 else None
+
+    def span(self, index):
+        """(start, end) character range of unit index, its marker line included."""
+        end = self.starts[index + 1] if index + 1 < len(self.starts) else self.length
+        return self.starts[index], end
+
+    def find(self, kind, name):
+        """Index of the first unit of a kind ('page', 'slide', 'notes', 'section') with that number or title, or None."""
+        if self._by_key is None:
+            self._by_key = {}
+            for index, label in enumerate(self.labels):
+                key = label_key(label)
+                if key is not None:
+                    self._by_key.setdefault(key, index)
+        return self._by_key.get((kind, str(name)))
+
+    def boundary_before(self, offset, lowest):
+        """The last unit start in (lowest, offset], or None; for cutting chunks where a unit begins."""
+        index = bisect.bisect_right(self.starts, offset) - 1
+        if index >= 0 and self.starts[index] > lowest:
+            return self.starts[index]
+        return None
+
+
+def build_offsets(text):
+    """The offsets index of an extracted text."""
+    starts, labels = array('I'), []
+    for match in MARKER_RE.finditer(text):
+        starts.append(match.start())
+        labels.append(match.group(1).strip())
+    return TextOffsets(starts, labels, len(text))
@@ -0,0 +1,217 @@
+"""
+Passage selection for long documents from a memory-mapped index of chunk vectors.
+
+Documents longer than PASSAGE_SELECTION_CHARS don't go into the prompt from the
+start up to a cut-off. Instead the passages most similar to the query are picked
+and joined in document order. Sandboxed workers can't call an embedding service,
+so vectors are made locally with the hashing trick. Each chunk's words are
+normalized as for the relevance pre-screen (relevance.py), so Polish inflections
+fall together. Every stem is hashed to one of EMBEDDING_DIM signed dimensions,
+weighted 1 + log(tf), and the vector is L2-normalized. This is no language model,
+but unlike plain term overlap it ranks every chunk of a long document by how much
+of the query's vocabulary it uses.
+
+Each document's index lives in MEDIA_ROOT/vectors, named by the hash of its text
+and the index parameters: a float32 (chunks x EMBEDDING_DIM) .npy file plus the
+chunks' character spans. A document uploaded again (in any session) reuses its
+index. New documents only add files; nothing that exists is rewritten or loaded
+whole. The vectors are written to the memory-mapped file PASSAGE_EMBED_BATCH chunks
+at a time, and read through a read-only memory map. Cosine scores (a dot product,
+since rows are normalized) are computed PASSAGE_SEARCH_BATCH_ROWS rows at a time,
+so memory stays flat however long the document is. Retention expires index files
+that haven't been used for RETENTION_MAX_AGE_DAYS (see retention.py).
+
+Chunks end where a page, section or slide begins when one falls in their second
+half (found in the document's offsets index, see offsets.py). A passage that starts
+inside a unit gets that unit's marker line, so the LLM and the quote check
+(quotes.py) still know which page it comes from.
+"""
+import hashlib
+import logging
+import math
+import os
+import uuid
+import zlib
+from collections import Counter
+from functools import lru_cache
+
+from django.conf import settings
+
+from .offsets import build_offsets
+from .relevance import WORD_RE, normalize_word
+from .utils import PROMPT_TEXT_CHARS, text_head
+
+logger = logging.getLogger(__name__)
+
+INDEX_VERSION = 2 # Part of every index name; bump it when chunking or embedding changes
+EMBEDDING_DIM = 1024
+PASSAGE_GAP = "\n[...]\n" # Between passages that aren't adjacent in the document
+
+
+def vectors_root():
+    return os.path.join(settings.MEDIA_ROOT, 'vectors')
+
+
+# --- Embedding ---
+
+@lru_cache(maxsize=65536)
+def _feature(stem):
+    """(dimension, sign) of a stem; crc32 rather than hash() so every process agrees."""
+    h = zlib.crc32(stem.encode('utf-8'))
+    return h % EMBEDDING_DIM, 1.0 if h & 0x80000000 else -1.0
+
+
+def embed(texts):
+    """L2-normalized hashing-trick vectors of texts, as a float32 (len(texts) x EMBEDDING_DIM) array."""
+    import numpy as np
+
+    matrix = np.zeros((len(texts), EMBEDDING_DIM), dtype=np.float32)
+    for row, text in enumerate(texts):
+        tf = Counter()
+        for word, count in Counter(WORD_RE.findall(text.lower())).items():
+            stem = normalize_word(word)
+            if stem:
+                tf[stem] += count
+        features = [(*_feature(stem), 1 + math.log(n)) for stem, n in tf.items()]
+        # Colliding stems add up
+        np.add.at(matrix[row], [col for col, _, _ in features], [sign * weight for _, sign, weight in features])
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    np.divide(matrix, norms, out=matrix, where=norms > 0)
+    return matrix
+
+
+def chunk_spans(text, chunk_chars, offsets=None):
+    """(start, end) spans of about chunk_chars each, cut where a unit begins, else at a line break or space."""
+    spans = []
+    start = 0
+    while start < len(text):
+        end = min(start + chunk_chars, len(text))
+        if end < len(text):
+            cut = offsets.boundary_before(end, start + chunk_chars // 2) if offsets is not None else None
+            if cut is not None:
+                spans.append((start, cut))
+                start = cut
+                continue
+            cut = text.rfind('\n', start + chunk_chars // 2, end)
+            if cut == -1:
+                cut = text.rfind(' ', start + chunk_chars // 2, end)
+            if cut != -1:
+                end = cut + 1
+        spans.append((start, end))
+        start = end
+    return spans
+
+
+# --- Index files ---
+
+def index_key(text, chunk_chars):
+    digest = hashlib.sha256(f"v{INDEX_VERSION}:{EMBEDDING_DIM}:{chunk_chars}:".encode())
+    digest.update(text.encode('utf-8', 'surrogatepass'))
+    return digest.hexdigest()
+
+
+def index_paths(key):
+    """(vectors, spans) .npy paths of an index."""
+    base = os.path.join(vectors_root(), key[:2], key)
+    return f"{base}.vectors.npy", f"{base}.spans.npy"
+
+
+def build_index(text, key, chunk_chars, offsets):
+    """Writes the chunk vectors of text, a batch of chunks at a time, then moves the files into place."""
+    import numpy as np
+
+    vectors_path, spans_path = index_paths(key)
+    os.makedirs(os.path.dirname(vectors_path), exist_ok=True)
+    spans = chunk_spans(text, chunk_chars, offsets)
+    suffix = f".{uuid.uuid4().hex}.tmp" # Two processes may index the same text at once
+    with open(spans_path + suffix, 'wb') as f:
+        np.save(f, np.array(spans, dtype=np.int64).reshape(-1, 2))
+    vectors = np.lib.format.open_memmap(
+        vectors_path + suffix, mode='w+', dtype=np.float32, shape=(len(spans), EMBEDDING_DIM),
+    )
+    batch = settings.PASSAGE_EMBED_BATCH
+    for start in range(0, len(spans), batch):
+        vectors[start:start + batch] = embed([text[s:e] for s, e in spans[start:start + batch]])
+    vectors.flush()
+    del vectors
+    os.replace(spans_path + suffix, spans_path)
+    os.replace(vectors_path + suffix, vectors_path) # The vectors file appearing marks the index complete
+
+
+def open_index(text, chunk_chars, offsets):
+    """(vectors as a read-only memory map, spans) of text's index, built first if it doesn't exist yet."""
+    import numpy as np
+
+    key = index_key(text, chunk_chars)
+    vectors_path, spans_path = index_paths(key)
+    if os.path.exists(vectors_path):
+        os.utime(vectors_path) # Last use, for retention
+    else:
+        build_index(text, key, chunk_chars, offsets)
+    return np.load(vectors_path, mmap_mode='r'), np.load(spans_path)
+
+
+# --- Search ---
+
+def rank_chunks(vectors, query_vector, limit):
+    """Indexes of the `limit` rows most similar to query_vector, best first."""
+    import numpy as np
+
+    scores = np.empty(len(vectors), dtype=np.float32)
+    batch = settings.PASSAGE_SEARCH_BATCH_ROWS
+    for start in range(0, len(vectors), batch):
+        scores[start:start + batch] = vectors[start:start + batch] @ query_vector
+    limit = min(limit, len(scores))
+    if not limit:
+        return []
+    top = np.argpartition(-scores, limit - 1)[:limit]
+    return top[np.argsort(-scores[top], kind='stable')].tolist()
+
+
+def _unit_header(offsets, start):
+    """The marker line of the unit a passage starts inside, or '' if it starts at one (or before any)."""
+    index = offsets.unit_at(start)
+    if index < 0 or offsets.starts[index] == start:
+        return ''
+    return f"--- {offsets.labels[index]} ---\n"
+
+
+def select_passages(text, query, max_chars, chunk_chars=None, offsets=None):
+    """The chunks of text most similar to query, up to max_chars, joined in document order."""
+    chunk_chars = chunk_chars or settings.PASSAGE_CHUNK_CHARS
+    query_vector = embed([query])[0]
+    if not query_vector.any():
+        return text_head(text, max_chars) # Nothing in the query to rank by
+    if offsets is None:
+        offsets = build_offsets(text)
+    vectors, spans = open_index(text, chunk_chars, offsets)
+    # Chunks are at least half of chunk_chars (except the last), so this many always fill max_chars
+    candidates = rank_chunks(vectors, query_vector, max_chars // max(1, chunk_chars // 2) + 1)
+    chosen, used = [], 0
+    for row in candidates:
+        start, end = (int(x) for x in spans[row])
+        size = end - start + len(PASSAGE_GAP) + len(_unit_header(offsets, start))
+        if used + size <= max_chars:
+            chosen.append((start, end))
+            used += size
+    parts = []
+    previous_end = 0
+    for start, end in sorted(chosen):
+        if start != previous_end:
+            parts.append(PASSAGE_GAP)
+            parts.append(_unit_header(offsets, start))
+        parts.append(text[start:end])
+        previous_end = end
+    logger.info(f"Selected {len(chosen)} of {len(spans)} passages ({used} characters) for the prompt")
+    return ''.join(parts)
+
+
+def prompt_text(text, query, offsets=None):
+    """
+    The part of a document's text that goes into its prompt: all of it if short
+    enough, else the best passages. offsets is the text's stored TextOffsets, if any.
+    """
+    limit = settings.PASSAGE_SELECTION_CHARS
+    if not limit or len(text) <= limit:
+        return text_head(text, PROMPT_TEXT_CHARS)
+    return select_passages(text, query, min(limit, PROMPT_TEXT_CHARS), offsets=offsets)
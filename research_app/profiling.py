@@ -0,0 +1,164 @@
+"""
+Opt-in profiling of session processing.
+
+A session runs under the profiler when PROFILE_SESSIONS is on, or when it was
+created with the per-request 'profile' flag (open the upload page with
+?profile=1, or set "profile": true in an API manifest entry). SESSION_PROFILER
+picks the profiler:
+
+- 'sampling' (default): a background thread records the processing thread's
+  stack every PROFILE_SAMPLE_INTERVAL seconds. The counts are stored as collapsed
+  stacks ("outer;inner;leaf count" lines, readable by flamegraph.pl and
+  speedscope). The overhead doesn't grow with the number of calls, so it is safe
+  on production data.
+- 'cprofile': deterministic cProfile, stored as a pstats file. Exact call counts,
+  but every call is slower.
+
+Only the processing thread is profiled. LLM calls run on the shared event loop
+thread and show up as time waiting in run_llm_coroutine. In workers mode the
+documents of a session are spread over several processes, so only the final
+stage (summary and DOCX report) is profiled. Profiles are written to
+MEDIA_ROOT/profiles and are shown and downloadable on the session's admin page.
+"""
+import cProfile
+import io
+import logging
+import os
+import pstats
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+SAMPLING = 'sampling'
+CPROFILE = 'cprofile'
+PROFILE_EXTENSIONS = {SAMPLING: '.collapsed', CPROFILE: '.prof'}
+SUMMARY_LINES = 40 # Functions listed on the admin page
+
+
+def profile_path(filename):
+    return os.path.join(settings.MEDIA_ROOT, 'profiles', filename)
+
+
+def _frame_label(code):
+    return f"{code.co_qualname} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+class StackSampler:
+    """Samples one thread's Python stack at a fixed interval into collapsed-stack counts."""
+
+    def __init__(self, thread_id, interval):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.counts = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='profile-sampler', daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                stack.append(_frame_label(frame.f_code))
+                frame = frame.f_back
+            if stack:
+                self.counts[';'.join(reversed(stack))] += 1
+
+    def write(self, path):
+        with open(path, 'w', encoding='utf-8') as f:
+            for stack, count in self.counts.most_common():
+                f.write(f"{stack} {count}\n")
+
+
+def _profile_requested(session_id):
+    from .models import ResearchSession
+
+    if settings.PROFILE_SESSIONS:
+        return True
+    return bool(ResearchSession.objects.filter(pk=session_id).values_list('profile_requested', flat=True).first())
+
+
+@contextmanager
+def profile_session(session_id):
+    """Runs the block under the configured profiler if the session asked for it, and stores the profile."""
+    if not _profile_requested(session_id):
+        yield
+        return
+
+    kind = CPROFILE if settings.SESSION_PROFILER == CPROFILE else SAMPLING
+    filename = f"profile_{session_id}{PROFILE_EXTENSIONS[kind]}"
+    started = time.perf_counter()
+    if kind == CPROFILE:
+        profiler = cProfile.Profile()
+        profiler.enable()
+    else:
+        profiler = StackSampler(threading.get_ident(), settings.PROFILE_SAMPLE_INTERVAL)
+        profiler.start()
+    try:
+        yield
+    finally:
+        if kind == CPROFILE:
+            profiler.disable()
+        else:
+            profiler.stop()
+        # A profile that can't be stored must never fail the session itself
+        try:
+            _store_profile(session_id, profiler, filename)
+            logger.info(f"Profiled session {session_id} ({time.perf_counter() - started:.1f}s): {filename}")
+        except Exception as e:
+            logger.error(f"Could not store the profile of session {session_id}: {e}")
+
+
+def _store_profile(session_id, profiler, filename):
+    from .models import ResearchSession
+
+    os.makedirs(profile_path(''), exist_ok=True)
+    if isinstance(profiler, cProfile.Profile):
+        profiler.dump_stats(profile_path(filename))
+    else:
+        profiler.write(profile_path(filename))
+    ResearchSession.objects.filter(pk=session_id).update(profile_filename=filename)
+
+
+def _summarize_collapsed(path, limit):
+    inclusive, own = Counter(), Counter()
+    total = 0
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            stack, _, count = line.rstrip('\n').rpartition(' ')
+            count = int(count)
+            frames = stack.split(';')
+            total += count
+            own[frames[-1]] += count
+            for frame in set(frames): # Recursion counts once per sample
+                inclusive[frame] += count
+    if not total:
+        return "No samples (the session finished within one sampling interval)."
+    lines = [f"{total} samples, {settings.PROFILE_SAMPLE_INTERVAL * 1000:g} ms apart", "", "   total%    self%  function"]
+    for frame, count in inclusive.most_common(limit):
+        lines.append(f"{100 * count / total:8.1f} {100 * own[frame] / total:8.1f}  {frame}")
+    return "\n".join(lines)
+
+
+def summarize_profile(filename, limit=SUMMARY_LINES):
+    """Text table of the hottest functions of a stored profile, by cumulative time."""
+    path = profile_path(filename)
+    if not os.path.exists(path):
+        return "Profile file is missing."
+    if filename.endswith(PROFILE_EXTENSIONS[CPROFILE]):
+        stream = io.StringIO()
+        pstats.Stats(path, stream=stream).strip_dirs().sort_stats('cumulative').print_stats(limit)
+        return stream.getvalue().strip()
+    return _summarize_collapsed(path, limit)
@@ -0,0 +1,218 @@
+"""
+Progress fractions and ETAs from rolling throughput statistics.
+
+Processing notes how long each extraction (bytes/s, per file type) and each
+document LLM call (seconds, per prompt-size bucket) took, and how each model did
+(see routing.py). The samples are buffered in memory - LLM calls finish on the
+event loop, where the ORM can't be used - and flush_throughput_samples() folds
+them into exponentially weighted averages in the ThroughputStat table, shared by
+every web and worker process.
+
+estimate_progress() turns those averages, each document's size, status and
+stage start time into per-document and per-session fractions and ETAs. The same
+table doubles as a capacity-planning signal (see the admin).
+"""
+import logging
+import math
+import os
+import threading
+from collections import defaultdict
+
+from django.conf import settings
+from django.db import DatabaseError, IntegrityError, transaction
+from django.db.models import F
+from django.utils import timezone
+
+logger = logging.getLogger(__name__)
+
+EXTRACT = 'extract'
+LLM = 'llm'
+MODEL = 'model' # Seconds per call by model and prompt size, for tuning the routing (see routing.py)
+MODEL_ERRORS = 'model_errors' # Share of failed calls by model
+EWMA_ALPHA = 0.2 # Weight of the newest sample
+
+# Used until the first samples of a kind arrive
+DEFAULT_EXTRACT_BYTES_PER_SECOND = 1024 * 1024
+DEFAULT_LLM_SECONDS = 10.0
+CHARS_PER_TOKEN = 4 # estimated_tokens -> prompt characters
+SUMMARY_PROMPT_CHARS_PER_DOCUMENT = 2000 # Rough size of one answer in the summary prompt
+MAX_STAGE_FRACTION = 0.95 # A stage running over its estimate never shows as done
+
+_samples = [] # (stage, bucket, value)
+_samples_lock = threading.Lock()
+
+
+def llm_size_bucket(chars):
+    """Prompt sizes grouped in powers of four: '4096' holds prompts of 1025-4096 chars."""
+    return str(4 ** max(1, math.ceil(math.log(max(chars, 1), 4))))
+
+
+def note_extraction(extension, size, seconds):
+    """Buffers one extraction timing (bytes/s for its file type)."""
+    if size > 0 and seconds > 0:
+        with _samples_lock:
+            _samples.append((EXTRACT, extension, size / seconds))
+
+
+def note_llm_call(prompt_chars, seconds):
+    """Buffers one LLM call latency. Safe to call from the event loop."""
+    with _samples_lock:
+        _samples.append((LLM, llm_size_bucket(prompt_chars), seconds))
+
+
+def note_model_call(model, prompt_chars, seconds, failed=False):
+    """Buffers one call attempt of a model: its latency if it succeeded, and the outcome."""
+    with _samples_lock:
+        if not failed:
+            _samples.append((MODEL, f"{model} {llm_size_bucket(prompt_chars)}", seconds))
+        _samples.append((MODEL_ERRORS, model, 1.0 if failed else 0.0))
+
+
+def flush_throughput_samples():
+    """Folds the buffered samples into the shared averages. Best effort: never raises."""
+    global _samples
+    with _samples_lock:
+        samples, _samples = _samples, []
+    grouped = defaultdict(list)
+    for stage, bucket, value in samples:
+        grouped[stage, bucket].append(value)
+
+    for (stage, bucket), values in grouped.items():
+        try:
+            _fold_samples(stage, bucket, values)
+        except DatabaseError as e: # e.g. a busy SQLite database; the estimates can wait
+            logger.warning(f"Could not record {len(values)} {stage}/{bucket} throughput sample(s): {e}")
+
+
+def _fold_samples(stage, bucket, values):
+    from .models import ThroughputStat
+
+    # n EWMA steps at once: value * (1 - a)^n + the decayed sum of the new samples,
+    # as one UPDATE so concurrent processes never read-modify-write
+    decay = (1 - EWMA_ALPHA) ** len(values)
+    added = sum(EWMA_ALPHA * (1 - EWMA_ALPHA) ** (len(values) - 1 - i) * v for i, v in enumerate(values))
+    stats = ThroughputStat.objects.filter(stage=stage, bucket=bucket)
+    if stats.update(value=F('value') * decay + added, samples=F('samples') + len(values)):
+        return
+    try:
+        with transaction.atomic():
+            ThroughputStat.objects.create(stage=stage, bucket=bucket, value=sum(values) / len(values), samples=len(values))
+    except IntegrityError: # Created by another process in the meantime
+        stats.update(value=F('value') * decay + added, samples=F('samples') + len(values))
+
+
+def load_throughput_stats():
+    from .models import ThroughputStat
+
+    return {(s.stage, s.bucket): s.value for s in ThroughputStat.objects.all()}
+
+
+async def aload_throughput_stats():
+    from .models import ThroughputStat
+
+    return {(s.stage, s.bucket): s.value async for s in ThroughputStat.objects.all()}
+
+
+def _llm_seconds(stats, chars):
+    bucket = int(llm_size_bucket(chars))
+    known = sorted((int(b), value) for (stage, b), value in stats.items() if stage == LLM)
+    if not known:
+        return DEFAULT_LLM_SECONDS
+    # The bucket itself, else the nearest one measured
+    return min(known, key=lambda item: abs(math.log(item[0]) - math.log(bucket)))[1]
+
+
+def _extract_seconds(stats, filename, size):
+    extension = os.path.splitext(filename)[1].lower()
+    rate = stats.get((EXTRACT, extension))
+    if rate is None:
+        rates = [value for (stage, _), value in stats.items() if stage == EXTRACT]
+        rate = sum(rates) / len(rates) if rates else DEFAULT_EXTRACT_BYTES_PER_SECOND
+    return size / rate if rate > 0 else 0
+
+
+def _elapsed(doc, now):
+    if doc.stage_started_at is None:
+        return 0
+    return max(0, (now - doc.stage_started_at).total_seconds())
+
+
+def estimate_document(doc, stats, now):
+    """(fraction done, extraction seconds left, LLM seconds left, total seconds) for one document."""
+    from .models import UploadedDocument
+
+    extract = _extract_seconds(stats, doc.original_filename, doc.file_size)
+    llm = _llm_seconds(stats, doc.estimated_tokens * CHARS_PER_TOKEN)
+    total = extract + llm
+
+    if doc.status in UploadedDocument.FINISHED_STATUSES:
+        return 1.0, 0, 0, total
+    if doc.status == 'converting':
+        done = min(_elapsed(doc, now), extract * MAX_STAGE_FRACTION)
+        return done / (total or 1), extract - done, llm, total
+    if doc.status in ('converted', 'processing'):
+        done = min(_elapsed(doc, now), llm * MAX_STAGE_FRACTION) if doc.status == 'processing' else 0
+        return (extract + done) / (total or 1), 0, llm - done, total
+    return 0.0, extract, llm, total
+
+
+def format_eta(seconds):
+    """Short human-readable time left, e.g. '45s', '3 min', '1 h 5 min'."""
+    if seconds is None:
+        return None
+    seconds = int(math.ceil(seconds))
+    if seconds < 60:
+        return f"{seconds}s"
+    minutes = int(math.ceil(seconds / 60))
+    if minutes < 60:
+        return f"{minutes} min"
+    return f"{minutes // 60} h {minutes % 60} min"
+
+
+def _progress_entry(fraction, eta_seconds):
+    return {
+        'fraction': fraction,
+        'percent': int(fraction * 100),
+        'eta_seconds': eta_seconds,
+        'eta_display': format_eta(eta_seconds),
+    }
+
+
+def estimate_progress(session, documents, stats, now=None):
+    """
+    Session and per-document progress: {'fraction', 'percent', 'eta_seconds',
+    'eta_display', 'documents': {doc.id: {same keys}}}; eta_seconds is None when
+    there is nothing to estimate (finished or still queued).
+    """
+    now = now or timezone.now()
+    concurrency = max(1, settings.LLM_MAX_CONCURRENCY)
+    per_document = {}
+    extract_left = llm_left = weighted_done = weight = 0
+    llm_waiting = 0
+    for doc in documents:
+        fraction, doc_extract, doc_llm, doc_weight = estimate_document(doc, stats, now)
+        per_document[doc.id] = _progress_entry(fraction, None if fraction >= 1 else doc_extract + doc_llm)
+        weighted_done += fraction * doc_weight
+        weight += doc_weight
+        extract_left += doc_extract # Documents are extracted one after another
+        llm_left += doc_llm
+        llm_waiting += doc_llm > 0
+
+    summary = _llm_seconds(stats, SUMMARY_PROMPT_CHARS_PER_DOCUMENT * max(1, len(documents)))
+    if session.status == 'summarizing':
+        summary_left = summary - min(
+            max(0, (now - session.updated_at).total_seconds()), summary * MAX_STAGE_FRACTION,
+        )
+    else:
+        summary_left = summary
+    weight += summary
+    weighted_done += summary - summary_left
+
+    if session.status in ('completed', 'failed'):
+        return {**_progress_entry(1.0, None), 'documents': per_document}
+    # LLM calls run concurrently, up to the global cap
+    eta = extract_left + llm_left / max(1, min(concurrency, llm_waiting)) + summary_left
+    return {
+        **_progress_entry(weighted_done / weight if weight else 0.0, None if session.status == 'queued' else eta),
+        'documents': per_document,
+    }
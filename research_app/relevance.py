@@ -0,0 +1,137 @@
+"""
+Local relevance pre-screen: documents that share no vocabulary with the query skip the LLM.
+
+Every converted document normally gets a full LLM call, even when the answer is
+bound to be "Ten dokument nie zawiera informacji...". Before querying, each
+document's text is scored against the query. The words of both are
+normalized for Polish: lowercased, diacritics folded (ł -> l), a common
+inflectional ending stripped and the result cut to a short prefix. Cutting to a
+prefix is crude, but for a screen that must not drop relevant documents, matching
+too much is the safe error. Stopwords don't count.
+
+The score is the mean over the query's terms of BM25's saturated term frequency,
+tf / (tf + k1). It is 0 when no query term occurs, and an occurrence or two of
+most terms scores well above any sensible cutoff. There is no IDF: a session's
+documents are usually about one topic, so corpus IDF would discount exactly the
+query terms they all share. The score also depends only on the document and the
+query, not on which other documents were screened with it (worker batches differ).
+
+Documents are screened right after extraction, on their whole text (one pass over
+its words), before passage selection (passages.py) builds an index for long ones.
+By default only documents in which no query term occurs (score 0) are marked
+'skipped', with a "not relevant" note that goes into the report instead of an
+LLM answer. RELEVANCE_MIN_SCORE > 0 opts into also skipping documents that score
+below it; RELEVANCE_SCREEN = false turns the screen off. Sessions created with
+the 'analyze_all' flag are not screened. Each screen logs its skip count and
+scoring time, and 'manage.py relevance_report' replays stored documents at
+other cutoffs to tune the setting.
+"""
+import logging
+import re
+import time
+from collections import Counter
+from functools import lru_cache
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+WORD_RE = re.compile(r'[^\W_]+')
+FOLD = str.maketrans('ąćęłńóśźż', 'acelnoszz')
+BM25_K1 = 1.2
+MIN_WORD_CHARS = 3 # Shorter words (and all stopwords) are ignored; numbers always count
+MIN_STEM_CHARS = 4 # An ending is only stripped if this much of the word is left
+STEM_CHARS = 5 # Stems are cut to this prefix
+
+# Folded forms, longest first so 'ami' wins over 'i'
+SUFFIXES = sorted([
+    'owie', 'ami', 'ach', 'ego', 'emu', 'ymi', 'imi', 'ych', 'ich', 'iej', 'owa', 'owe', 'owy', 'ow', 'om',
+    'ie', 'ej', 'ym', 'im', 'ia', 'ii', 'ji', 'ja', 'a', 'e', 'i', 'o', 'u', 'y',
+], key=len, reverse=True)
+
+STOPWORDS = frozenset((
+    # Polish
+    'ale', 'bez', 'byc', 'byl', 'byla', 'bylo', 'byly', 'czy', 'dla', 'do', 'gdy', 'gdzie', 'ich', 'ile', 'jak',
+    'jaka', 'jaki', 'jakie', 'jakich', 'jako', 'jest', 'jego', 'jej', 'jesli', 'kiedy', 'ktora', 'ktore', 'ktorych',
+    'ktory', 'lub', 'ma', 'maja', 'miedzy', 'moze', 'nad', 'nie', 'oraz', 'pod', 'po', 'przez', 'przy', 'sa', 'sie',
+    'tak', 'takze', 'tego', 'tej', 'ten', 'to', 'tym', 'wsrod', 'za', 'zas', 'ze', 'jakim', 'czym', 'co', 'kto',
+    'tylko', 'wiec', 'rowniez', 'bardzo', 'ktorzy', 'mozna',
+    # English
+    'and', 'are', 'for', 'from', 'has', 'have', 'how', 'into', 'the', 'this', 'that', 'was', 'were', 'what',
+    'when', 'where', 'which', 'who', 'why', 'with', 'does', 'about', 'there', 'their',
+))
+
+
+@lru_cache(maxsize=65536)
+def normalize_word(word):
+    """The stem a (lowercase) word is matched by, or None for stopwords and short words."""
+    word = word.translate(FOLD)
+    if word.isdigit():
+        return word
+    if len(word) < MIN_WORD_CHARS or word in STOPWORDS:
+        return None
+    for suffix in SUFFIXES:
+        if word.endswith(suffix) and len(word) - len(suffix) >= MIN_STEM_CHARS:
+            word = word[:-len(suffix)]
+            break
+    return word[:STEM_CHARS]
+
+
+def query_terms(query):
+    """The distinct stems of the query's words."""
+    return {stem for stem in map(normalize_word, WORD_RE.findall(query.lower())) if stem}
+
+
+def relevance_score(text, terms):
+    """Mean saturated term frequency of the query terms in text, from 0 (none occur) towards 1."""
+    if not terms:
+        return None
+    tf = Counter()
+    # Counting distinct words first means each one is normalized once
+    for word, count in Counter(WORD_RE.findall(text.lower())).items():
+        stem = normalize_word(word)
+        if stem in terms:
+            tf[stem] += count
+    return sum(n / (n + BM25_K1) for n in tf.values()) / len(terms)
+
+
+class RelevanceScreen:
+    """
+    Screens the documents of one query as they come, one text at a time, and logs
+    the totals at the end. Nothing is skipped when the screen is off or the query
+    has no usable terms (scores are then None).
+    """
+
+    def __init__(self, query, threshold=None):
+        self.enabled = settings.RELEVANCE_SCREEN
+        self.threshold = settings.RELEVANCE_MIN_SCORE if threshold is None else threshold
+        self.terms = query_terms(query)
+        self.checked = 0
+        self.skipped = 0
+        self.seconds = 0.0
+
+    def check(self, text):
+        """(score, skip) for one document's text."""
+        started = time.perf_counter()
+        score = relevance_score(text, self.terms)
+        skip = self.enabled and score is not None and (score == 0 or score < self.threshold)
+        self.seconds += time.perf_counter() - started
+        self.checked += 1
+        self.skipped += skip
+        return score, skip
+
+    def log(self):
+        logger.info(
+            f"Relevance pre-screen skipped {self.skipped} of {self.checked} document(s) "
+            f"in {self.seconds * 1000:.1f} ms (threshold {self.threshold:g})"
+        )
+
+
+def skipped_answer(query, score, threshold=None):
+    """The report's note for a document that was not sent to the LLM."""
+    threshold = settings.RELEVANCE_MIN_SCORE if threshold is None else threshold
+    if score == 0:
+        reason = "w tekście nie występuje żadne słowo z pytania"
+    else:
+        reason = f"wynik wstępnej oceny trafności {score:.3f} poniżej progu {threshold:g}"
+    return f"Ten dokument nie zawiera informacji dotyczących pytania: '{query}'. (Pominięty bez analizy LLM: {reason}.)"
@@ -0,0 +1,284 @@
+"""
+Retention and garbage collection for uploads, reports and extracted text.
+
+Run through 'manage.py gc_storage'. Finished (completed or failed) sessions are
+removed once they have not been updated or downloaded for RETENTION_MAX_AGE_DAYS,
+and, while blobs, legacy uploads and reports together exceed RETENTION_MAX_BYTES,
+least recently used first. Deleting a session deletes its report and profile files, and its
+documents release their blobs (see storage.py). Extracted text of finished
+sessions is cleared after RETENTION_EXTRACTED_TEXT_DAYS, and files no row points
+to are swept up. Passage indexes (see passages.py) are named by text hash, not
+by any row, so they expire once unused for RETENTION_MAX_AGE_DAYS. Over the size
+budget they are evicted, least recently used first, before any session: they
+are only a cache and are rebuilt when needed.
+
+Every delete or update transaction covers at most RETENTION_BATCH_SIZE sessions
+or documents (plus the blobs those documents release), so each one is short and
+never holds the database lock for long. A session's documents are deleted in
+batches of their own before the session, so a session with thousands of
+documents doesn't cascade in one statement. Files are removed only once the
+transaction that dropped their rows has committed (see storage.py), so a
+rollback never leaves rows pointing at deleted files.
+"""
+import logging
+import os
+import shutil
+import time
+import uuid
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Sum
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from .models import ResearchSession, StoredBlob, UploadedDocument
+from .passages import vectors_root
+from .profiling import profile_path
+from .storage import blob_path, remove_file_on_commit
+
+logger = logging.getLogger(__name__)
+
+FINISHED_STATUSES = ('completed', 'failed')
+
+
+def _finished_sessions_by_last_use():
+    return ResearchSession.objects.filter(status__in=FINISHED_STATUSES).annotate(
+        last_used=Coalesce('last_accessed_at', 'updated_at'),
+    ).order_by('last_used')
+
+
+def _report_path(filename):
+    return os.path.join(settings.MEDIA_ROOT, 'reports', filename)
+
+
+def delete_sessions(session_ids, batch_size=None):
+    """Deletes sessions, their documents (batch_size at a time) and their report and profile files."""
+    batch_size = batch_size or settings.RETENTION_BATCH_SIZE
+    while True:
+        documents = list(
+            UploadedDocument.objects.filter(session_id__in=session_ids).values_list('pk', flat=True)[:batch_size]
+        )
+        if not documents:
+            break
+        with transaction.atomic(): # The blob releases commit (or roll back) with the deletes
+            UploadedDocument.objects.filter(pk__in=documents).delete()
+
+    with transaction.atomic():
+        for report, profile in ResearchSession.objects.filter(pk__in=session_ids).values_list('report_filename', 'profile_filename'):
+            for path in (report and _report_path(report), profile and profile_path(profile)):
+                if path:
+                    remove_file_on_commit(path)
+        deleted, _ = ResearchSession.objects.filter(pk__in=session_ids).delete()
+    return len(session_ids) if deleted else 0
+
+
+def expire_old_sessions(max_age_days, batch_size, pause=0):
+    """Deletes finished sessions unused for max_age_days. Returns the number deleted."""
+    cutoff = timezone.now() - timedelta(days=max_age_days)
+    removed = 0
+    while True:
+        batch = list(
+            _finished_sessions_by_last_use().filter(last_used__lt=cutoff).values_list('pk', flat=True)[:batch_size]
+        )
+        if not batch:
+            return removed
+        removed += delete_sessions(batch, batch_size)
+        time.sleep(pause)
+
+
+def clear_extracted_text(max_age_days, batch_size, pause=0):
+    """Drops extracted text (and its offsets index) of documents in sessions finished over max_age_days ago."""
+    cutoff = timezone.now() - timedelta(days=max_age_days)
+    cleared = 0
+    while True:
+        batch = list(
+            UploadedDocument.objects.filter(
+                session__status__in=FINISHED_STATUSES,
+                session__updated_at__lt=cutoff,
+                extracted_text__isnull=False,
+            ).values_list('pk', flat=True)[:batch_size]
+        )
+        if not batch:
+            return cleared
+        cleared += UploadedDocument.objects.filter(pk__in=batch).update(extracted_text=None, text_offsets=None)
+        time.sleep(pause)
+
+
+def _dir_size(path):
+    if not os.path.isdir(path):
+        return 0
+    with os.scandir(path) as entries:
+        return sum(entry.stat().st_size for entry in entries if entry.is_file())
+
+
+def _vector_dirs():
+    root = vectors_root()
+    return [os.path.join(root, name) for name in sorted(os.listdir(root))] if os.path.isdir(root) else []
+
+
+def storage_usage():
+    """Bytes held by blobs, legacy per-session uploads, reports, profiles and passage indexes."""
+    blobs = StoredBlob.objects.aggregate(total=Sum('size'))['total'] or 0
+    legacy = UploadedDocument.objects.filter(blob__isnull=True).aggregate(total=Sum('file_size'))['total'] or 0
+    files = _dir_size(os.path.join(settings.MEDIA_ROOT, 'reports')) + _dir_size(profile_path(''))
+    return blobs + legacy + files + sum(_dir_size(directory) for directory in _vector_dirs())
+
+
+def evict_vector_indexes(bytes_to_free):
+    """Removes least recently used passage indexes until bytes_to_free are freed (or none are left). Returns bytes freed."""
+    indexes = []
+    for directory in _vector_dirs():
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if entry.name.endswith('.vectors.npy') and entry.is_file():
+                    spans = os.path.join(directory, entry.name[:-len('.vectors.npy')] + '.spans.npy')
+                    indexes.append((entry.stat().st_mtime, entry.path, spans))
+    freed = 0
+    for _, vectors, spans in sorted(indexes):
+        if freed >= bytes_to_free:
+            break
+        for path in (vectors, spans):
+            try:
+                size = os.path.getsize(path)
+                os.remove(path)
+                freed += size
+            except FileNotFoundError:
+                pass
+    return freed
+
+
+def evict_to_budget(max_bytes, batch_size, pause=0):
+    """
+    Gets usage down to max_bytes: first by removing least recently used passage
+    indexes, which are rebuilt on demand, then by deleting least recently used
+    finished sessions. Returns the number of sessions deleted.
+    """
+    over = storage_usage() - max_bytes
+    if over > 0:
+        freed = evict_vector_indexes(over)
+        if freed:
+            logger.info(f"Evicted {freed} bytes of passage indexes to get under the {max_bytes} byte budget")
+    removed = 0
+    while storage_usage() > max_bytes:
+        batch = list(_finished_sessions_by_last_use().values_list('pk', flat=True)[:batch_size])
+        if not batch:
+            logger.warning(f"Storage is over its {max_bytes} byte budget but no finished sessions are left to evict")
+            break
+        removed += delete_sessions(batch, batch_size)
+        time.sleep(pause)
+    return removed
+
+
+def expire_vector_indexes(max_age_days):
+    """Removes passage indexes (and leftover temporary files) unused for max_age_days. Returns files removed."""
+    cutoff = time.time() - max_age_days * 86400
+    removed = 0
+    for directory in _vector_dirs():
+        for name in os.listdir(directory):
+            if not name.endswith('.vectors.npy'):
+                continue # Spans files go with their vectors file, which records the last use
+            path = os.path.join(directory, name)
+            if _older_than(path, cutoff):
+                os.remove(path)
+                removed += 1
+        for name in os.listdir(directory):
+            path = os.path.join(directory, name)
+            # Spans whose vectors expired above, and temporary files of crashed builds
+            vectors = os.path.join(directory, f"{name.split('.', 1)[0]}.vectors.npy")
+            if (name.endswith('.tmp') or not os.path.exists(vectors)) and _older_than(path, cutoff):
+                os.remove(path)
+                removed += 1
+    return removed
+
+
+def _older_than(path, cutoff):
+    try:
+        return os.path.getmtime(path) < cutoff
+    except FileNotFoundError:
+        return False
+
+
+def sweep_orphans(grace_seconds, batch_size):
+    """Removes unreferenced blobs and files older than grace_seconds. Returns files removed."""
+    cutoff = time.time() - grace_seconds
+    removed = 0
+
+    # Blob rows left at zero references (a crash between create and use)
+    stale = timezone.now() - timedelta(seconds=grace_seconds)
+    while True:
+        orphans = list(
+            StoredBlob.objects.filter(ref_count=0, created_at__lt=stale, documents__isnull=True)[:batch_size]
+        )
+        deleted = 0
+        for blob in orphans:
+            if StoredBlob.objects.filter(pk=blob.pk, ref_count=0).delete()[0]:
+                deleted += 1
+                if os.path.exists(blob_path(blob.file.name)):
+                    os.remove(blob_path(blob.file.name))
+                    removed += 1
+        if len(orphans) < batch_size or not deleted:
+            break
+
+    # Files no blob row points to, one hash-prefix directory at a time
+    blobs_root = os.path.join(settings.MEDIA_ROOT, 'blobs')
+    if os.path.isdir(blobs_root):
+        for prefix in sorted(os.listdir(blobs_root)):
+            directory = os.path.join(blobs_root, prefix)
+            known = set(StoredBlob.objects.filter(file__startswith=f'blobs/{prefix}/').values_list('file', flat=True))
+            for name in os.listdir(directory):
+                path = os.path.join(directory, name)
+                if f'blobs/{prefix}/{name}' not in known and _older_than(path, cutoff):
+                    os.remove(path)
+                    removed += 1
+
+    # Reports and profiles of sessions that no longer exist
+    for directory, field in (('reports', 'report_filename'), ('profiles', 'profile_filename')):
+        root = os.path.join(settings.MEDIA_ROOT, directory)
+        if not os.path.isdir(root):
+            continue
+        names = sorted(os.listdir(root))
+        for start in range(0, len(names), batch_size):
+            chunk = names[start:start + batch_size]
+            known = set(ResearchSession.objects.filter(**{f'{field}__in': chunk}).values_list(field, flat=True))
+            for name in chunk:
+                path = os.path.join(root, name)
+                if name not in known and _older_than(path, cutoff):
+                    os.remove(path)
+                    removed += 1
+
+    # Legacy upload directories of sessions that no longer exist
+    uploads_root = os.path.join(settings.MEDIA_ROOT, 'uploads')
+    if os.path.isdir(uploads_root):
+        names = sorted(os.listdir(uploads_root))
+        for start in range(0, len(names), batch_size):
+            chunk = names[start:start + batch_size]
+            known = {str(pk) for pk in ResearchSession.objects.filter(pk__in=_valid_uuids(chunk)).values_list('pk', flat=True)}
+            for name in chunk:
+                path = os.path.join(uploads_root, name)
+                if name not in known and os.path.isdir(path) and _older_than(path, cutoff):
+                    removed += sum(len(files) for _, _, files in os.walk(path))
+                    shutil.rmtree(path)
+    return removed
+
+
+def _valid_uuids(names):
+    valid = []
+    for name in names:
+        try:
+            valid.append(uuid.UUID(name))
+        except ValueError:
+            pass
+    return valid
+
+
+def vacuum_database():
+    """Gives the space of deleted rows back to the OS (SQLite only; locks the database while it runs)."""
+    from django.db import connection
+
+    if connection.vendor != 'sqlite':
+        return False
+    with connection.cursor() as cursor:
+        cursor.execute('VACUUM')
+    return True
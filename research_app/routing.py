@@ -0,0 +1,99 @@
+"""
+Model routing: which Gemini model answers each call.
+
+Instead of one model for everything, pick_model() chooses per call from the
+task, the prompt size and how the models have been doing lately:
+
+- Summaries and partial-summary merges (SUMMARY) go to LLM_SUMMARY_MODEL. They
+  read every answer and are what the user sees first.
+- Document prompts (DOCUMENT) up to LLM_SMALL_PROMPT_CHARS go to LLM_SMALL_MODEL.
+  A 2 KB note doesn't need the model that reads a 900 KB PDF.
+- Everything else goes to LLM_MODEL, as do the two above when left empty.
+
+A retry after a failed attempt goes to LLM_FALLBACK_MODEL, so one model's outage
+or quota doesn't fail the document twice. So does every call while the routed
+model looks unhealthy: over LLM_ROUTE_MAX_ERROR_RATE of its calls failed, or its
+mean latency for that prompt size is over LLM_ROUTE_MAX_SECONDS. Health is judged
+per process from the calls of the last LLM_ROUTE_WINDOW_SECONDS. Old calls age
+out, so a model that was avoided gets traffic again once the window has passed.
+
+Every call's latency and outcome also goes into the shared ThroughputStat table
+(stages 'model' and 'model_errors', see progress.py). There the policy can be
+tuned with real numbers from every process; the Django admin lists them.
+"""
+import logging
+import threading
+import time
+from collections import defaultdict, deque
+
+from django.conf import settings
+
+from .progress import llm_size_bucket, note_model_call
+
+logger = logging.getLogger(__name__)
+
+DOCUMENT = 'document'
+SUMMARY = 'summary'
+HEALTH_WINDOW_CALLS = 200 # Most recent calls kept per model (and per model and prompt size for latency)
+
+# Sync calls run in threads, async ones on the LLM event loop
+_lock = threading.Lock()
+_outcomes = defaultdict(lambda: deque(maxlen=HEALTH_WINDOW_CALLS)) # model -> (time, failed)
+_latencies = defaultdict(lambda: deque(maxlen=HEALTH_WINDOW_CALLS)) # (model, size bucket) -> (time, seconds)
+
+
+def routed_model(task, prompt_chars):
+    """The model for a task and prompt size, before health and retries are considered."""
+    if task == SUMMARY and settings.LLM_SUMMARY_MODEL:
+        return settings.LLM_SUMMARY_MODEL
+    if task == DOCUMENT and settings.LLM_SMALL_MODEL and prompt_chars <= settings.LLM_SMALL_PROMPT_CHARS:
+        return settings.LLM_SMALL_MODEL
+    return settings.LLM_MODEL
+
+
+def _recent(samples, now):
+    since = now - settings.LLM_ROUTE_WINDOW_SECONDS
+    return [value for at, value in samples if at >= since]
+
+
+def unhealthy_reason(model, prompt_chars, now=None):
+    """Why calls should avoid model right now, or None."""
+    now = time.monotonic() if now is None else now
+    min_samples = settings.LLM_ROUTE_MIN_SAMPLES
+    with _lock:
+        failures = _recent(_outcomes[model], now)
+        latencies = _recent(_latencies[model, llm_size_bucket(prompt_chars)], now)
+    if len(failures) >= min_samples:
+        error_rate = sum(failures) / len(failures)
+        if error_rate > settings.LLM_ROUTE_MAX_ERROR_RATE:
+            return f"{error_rate:.0%} of its recent calls failed"
+    if settings.LLM_ROUTE_MAX_SECONDS and len(latencies) >= min_samples:
+        mean = sum(latencies) / len(latencies)
+        if mean > settings.LLM_ROUTE_MAX_SECONDS:
+            return f"its recent calls of this size took {mean:.1f}s on average"
+    return None
+
+
+def pick_model(task, prompt_chars, attempt=0):
+    """The model for one call attempt (0 = first try)."""
+    model = routed_model(task, prompt_chars)
+    fallback = settings.LLM_FALLBACK_MODEL
+    if not fallback or fallback == model:
+        return model
+    if attempt > 0:
+        return fallback
+    reason = unhealthy_reason(model, prompt_chars)
+    if reason:
+        logger.info(f"Routing a {task} call to {fallback} instead of {model}: {reason}")
+        return fallback
+    return model
+
+
+def record_call(model, prompt_chars, seconds, failed=False):
+    """Notes one call attempt for the routing health checks and the shared statistics."""
+    now = time.monotonic()
+    with _lock:
+        _outcomes[model].append((now, failed))
+        if not failed:
+            _latencies[model, llm_size_bucket(prompt_chars)].append((now, seconds))
+    note_model_call(model, prompt_chars, seconds, failed)
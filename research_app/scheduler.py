@@ -0,0 +1,180 @@
+"""
+Fair-share scheduling of document-level LLM work across research sessions.
+
+Every document query from every active session goes through one scheduler on the
+shared LLM event loop (see research_app.llm). It enforces a global concurrency
+cap and picks the next item with deficit round-robin (DRR) across sessions, so a
+500-document batch session can't starve a 3-document interactive one. Items are
+costed by prompt size, so sessions with huge documents get proportionally fewer
+dispatches. Priority classes are served strictly in order (higher first); DRR
+applies within a class. A session may also cap its own in-flight items
+(max_running, e.g. 'research_batch --llm-concurrency'); it then sits out the
+rotation while at its cap.
+"""
+import asyncio
+import time
+from collections import OrderedDict, deque
+
+from django.conf import settings
+
+from .llm import get_llm_loop, run_llm_coroutine
+
+PRIORITY_BATCH = 0
+PRIORITY_INTERACTIVE = 1
+
+# How many finished sessions to keep queue statistics for
+KEEP_FINISHED_SESSIONS = 1000
+
+
+def _percentile(values, fraction):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+class _SessionQueue:
+    """Waiting work items and DRR state of one session."""
+
+    def __init__(self, key, weight, priority):
+        self.key = key
+        self.weight = weight
+        self.priority = priority
+        self.deficit = 0
+        self.items = deque() # (future, cost, enqueued_at)
+        self.running = 0
+        self.max_running = None # The session's own cap on in-flight items, if any
+        self.waits = deque(maxlen=1000) # Seconds spent queued, per dispatched item
+
+
+class FairShareScheduler:
+    """Deficit round-robin across sessions with a global concurrency cap."""
+
+    def __init__(self, max_concurrency, quantum):
+        self.max_concurrency = max_concurrency
+        self.quantum = quantum # Cost credited to a session per round (times its weight)
+        self.running = 0
+        self._sessions = OrderedDict() # key -> _SessionQueue
+        self._active = {} # priority -> OrderedDict(key -> _SessionQueue) with waiting items
+
+    async def run(self, session_key, coro_factory, cost=1, weight=1, priority=PRIORITY_BATCH, max_running=None):
+        """Waits for this session's turn and a free slot, then awaits coro_factory()."""
+        queue = self._sessions.get(session_key)
+        if queue is None:
+            queue = self._sessions[session_key] = _SessionQueue(session_key, weight, priority)
+        queue.weight, queue.priority, queue.max_running = weight, priority, max_running
+
+        future = asyncio.get_running_loop().create_future()
+        queue.items.append((future, max(1, cost), time.monotonic()))
+        self._active.setdefault(priority, OrderedDict()).setdefault(session_key, queue)
+        self._dispatch()
+
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                self._release(queue) # Slot was granted just before the cancellation
+            raise
+        try:
+            return await coro_factory()
+        finally:
+            self._release(queue)
+
+    def _release(self, queue):
+        self.running -= 1
+        queue.running -= 1
+        if queue.items: # Back in the rotation if it sat out at its own cap
+            self._active.setdefault(queue.priority, OrderedDict()).setdefault(queue.key, queue)
+        self._forget_finished()
+        self._dispatch()
+
+    def _dispatch(self):
+        while self.running < self.max_concurrency:
+            picked = self._next_item()
+            if picked is None:
+                return
+            queue, future, enqueued_at = picked
+            self.running += 1
+            queue.running += 1
+            queue.waits.append(time.monotonic() - enqueued_at)
+            future.set_result(None)
+
+    def _next_item(self):
+        for priority in sorted(self._active, reverse=True):
+            active = self._active[priority]
+            while active:
+                key, queue = next(iter(active.items()))
+                while queue.items and queue.items[0][0].cancelled():
+                    queue.items.popleft()
+                if not queue.items:
+                    del active[key]
+                    queue.deficit = 0
+                    continue
+                if queue.max_running and queue.running >= queue.max_running:
+                    del active[key] # _release() puts it back
+                    continue
+                future, cost, enqueued_at = queue.items[0]
+                if queue.deficit >= cost:
+                    queue.deficit -= cost
+                    queue.items.popleft()
+                    if not queue.items:
+                        del active[key]
+                        queue.deficit = 0
+                    return queue, future, enqueued_at
+                # Not enough credit: top up and give the next session its turn
+                queue.deficit += self.quantum * queue.weight
+                active.move_to_end(key)
+            del self._active[priority]
+        return None
+
+    def _forget_finished(self):
+        idle = [key for key, q in self._sessions.items() if not q.items and not q.running]
+        for key in idle[:max(0, len(idle) - KEEP_FINISHED_SESSIONS)]:
+            del self._sessions[key]
+
+    def stats(self, session_key):
+        """Queue statistics for one session, or None if it never queued work."""
+        queue = self._sessions.get(session_key)
+        if queue is None:
+            return None
+        waits = list(queue.waits)
+        return {
+            'queued': len(queue.items),
+            'running': queue.running,
+            'priority': queue.priority,
+            'wait_p50': _percentile(waits, 0.5),
+            'wait_p95': _percentile(waits, 0.95),
+            'wait_max': max(waits) if waits else None,
+        }
+
+
+_scheduler = None
+
+
+def get_scheduler():
+    """Returns the process-wide scheduler. Must be called on the LLM event loop."""
+    global _scheduler
+    if _scheduler is None:
+        _scheduler = FairShareScheduler(settings.LLM_MAX_CONCURRENCY, settings.SCHEDULER_QUANTUM)
+    # Pick up setting changes without losing queued work
+    _scheduler.max_concurrency = settings.LLM_MAX_CONCURRENCY
+    _scheduler.quantum = settings.SCHEDULER_QUANTUM
+    return _scheduler
+
+
+async def _stats(session_key):
+    return _scheduler.stats(session_key)
+
+
+def get_queue_stats(session_key):
+    """Returns a session's queue statistics, read on the LLM event loop."""
+    if _scheduler is None:
+        return None
+    return run_llm_coroutine(_stats(session_key))
+
+
+async def aget_queue_stats(session_key):
+    """Async version of get_queue_stats, for async views running on another loop."""
+    if _scheduler is None:
+        return None
+    return await asyncio.wrap_future(asyncio.run_coroutine_threadsafe(_stats(session_key), get_llm_loop()))
@@ -0,0 +1,145 @@
+"""
+Content-addressed storage for uploaded files.
+
+Each distinct file content (SHA-256 plus extension) is stored once under
+MEDIA_ROOT/blobs as a StoredBlob; documents point at it through their `blob`
+foreign key, and their `file` field holds the blob's path so extraction code
+keeps working unchanged. The same PDF uploaded in twenty sessions is written
+once. Every document takes a reference (an atomic ref_count increment); deleting
+a document, or its session, drops it, and the blob and its file go away only
+when the last reference does. Files are removed only after the deleting
+transaction commits, so a rollback never leaves a row without its file.
+
+Each blob row gets its own file name (a random suffix), so a blob being deleted
+never takes the file of a freshly created blob with the same content with it.
+"""
+import hashlib
+import logging
+import os
+import tempfile
+import uuid
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F, ProtectedError
+from django.db.models.signals import post_delete
+from django.dispatch import receiver
+from django.utils import timezone
+
+from .models import StoredBlob, UploadedDocument
+
+logger = logging.getLogger(__name__)
+
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+def blob_path(name):
+    return os.path.join(settings.MEDIA_ROOT, name)
+
+
+def _new_blob_name(sha256, extension):
+    return f'blobs/{sha256[:2]}/{sha256}-{uuid.uuid4().hex[:8]}{extension}'
+
+
+def hash_file(path):
+    """SHA-256 of a file on disk, read in chunks."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while chunk := f.read(HASH_CHUNK_SIZE):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _take_reference(sha256, extension):
+    blob = StoredBlob.objects.filter(sha256=sha256, extension=extension).first()
+    if blob is None:
+        return None
+    # Fails if the blob was deleted in the meantime; the caller then creates it again
+    if StoredBlob.objects.filter(pk=blob.pk).update(ref_count=F('ref_count') + 1, last_used_at=timezone.now()):
+        return blob
+    return None
+
+
+def _store_content(sha256, extension, size, place_file):
+    """Takes a reference on the blob with this content, creating it with place_file(path) if needed.
+
+    Returns (blob, reused); reused is False when this call's file became the blob.
+    """
+    while True:
+        blob = _take_reference(sha256, extension)
+        if blob is not None:
+            return blob, True
+
+        name = _new_blob_name(sha256, extension)
+        path = blob_path(name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        place_file(path)
+        blob, created = StoredBlob.objects.get_or_create(
+            sha256=sha256, extension=extension, defaults={'file': name, 'size': size},
+        )
+        if not created:
+            os.remove(path) # Another upload of the same content won the race
+        elif StoredBlob.objects.filter(pk=blob.pk).update(ref_count=F('ref_count') + 1):
+            return blob, False
+
+
+def store_upload(uploaded_file):
+    """Stores an uploaded file by content and returns its StoredBlob, with a reference taken."""
+    digest = hashlib.sha256()
+    for chunk in uploaded_file.chunks():
+        digest.update(chunk)
+    extension = os.path.splitext(uploaded_file.name)[1].lower()
+
+    def write_upload(path):
+        # Write next to the target and rename, so a blob file is never seen half-written
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.part')
+        with os.fdopen(fd, 'wb') as f:
+            for chunk in uploaded_file.chunks():
+                f.write(chunk)
+        os.replace(tmp_path, path)
+
+    blob, _ = _store_content(digest.hexdigest(), extension, uploaded_file.size, write_upload)
+    return blob
+
+
+def adopt_file(path):
+    """Moves an existing media file into blob storage. Returns (blob, reused); if reused,
+    an identical blob already existed and `path` is left for the caller to delete."""
+    extension = os.path.splitext(path)[1].lower()
+    return _store_content(hash_file(path), extension, os.path.getsize(path), lambda target: os.replace(path, target))
+
+
+def remove_file_on_commit(path):
+    """Removes a file once the current transaction commits (right away outside one), so a rollback keeps it."""
+    def remove():
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+    transaction.on_commit(remove)
+
+
+def release_blob(blob_id):
+    """Drops one reference; deletes the blob and its file when it was the last one."""
+    StoredBlob.objects.filter(pk=blob_id, ref_count__gt=0).update(ref_count=F('ref_count') - 1)
+    blob = StoredBlob.objects.filter(pk=blob_id, ref_count=0).first()
+    if blob is None:
+        return False
+    try:
+        deleted, _ = StoredBlob.objects.filter(pk=blob_id, ref_count=0).delete()
+    except ProtectedError:
+        logger.error(f"Blob {blob_id} has ref_count 0 but documents still point to it; keeping it")
+        return False
+    if deleted:
+        remove_file_on_commit(blob_path(blob.file.name))
+    return bool(deleted)
+
+
+@receiver(post_delete, sender=UploadedDocument)
+def release_document_blob(sender, instance, **kwargs):
+    """Releases the document's blob reference, also when its session is deleted."""
+    if instance.blob_id is not None:
+        release_blob(instance.blob_id)
+    elif instance.file and instance.file.name.startswith('uploads/'):
+        # Legacy per-session upload, not shared with anything
+        remove_file_on_commit(blob_path(instance.file.name))
@@ -0,0 +1,46 @@
+"""
+Partial LLM output saved while it streams, for the progress view.
+
+Chunks arrive on the LLM event loop, where the ORM can't be used, so LiveText
+only keeps the latest text of each document answer or session summary in
+memory. The thread waiting for the LLM work saves whatever changed every
+LLM_STREAM_SAVE_INTERVAL seconds (run_llm_coroutine(..., tick=live.save)), one
+UPDATE per changed row, however many chunks came in. The UPDATEs only match rows
+still in the streaming stage, so a late save can't overwrite a finished result,
+and saving the final result clears the partial text.
+"""
+import logging
+import threading
+
+from django.db import DatabaseError
+
+logger = logging.getLogger(__name__)
+
+DOCUMENT = 'document'
+SESSION = 'session'
+
+
+class LiveText:
+    """Latest streamed text per document/session, updated on the LLM loop and saved from the waiting thread."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._changed = {} # (kind, pk) -> text so far
+
+    def update(self, kind, pk, text):
+        with self._lock:
+            self._changed[kind, pk] = text
+
+    def save(self):
+        from .models import ResearchSession, UploadedDocument
+
+        with self._lock:
+            changed, self._changed = self._changed, {}
+        try:
+            for (kind, pk), text in changed.items():
+                if kind == DOCUMENT:
+                    UploadedDocument.objects.filter(pk=pk, status='processing').update(partial_answer=text)
+                else:
+                    ResearchSession.objects.filter(pk=pk, status='summarizing').update(partial_summary=text)
+        except DatabaseError as e: # Only a preview; the final answer is saved separately
+            logger.warning(f"Could not save streamed text: {e}")
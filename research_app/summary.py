@@ -0,0 +1,124 @@
+"""
+Incremental summary of a session's answers, built while documents are still querying.
+
+A summary made only after the last answer arrives adds its whole latency after
+the slowest document. IncrementalSummarizer instead folds answers in as they
+complete (through aquery_documents' on_result hook). Every
+SUMMARY_PARTIAL_DOCUMENTS answers, or SUMMARY_PARTIAL_CHARS of answer text, are
+summarized in the background into a partial synthesis. Whenever
+SUMMARY_MERGE_FANIN partials are ready they are merged into one, so only a few
+partials exist however many documents there are. finish() waits for the
+background work, then makes one last call over the remaining partials plus the
+answers that came after the last chunk. Sessions that never fill a chunk make
+the single summary call as before.
+
+Background calls go through the fair-share scheduler under the session's key,
+so they count against LLM_MAX_CONCURRENCY like document queries. A partial that
+fails falls back to the text it was given, so no answer is lost to the final
+synthesis.
+"""
+import asyncio
+import logging
+
+from django.conf import settings
+
+from .scheduler import PRIORITY_BATCH, get_scheduler
+from .utils import agenerate_summary, build_merge_prompt, build_summary_prompt
+
+logger = logging.getLogger(__name__)
+
+
+def format_answer(filename, answer):
+    """One document's answer as it appears in summary prompts."""
+    return f"--- Document: {filename} ---\n{answer}\n\n"
+
+
+class IncrementalSummarizer:
+    """Folds document answers into partial summaries as they arrive. Used on the LLM event loop."""
+
+    def __init__(self, query, session_key=None, priority=PRIORITY_BATCH):
+        self.query = query
+        self.session_key = session_key if session_key is not None else object()
+        self.priority = priority
+        self.chunk_documents = max(1, settings.SUMMARY_PARTIAL_DOCUMENTS)
+        self.chunk_chars = settings.SUMMARY_PARTIAL_CHARS
+        self.fanin = max(2, settings.SUMMARY_MERGE_FANIN)
+        self.background_calls = 0
+        self._pending = [] # Formatted answers not in any partial yet
+        self._pending_chars = 0
+        self._partials = [] # (text, documents covered, is a summary rather than fallback text)
+        self._tasks = set()
+
+    def add(self, filename, answer):
+        """Adds one finished answer; summarizes a chunk in the background once one is full."""
+        self._pending.append(format_answer(filename, answer))
+        self._pending_chars += len(self._pending[-1])
+        if len(self._pending) >= self.chunk_documents or self._pending_chars >= self.chunk_chars:
+            chunk, self._pending, self._pending_chars = self._pending, [], 0
+            self._spawn(self._summarize_chunk(chunk))
+
+    async def finish(self, on_text=None):
+        """
+        The final summary: waits for the background partials and merges what is left.
+        If it is cancelled (the session's time budget ran out), the background partials
+        and merges are cancelled with it, so no LLM calls outlive the session.
+        """
+        try:
+            while self._tasks: # Finished partials may start merges
+                await asyncio.gather(*list(self._tasks))
+            if not self._partials:
+                return await agenerate_summary(build_summary_prompt(''.join(self._pending), self.query), on_text)
+            if len(self._partials) == 1 and self._partials[0][2] and not self._pending:
+                return self._partials[0][0] # A single partial already covers every answer
+            return await agenerate_summary(
+                build_merge_prompt(self._material(self._partials, self._pending), self.query), on_text,
+            )
+        finally:
+            await self._cancel_background()
+
+    # --- Background work ---
+
+    def _spawn(self, coro):
+        task = asyncio.ensure_future(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _cancel_background(self):
+        while self._tasks:
+            tasks = list(self._tasks)
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def _call(self, prompt):
+        self.background_calls += 1
+        return await get_scheduler().run(
+            self.session_key, lambda: agenerate_summary(prompt), cost=len(prompt), priority=self.priority,
+        )
+
+    def _material(self, partials, answers):
+        parts = [
+            f"--- Partial summary of {documents} document(s) ---\n{text}\n\n" if summarized else text
+            for text, documents, summarized in partials
+        ]
+        return ''.join(parts + answers)
+
+    async def _summarize_chunk(self, chunk):
+        text = ''.join(chunk)
+        self._add_partial(await self._call(build_summary_prompt(text, self.query)), text, len(chunk))
+
+    async def _merge(self, group):
+        material = self._material(group, [])
+        self._add_partial(
+            await self._call(build_merge_prompt(material, self.query)), material, sum(p[1] for p in group),
+        )
+
+    def _add_partial(self, summary, source_text, documents):
+        if "Error:" in summary:
+            logger.warning(f"Partial summary of {documents} document(s) failed; keeping its input instead: {summary}")
+            self._partials.append((source_text, documents, False))
+        else:
+            self._partials.append((summary, documents, True))
+        if len(self._partials) >= self.fanin:
+            group, self._partials = self._partials[:self.fanin], self._partials[self.fanin:]
+            self._spawn(self._merge(group))
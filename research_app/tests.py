@@ -3,17 +3,26 @@ import uuid
 import pytest
 from django.core.files.uploadedfile import SimpleUploadedFile
 from django.urls import reverse
-from io import BytesIO
+from io import BytesIO, StringIO
 from reportlab.pdfgen import canvas
 
 
 from research_app.models import ResearchSession, UploadedDocument
+from research_app.views import process_research_sync
 from research_app.forms import ResearchForm
 from research_app.utils import (
     extract_text,
+    extract_text_from_docx_fast,
+    extract_text_from_pdf,
+    extract_text_from_pptx,
+    extract_text_from_pptx_fast,
     initialize_report,
+    normalize_extracted_text,
     add_answer_to_report,
     add_summary_to_report,
+    SessionMemoryBudget,
+    SpilledText,
+    aquery_documents,
 )
 
 # --- Mock Document ---
@@ -152,13 +161,11 @@ def test_index_view(client):
     assert isinstance(response.context["form"], ResearchForm)
 
 @pytest.mark.django_db
-def test_start_research_session_view(client, sample_file, monkeypatch):
+def test_start_research_session_view(client, sample_file, media_root_temp_dir, monkeypatch):
     """Test starting a research session."""
-    # Mock the process_research_sync function to avoid actual processing
-    monkeypatch.setattr(
-        "research_app.views.process_research_sync",
-        lambda session_id: None
-    )
+    # The view hands admitted sessions to the background pool; keep it from processing anything
+    started = []
+    monkeypatch.setattr("research_app.views.start_session_processing", started.append)
 
     url = reverse("research_app:start_research")
     data = {
@@ -172,6 +179,499 @@ def test_start_research_session_view(client, sample_file, monkeypatch):
     session = ResearchSession.objects.first()
     assert session.query == "What are the main points?"
     assert UploadedDocument.objects.filter(session=session).count() == 1
+    assert started == [session.session_id]
+
+@pytest.mark.django_db
+def test_start_research_session_queues_then_rejects_when_busy(client, settings, media_root_temp_dir, monkeypatch):
+    """Test that submissions past the in-flight limits are queued, then rejected with 429."""
+    started = []
+    monkeypatch.setattr("research_app.views.start_session_processing", started.append)
+    settings.ADMISSION_MAX_OUTSTANDING_DOCUMENTS = 1
+    settings.ADMISSION_MAX_QUEUED_SESSIONS = 1
+    url = reverse("research_app:start_research")
+
+    def submit():
+        return client.post(url, {
+            "query": "What are the main points?",
+            "documents": [SimpleUploadedFile("doc.txt", b"content")],
+        })
+
+    first, second, third = submit(), submit(), submit()
+
+    assert first.status_code == 200
+    assert len(started) == 1
+    assert second.status_code == 200
+    assert "#1</strong> in the queue" in second.content.decode()
+    assert third.status_code == 429
+    assert third["Retry-After"] == str(settings.ADMISSION_RETRY_AFTER_SECONDS)
+    assert ResearchSession.objects.filter(status="queued").count() == 1
+
+@pytest.mark.django_db
+def test_identical_uploads_share_one_blob(client, media_root_temp_dir, monkeypatch, django_capture_on_commit_callbacks):
+    """Test that the same file uploaded in two sessions is stored once and freed with its last reference."""
+    from research_app.models import StoredBlob
+
+    monkeypatch.setattr("research_app.views.start_session_processing", lambda session_id: None)
+    url = reverse("research_app:start_research")
+    for _ in range(2):
+        client.post(url, {"query": "Q?", "documents": [SimpleUploadedFile("report.txt", b"same content")]})
+
+    blob = StoredBlob.objects.get()
+    blob_file = os.path.join(media_root_temp_dir, blob.file.name)
+    assert blob.ref_count == 2
+    assert set(UploadedDocument.objects.values_list("file", flat=True)) == {blob.file.name}
+    assert open(blob_file, "rb").read() == b"same content"
+
+    first, second = ResearchSession.objects.order_by("created_at")
+    first.delete()
+    blob.refresh_from_db()
+    assert blob.ref_count == 1 and os.path.exists(blob_file)
+    with django_capture_on_commit_callbacks(execute=True): # The file goes once the delete commits
+        second.delete()
+    assert not StoredBlob.objects.exists()
+    assert not os.path.exists(blob_file)
+
+@pytest.mark.django_db
+def test_delete_sessions_batches_documents_and_keeps_files_on_rollback(
+    research_session_factory, media_root_temp_dir, django_capture_on_commit_callbacks,
+):
+    """Test that a session's documents are deleted in batches and files only go once the delete commits."""
+    from django.db import connection, transaction
+    from django.test.utils import CaptureQueriesContext
+    from research_app.retention import delete_sessions
+
+    session = research_session_factory()
+    paths = []
+    for i in range(5):
+        name = f"uploads/{session.session_id}/doc{i}.txt"
+        paths.append(os.path.join(media_root_temp_dir, name))
+        os.makedirs(os.path.dirname(paths[-1]), exist_ok=True)
+        with open(paths[-1], "w") as f:
+            f.write(f"document {i}")
+        UploadedDocument.objects.create(session=session, file=name, original_filename=f"doc{i}.txt")
+
+    with pytest.raises(RuntimeError):
+        with transaction.atomic():
+            delete_sessions([session.pk], batch_size=2)
+            raise RuntimeError("Simulated failure before commit")
+    assert ResearchSession.objects.filter(pk=session.pk).exists()
+    assert all(os.path.exists(path) for path in paths)
+
+    with django_capture_on_commit_callbacks(execute=True), CaptureQueriesContext(connection) as queries:
+        assert delete_sessions([session.pk], batch_size=2) == 1
+    document_deletes = [q for q in queries if q["sql"].startswith('DELETE FROM "research_app_uploadeddocument"')]
+    assert len(document_deletes) == 3 # 2 + 2 + 1
+    assert not ResearchSession.objects.filter(pk=session.pk).exists()
+    assert not any(os.path.exists(path) for path in paths)
+
+@pytest.mark.django_db
+def test_dedupe_uploads_moves_legacy_files_into_blobs(research_session_factory, media_root_temp_dir):
+    """Test that the dedupe command keeps one copy of identical legacy uploads."""
+    from django.core.management import call_command
+    from research_app.models import StoredBlob
+
+    docs = []
+    for content in (b"shared", b"shared", b"unique"):
+        session = research_session_factory()
+        name = f"uploads/{session.session_id}/doc.txt"
+        os.makedirs(os.path.join(media_root_temp_dir, os.path.dirname(name)))
+        with open(os.path.join(media_root_temp_dir, name), "wb") as f:
+            f.write(content)
+        docs.append(UploadedDocument.objects.create(session=session, file=name, original_filename="doc.txt"))
+
+    call_command("dedupe_uploads", batch_size=2)
+
+    assert sorted(StoredBlob.objects.values_list("ref_count", flat=True)) == [1, 2]
+    for doc in docs:
+        doc.refresh_from_db()
+        assert doc.file.name == doc.blob.file.name
+    assert docs[0].blob_id == docs[1].blob_id
+    assert extract_text(docs[0])[0] == "shared"
+    assert not os.path.exists(os.path.join(media_root_temp_dir, "uploads")) or not os.listdir(os.path.join(media_root_temp_dir, "uploads"))
+
+def _stored_session(media_root, content, status="completed", days_old=0, report=True):
+    """A session with one blob-backed document and a report file, last updated days_old ago."""
+    from datetime import timedelta
+    from django.utils import timezone
+    from research_app.storage import store_upload
+
+    session = ResearchSession.objects.create(query="Q?", status=status)
+    blob = store_upload(SimpleUploadedFile("doc.txt", content))
+    UploadedDocument.objects.create(
+        session=session, file=blob.file.name, blob=blob, original_filename="doc.txt", extracted_text="text",
+    )
+    if report:
+        os.makedirs(os.path.join(media_root, "reports"), exist_ok=True)
+        session.report_filename = f"report_{session.session_id}.docx"
+        with open(session.get_report_path(), "wb") as f:
+            f.write(b"report")
+    session.save()
+    ResearchSession.objects.filter(pk=session.pk).update(updated_at=timezone.now() - timedelta(days=days_old))
+    return session
+
+@pytest.mark.django_db
+def test_gc_storage_expires_old_sessions_and_sweeps_orphans(media_root_temp_dir, settings):
+    """Test that gc_storage removes expired finished sessions with their files, and nothing else."""
+    from django.core.management import call_command
+    import time
+    from research_app.models import StoredBlob
+
+    settings.RETENTION_ORPHAN_GRACE_SECONDS = 0
+    old = _stored_session(media_root_temp_dir, b"old", days_old=40)
+    old_report = old.get_report_path()
+    recent = _stored_session(media_root_temp_dir, b"recent", days_old=2)
+    running = _stored_session(media_root_temp_dir, b"running", status="processing", days_old=40, report=False)
+    orphan = os.path.join(media_root_temp_dir, "reports", "report_gone.docx")
+    open(orphan, "wb").close()
+    # Passage indexes expire by last use
+    os.makedirs(os.path.join(media_root_temp_dir, "vectors", "ab"))
+    index_files = {}
+    for name, days_old in (("abold.vectors.npy", 40), ("abold.spans.npy", 40), ("abnew.vectors.npy", 2), ("abnew.spans.npy", 40)):
+        index_files[name] = os.path.join(media_root_temp_dir, "vectors", "ab", name)
+        open(index_files[name], "wb").close()
+        os.utime(index_files[name], (time.time() - days_old * 86400,) * 2)
+
+    call_command("gc_storage", max_age_days=30, text_days=1, max_bytes=0, batch_size=1, pause=0)
+
+    assert set(ResearchSession.objects.values_list("pk", flat=True)) == {recent.pk, running.pk}
+    assert not os.path.exists(old_report) and not os.path.exists(orphan)
+    assert os.path.exists(recent.get_report_path())
+    assert StoredBlob.objects.count() == 2
+    texts = dict(UploadedDocument.objects.values_list("session_id", "extracted_text"))
+    assert texts == {recent.pk: None, running.pk: "text"}
+    assert sorted(name for name, path in index_files.items() if os.path.exists(path)) == ["abnew.spans.npy", "abnew.vectors.npy"]
+
+@pytest.mark.django_db
+def test_evict_to_budget_removes_least_recently_used_first(media_root_temp_dir):
+    """Test that eviction over the size budget keeps recently downloaded sessions."""
+    from django.utils import timezone
+    from research_app import retention
+
+    older = _stored_session(media_root_temp_dir, b"a" * 1000, days_old=3)
+    downloaded = _stored_session(media_root_temp_dir, b"b" * 1000, days_old=5)
+    newer = _stored_session(media_root_temp_dir, b"c" * 1000, days_old=1)
+    ResearchSession.objects.filter(pk=downloaded.pk).update(last_accessed_at=timezone.now())
+
+    evicted = retention.evict_to_budget(2100, batch_size=1)
+
+    assert evicted == 1
+    assert set(ResearchSession.objects.values_list("pk", flat=True)) == {downloaded.pk, newer.pk}
+    assert retention.storage_usage() <= 2100
+
+@pytest.mark.django_db
+def test_evict_to_budget_drops_passage_indexes_before_sessions(media_root_temp_dir):
+    """Test that an overage made of passage indexes is freed from them, least recently used first."""
+    import time
+    from research_app import retention
+
+    session = _stored_session(media_root_temp_dir, b"a" * 1000, days_old=3)
+    os.makedirs(os.path.join(media_root_temp_dir, "vectors", "ab"))
+    for name, days_old in (("abold", 3), ("abnew", 1)):
+        for suffix in (".vectors.npy", ".spans.npy"):
+            path = os.path.join(media_root_temp_dir, "vectors", "ab", name + suffix)
+            with open(path, "wb") as f:
+                f.write(b"v" * 500)
+            os.utime(path, (time.time() - days_old * 86400,) * 2)
+
+    assert retention.evict_to_budget(retention.storage_usage() - 1, batch_size=1) == 0
+    assert ResearchSession.objects.filter(pk=session.pk).exists()
+    assert sorted(os.listdir(os.path.join(media_root_temp_dir, "vectors", "ab"))) == ["abnew.spans.npy", "abnew.vectors.npy"]
+
+@pytest.mark.django_db
+def test_dispatch_queued_sessions_starts_when_capacity_frees(research_session_factory, settings, monkeypatch):
+    """Test that a queued session starts once in-flight work finishes."""
+    from research_app import admission
+
+    settings.ADMISSION_MAX_OUTSTANDING_DOCUMENTS = 1
+    started = []
+    monkeypatch.setattr(admission, "start_session_processing", started.append)
+    running = research_session_factory(status="processing")
+    UploadedDocument.objects.create(session=running, file="uploads/a.txt", original_filename="a.txt", status="processing")
+    queued = research_session_factory(status="queued")
+    UploadedDocument.objects.create(session=queued, file="uploads/b.txt", original_filename="b.txt")
+
+    admission.dispatch_queued_sessions()
+    assert started == []
+    running.status = "completed"
+    running.save()
+    admission.dispatch_queued_sessions()
+
+    queued.refresh_from_db()
+    assert started == [queued.session_id]
+    assert queued.status == "pending"
+
+@pytest.mark.django_db
+def test_skipped_and_timed_out_documents_free_admission_capacity(research_session_factory, settings, monkeypatch):
+    """Test that skipped and timed out documents don't count as in-flight work."""
+    from research_app import admission
+
+    settings.ADMISSION_MAX_OUTSTANDING_DOCUMENTS = 2
+    started = []
+    monkeypatch.setattr(admission, "start_session_processing", started.append)
+    summarizing = research_session_factory(status="summarizing")
+    for name, status in (("a.txt", "skipped"), ("b.txt", "timed_out")):
+        UploadedDocument.objects.create(session=summarizing, file=f"uploads/{name}", original_filename=name, status=status)
+    queued = research_session_factory(status="queued")
+    UploadedDocument.objects.create(session=queued, file="uploads/c.txt", original_filename="c.txt")
+
+    assert admission.outstanding_work()["documents"] == 0
+    admission.dispatch_queued_sessions()
+    assert started == [queued.session_id]
+
+@pytest.mark.django_db(transaction=True)
+def test_concurrent_submissions_cannot_both_take_the_last_queue_place(research_session_factory, settings, monkeypatch):
+    """Test that two submissions racing for the last queue place are decided one after the other."""
+    import threading
+    import time
+    from django.db import connection
+    from research_app import admission
+
+    settings.ADMISSION_MAX_OUTSTANDING_DOCUMENTS = 1
+    settings.ADMISSION_MAX_QUEUED_SESSIONS = 1
+    busy = research_session_factory(status="processing")
+    UploadedDocument.objects.create(session=busy, file="uploads/a.txt", original_filename="a.txt")
+
+    decide = admission.decide_admission
+    def slow_decide(uploaded_files):
+        decision = decide(uploaded_files)
+        time.sleep(0.2) # Without the lock, both decide before either inserts
+        return decision
+    monkeypatch.setattr(admission, "decide_admission", slow_decide)
+
+    decisions = []
+    def submit():
+        try:
+            files = [SimpleUploadedFile("doc.txt", b"content")]
+            decision, _ = admission.admit_session(files, lambda decision: research_session_factory(status="queued"))
+            decisions.append(decision)
+        finally:
+            connection.close()
+
+    threads = [threading.Thread(target=submit) for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert sorted(decisions) == [admission.QUEUE, admission.REJECT]
+    assert ResearchSession.objects.filter(status="queued").count() == 1
+
+@pytest.mark.django_db
+def test_claim_documents_reclaims_only_expired_leases(research_session_factory):
+    """Test that a live lease blocks other workers and an expired one is reclaimed."""
+    from datetime import timedelta
+    from django.utils import timezone
+    from research_app.workers import claim_documents, complete_document
+
+    session = research_session_factory(status="processing")
+    doc = UploadedDocument.objects.create(session=session, file="uploads/a.txt", original_filename="a.txt")
+
+    assert claim_documents("worker-1", 10, 60) == [doc.id]
+    assert claim_documents("worker-2", 10, 60) == []
+
+    UploadedDocument.objects.filter(pk=doc.pk).update(lease_expires_at=timezone.now() - timedelta(seconds=1))
+    assert claim_documents("worker-2", 10, 60) == [doc.id]
+    assert not complete_document("worker-1", doc.id, status="processed") # Lost lease, result dropped
+    assert complete_document("worker-2", doc.id, status="processed")
+    doc.refresh_from_db()
+    assert (doc.status, doc.lease_owner) == ("processed", None)
+
+    # Sessions running on a web process's thread pool take no leases; workers leave them alone
+    in_process = research_session_factory(status="processing", in_process=True)
+    UploadedDocument.objects.create(session=in_process, file="uploads/b.txt", original_filename="b.txt")
+    assert claim_documents("worker-1", 10, 60) == []
+
+@pytest.mark.django_db
+def test_worker_that_lost_its_lease_mid_extraction_writes_nothing(research_session_factory, media_root_temp_dir, monkeypatch):
+    """Test that a worker whose lease was taken over stops without overwriting the new owner's result."""
+    from datetime import timedelta
+    from django.utils import timezone
+    from research_app import workers
+
+    os.makedirs(os.path.join(media_root_temp_dir, "uploads"))
+    with open(os.path.join(media_root_temp_dir, "uploads", "a.txt"), "w") as f:
+        f.write("Inflation data")
+    session = research_session_factory(status="processing", analyze_all=True)
+    doc = UploadedDocument.objects.create(session=session, file="uploads/a.txt", original_filename="a.txt")
+    worker = workers.DocumentWorker(owner="worker-1", lease_seconds=60)
+    assert workers.claim_documents("worker-1", 10, 60) == [doc.id]
+
+    def slow_extract(document):
+        # Meanwhile the lease expired and worker-2 took the document over and finished it
+        UploadedDocument.objects.filter(pk=doc.pk).update(lease_expires_at=timezone.now() - timedelta(seconds=1))
+        assert workers.claim_documents("worker-2", 10, 60) == [doc.id]
+        assert workers.complete_document("worker-2", doc.id, status="processed", answer="Answer of worker-2")
+        return workers_extract_text(document)
+
+    workers_extract_text = workers.extract_text
+    monkeypatch.setattr(workers, "extract_text", slow_extract)
+    monkeypatch.setattr(workers.DocumentWorker, "_query", lambda *args: pytest.fail("queried without the lease"))
+    worker.process_documents([doc.id])
+
+    doc.refresh_from_db()
+    assert (doc.status, doc.answer, doc.extracted_text) == ("processed", "Answer of worker-2", None)
+
+WORKER_SCRIPT = """
+import asyncio, os, sys, django
+django.setup()
+from research_app import utils
+
+async def fake_generate_async(prompt, model):
+    name = prompt.split("Źródło dokumentu: ")[1].split(chr(10))[0] if "Źródło dokumentu: " in prompt else "SUMMARY"
+    with open(os.environ["LLM_CALL_LOG"], "a") as f:
+        f.write(name + chr(10))
+    await asyncio.sleep(0.05)
+    return "Answer"
+
+from research_app.llm import LocalStreamingLLM
+utils.gemini_generate_async = fake_generate_async
+utils.gemini_stream_async = LocalStreamingLLM(fake_generate_async).stream
+from django.core.management import call_command
+call_command("run_worker", once=True, batch_size=2, poll_interval=0)
+"""
+
+SETUP_SCRIPT = """
+import os, django
+django.setup()
+from django.core.management import call_command
+from research_app.models import ResearchSession, UploadedDocument
+call_command("migrate", verbosity=0)
+session = ResearchSession.objects.create(query="What is inside?", status="pending")
+os.makedirs(os.path.join(os.environ["MEDIA_ROOT"], "uploads"))
+for i in range(24):
+    with open(os.path.join(os.environ["MEDIA_ROOT"], "uploads", f"doc{i}.txt"), "w") as f:
+        f.write(f"Document {i}, with something inside")
+    UploadedDocument.objects.create(session=session, file=f"uploads/doc{i}.txt", original_filename=f"doc{i}.txt")
+"""
+
+def test_workers_on_shared_database_process_each_document_once(settings, tmp_path):
+    """Test that several worker processes on one database never process a document twice."""
+    import sqlite3
+    import subprocess
+    import sys
+
+    env = {
+        **os.environ,
+        "DJANGO_SETTINGS_MODULE": "desk_research_project.settings",
+        "DB_NAME": str(tmp_path / "shared.sqlite3"),
+        "MEDIA_ROOT": str(tmp_path / "media"),
+        "PROCESSING_MODE": "workers",
+        "LLM_CALL_LOG": str(tmp_path / "calls.log"),
+    }
+    subprocess.run([sys.executable, "-c", SETUP_SCRIPT], cwd=settings.BASE_DIR, env=env, check=True)
+
+    workers = [
+        subprocess.Popen([sys.executable, "-c", WORKER_SCRIPT], cwd=settings.BASE_DIR, env=env)
+        for _ in range(4)
+    ]
+    assert [worker.wait(timeout=120) for worker in workers] == [0, 0, 0, 0]
+
+    calls = (tmp_path / "calls.log").read_text().split()
+    assert sorted(calls) == sorted([f"doc{i}.txt" for i in range(24)] + ["SUMMARY"])
+    db = sqlite3.connect(env["DB_NAME"])
+    assert db.execute("SELECT status FROM research_app_researchsession").fetchall() == [("completed",)]
+    assert db.execute(
+        "SELECT COUNT(*) FROM research_app_uploadeddocument WHERE status = 'processed' AND lease_owner IS NULL"
+    ).fetchone() == (24,)
+
+def test_research_batch_streams_jsonl_and_resumes(tmp_path, settings, monkeypatch):
+    """Test the batch command's JSONL output, DOCX report and resuming from the checkpoint."""
+    import json
+    from django.core.management import call_command
+
+    settings.LLM_MAX_CONCURRENCY = 2 # The command overrides it; restored after the test
+    prompts = []
+
+    async def fake_generate_async(prompt, model):
+        prompts.append(prompt)
+        return 'Answer with "a quote".'
+
+    monkeypatch.setattr("research_app.utils.gemini_generate_async", fake_generate_async)
+    corpus = tmp_path / "corpus"
+    (corpus / "nested").mkdir(parents=True)
+    for i in range(4):
+        (corpus / f"doc{i}.txt").write_text(f"Document {i}")
+    (corpus / "nested" / "empty.txt").write_text("")
+    (corpus / "notes.csv").write_text("ignored")
+    output, docx_path = tmp_path / "answers.jsonl", tmp_path / "report.docx"
+
+    def run():
+        call_command("research_batch", str(corpus), query="What?", output=str(output),
+                     extract_workers=2, llm_concurrency=2, docx=str(docx_path), stdout=StringIO(), stderr=StringIO())
+
+    run()
+    records = {r["path"]: r for r in map(json.loads, output.read_text().splitlines())}
+    assert set(records) == {"doc0.txt", "doc1.txt", "doc2.txt", "doc3.txt", os.path.join("nested", "empty.txt")}
+    assert records["doc0.txt"]["status"] == "processed"
+    assert records[os.path.join("nested", "empty.txt")]["status"] == "error"
+    assert len(prompts) == 5 # 4 documents + summary
+    assert docx_path.exists()
+
+    (corpus / "doc4.txt").write_text("Document 4")
+    prompts.clear()
+    run()
+    assert len(output.read_text().splitlines()) == 6
+    assert len(prompts) == 2 # Only the new document, then the summary
+
+@pytest.mark.django_db
+def test_api_bulk_create_and_status(client, media_root_temp_dir, monkeypatch):
+    """Test creating several sessions in one request and reading their status in bulk."""
+    import json
+    monkeypatch.setattr("research_app.views.start_session_processing", lambda session_id: None)
+
+    response = client.post(reverse("research_app:api_sessions"), {
+        "sessions": json.dumps([
+            {"query": "First?", "files": ["a", "b"]},
+            {"query": "Second?", "files": ["c"]},
+        ]),
+        "a": SimpleUploadedFile("a.txt", b"A"),
+        "b": SimpleUploadedFile("b.txt", b"B"),
+        "c": SimpleUploadedFile("c.txt", b"C"),
+    })
+    assert response.status_code == 201
+    created = response.json()["sessions"]
+    assert [item["documents"] for item in created] == [2, 1]
+
+    UploadedDocument.objects.filter(original_filename="a.txt").update(status="processed", answer="Yes")
+    missing = str(uuid.uuid4())
+    response = client.post(
+        reverse("research_app:api_session_status"),
+        json.dumps({"session_ids": [item["session_id"] for item in created] + [missing]}),
+        content_type="application/json",
+    )
+    body = response.json()
+    assert body["missing"] == [missing]
+    assert body["sessions"][0]["documents"] == {"total": 2, "processed": 1, "skipped": 0, "timed_out": 0, "failed": 0}
+    assert body["sessions"][1]["query"] == "Second?"
+
+    bad = client.post(reverse("research_app:api_sessions"), {"sessions": json.dumps([{"query": "Q", "files": ["x"]}])})
+    assert bad.status_code == 400
+
+@pytest.mark.django_db
+def test_api_cursor_pagination_without_n_plus_one(client, research_session_factory, django_assert_max_num_queries):
+    """Test that session and document listings page through everything with a fixed number of queries."""
+    sessions = [research_session_factory() for _ in range(5)]
+    for session in sessions:
+        for i in range(3):
+            UploadedDocument.objects.create(session=session, file=f"uploads/{i}.txt", original_filename=f"{i}.txt")
+
+    seen, cursor = [], None
+    while True:
+        params = {"limit": 2, **({"cursor": cursor} if cursor else {})}
+        with django_assert_max_num_queries(3):
+            page = client.get(reverse("research_app:api_sessions"), params).json()
+        seen += [item["session_id"] for item in page["sessions"]]
+        assert all(item["documents"]["total"] == 3 for item in page["sessions"])
+        cursor = page["next_cursor"]
+        if not cursor:
+            break
+    assert sorted(seen) == sorted(str(s.session_id) for s in sessions)
+
+    url = reverse("research_app:api_session_documents", args=[sessions[0].session_id])
+    first = client.get(url, {"limit": 2}).json()
+    second = client.get(url, {"limit": 2, "cursor": first["next_cursor"]}).json()
+    assert len(first["documents"]) == 2 and len(second["documents"]) == 1 and second["next_cursor"] is None
+    assert client.get(reverse("research_app:api_sessions"), {"cursor": "garbage"}).status_code == 400
 
 @pytest.mark.django_db
 def test_get_session_status_view_pending(client, research_session):
@@ -221,6 +721,30 @@ def test_download_report_view(client, processed_session, tmp_path, settings, mon
     assert response["Content-Type"] == "application/vnd.openxmlformats-officedocument.wordprocessingml.document"
     assert 'attachment; filename="test_report.docx"' in response["Content-Disposition"]
 
+@pytest.mark.django_db
+def test_download_report_view_streams_asynchronously(processed_session, tmp_path, settings):
+    """Test that the async download view streams the full report through an ASGI request."""
+    from asgiref.sync import async_to_sync
+    from django.test import AsyncClient
+
+    reports_dir = tmp_path / "reports"
+    reports_dir.mkdir()
+    content = os.urandom(200_000) # Larger than one streaming chunk
+    (reports_dir / "test_report.docx").write_bytes(content)
+    settings.MEDIA_ROOT = str(tmp_path)
+
+    async def download():
+        url = reverse("research_app:download_report", args=[processed_session.session_id])
+        response = await AsyncClient().get(url)
+        body = b"".join([chunk async for chunk in response.streaming_content])
+        return response, body
+
+    response, body = async_to_sync(download)()
+
+    assert response.status_code == 200
+    assert response["Content-Length"] == str(len(content))
+    assert body == content
+
 # ---- Utility Tests ----
 
 def test_extract_text_from_txt():
@@ -239,6 +763,870 @@ def test_extract_text_from_txt():
     if os.path.exists(file_path):
         os.remove(file_path)
 
+def test_normalize_extracted_text_strips_repeated_lines():
+    """Test that running headers/footers are removed after their first occurrence."""
+    text = "".join(
+        f"\n--- Page {i} ---\nACME Corp Confidential\nBody of page {i}   with  spaces\nPage {i} of 4\n"
+        for i in range(1, 5)
+    )
+    normalized, bytes_saved = normalize_extracted_text(text)
+
+    assert normalized.count("ACME Corp Confidential") == 1
+    assert normalized.count(" of 4") == 1
+    for i in range(1, 5):
+        assert f"--- Page {i} ---" in normalized
+        assert f"Body of page {i} with spaces" in normalized
+    assert bytes_saved == len(text.encode()) - len(normalized.encode())
+    assert bytes_saved > 0
+
+def test_normalize_extracted_text_keeps_numeric_tables():
+    """Test that rows differing only in their numbers are kept; only page numbers in step with the pages are dropped."""
+    totals = [17, 2019, 5, 88, 3, 41]
+    text = "".join(
+        f"\n--- Page {i} ---\nRaport roczny\nTotal: {total} PLN\nQ{i % 4 + 1} results\n"
+        f"{i * 11} | {total * 2}\n{i * 7} | {i * 5}\nStrona {i} z 6\n"
+        for i, total in enumerate(totals, start=1)
+    )
+    normalized, _ = normalize_extracted_text(text)
+
+    pages = normalized.split("--- Page ")[1:]
+    for i, (page, total) in enumerate(zip(pages, totals), start=1):
+        assert f"Total: {total} PLN" in page
+        assert f"{i * 11} | {total * 2}" in page and f"{i * 7} | {i * 5}" in page # Last row before the footer
+    assert normalized.count("Raport roczny") == 1
+    assert normalized.count(" z 6") == 1
+
+def test_normalize_extracted_text_keeps_numbered_headings():
+    """Test that headings numbered like the slides survive; only real page numbers are dropped."""
+    text = "".join(
+        f"\n--- Slide {i}: Q{i} revenue ---\nQ{i} revenue\nStep {i}\nGrowth was steady.\nQuestion {i}\n{i + 2}\n"
+        for i in range(1, 6)
+    )
+    normalized, _ = normalize_extracted_text(text)
+
+    for i in range(1, 6):
+        for heading in (f"Q{i} revenue\n", f"Step {i}\n", f"Question {i}\n"):
+            assert heading in normalized
+    # Printed page numbers two ahead of the slides: not the index, but the same form at the bottom of every slide
+    assert not any(f"\n{i + 2}\n" in normalized for i in range(2, 6))
+
+def test_normalize_extracted_text_keeps_short_documents():
+    """Test that documents with too few pages only get whitespace collapsed."""
+    text = "\n--- Page 1 ---\nHeader\n\n\n\nText\n--- Page 2 ---\nHeader\n"
+    normalized, _ = normalize_extracted_text(text)
+
+    assert normalized.count("Header") == 2
+    assert "\n\n\n" not in normalized
+
+def test_extract_text_from_docx_fast_includes_tables(tmp_path):
+    """Test that the streaming DOCX extractor keeps headings and table rows."""
+    from docx import Document
+
+    docx_path = tmp_path / "report.docx"
+    document = Document()
+    document.add_heading("Findings", level=1)
+    document.add_paragraph("Revenue grew.")
+    table = document.add_table(rows=1, cols=2)
+    table.cell(0, 0).text = "Q1"
+    table.cell(0, 1).text = "100"
+    document.save(docx_path)
+
+    text, metadata = extract_text_from_docx_fast(str(docx_path))
+
+    assert text == "\n--- Section: Findings ---\nRevenue grew.\nQ1 | 100\n"
+    assert metadata == {"title": "report.docx"}
+
+def test_extract_text_from_pptx_fast_matches_object_model(tmp_path):
+    """Test that the streaming PPTX extractor produces the same slide and notes markers."""
+    from pptx import Presentation
+
+    pptx_path = tmp_path / "deck.pptx"
+    prs = Presentation()
+    for i in range(2):
+        slide = prs.slides.add_slide(prs.slide_layouts[1])
+        slide.shapes.title.text = f"Title {i}"
+        slide.placeholders[1].text = f"Point {i}"
+        slide.notes_slide.notes_text_frame.text = f"Notes {i}"
+    prs.save(pptx_path)
+
+    fast_text, _ = extract_text_from_pptx_fast(str(pptx_path))
+    slow_text, _ = extract_text_from_pptx(str(pptx_path))
+
+    assert fast_text == slow_text
+    assert "--- Notes for Slide 2: Title 1 ---" in fast_text
+
+def test_extract_text_from_pdf_sharded_keeps_page_order(tmp_path, settings):
+    """Test that sharded PDF extraction stitches pages back in order, on one shared non-forking pool."""
+    import fitz
+    from research_app import utils
+
+    pdf_path = str(tmp_path / "long.pdf")
+    pdf = fitz.open()
+    for i in range(5):
+        pdf.new_page().insert_text((72, 72), f"Content of page {i + 1}")
+    pdf.save(pdf_path)
+    pdf.close()
+
+    settings.PDF_SHARD_WORKERS = 1
+    unsharded_text, _ = extract_text_from_pdf(pdf_path)
+
+    settings.PDF_SHARD_PAGES = 2
+    settings.PDF_SHARD_WORKERS = 2
+    sharded_text, metadata = extract_text_from_pdf(pdf_path)
+
+    assert sharded_text == unsharded_text
+    positions = [sharded_text.index(f"--- Page {i} ---") for i in range(1, 6)]
+    assert positions == sorted(positions)
+    assert metadata is not None
+    pool = utils._pdf_pool
+    assert pool._mp_context.get_start_method() in ("forkserver", "spawn")
+    assert extract_text_from_pdf(pdf_path)[0] == sharded_text and utils._pdf_pool is pool
+
+def test_verify_quotes_maps_hits_and_flags_fabrications():
+    """Test quote verification across line breaks, ellipses and section markers."""
+    from research_app.quotes import verify_quotes
+
+    text = (
+        "--- Page 1 ---\nIntroduction to the study.\n"
+        "--- Page 2 ---\nSales grew by 12%\nin the „northern” region, while costs fell.\n"
+    )
+    results = verify_quotes(text, [
+        "sales grew by 12% in the northern region",
+        "Sales grew ... costs fell",
+        "Profits doubled in the southern region",
+        "12%",
+    ])
+
+    assert [(r["verified"], r["location"]) for r in results] == [
+        (True, "Page 2"), (True, "Page 2"), (False, None), (None, None),
+    ]
+
+@pytest.mark.django_db
+def test_flush_throughput_samples_keeps_rolling_average(monkeypatch):
+    """Test that buffered timings are folded into one exponentially weighted average per bucket."""
+    from research_app.models import ThroughputStat
+    from research_app.progress import EWMA_ALPHA, flush_throughput_samples, llm_size_bucket, note_llm_call
+
+    monkeypatch.setattr("research_app.progress._samples", []) # Drop samples left by other tests
+    note_llm_call(3000, 10.0)
+    flush_throughput_samples()
+    note_llm_call(3000, 20.0)
+    note_llm_call(3000, 20.0)
+    flush_throughput_samples()
+
+    stat = ThroughputStat.objects.get(stage="llm", bucket=llm_size_bucket(3000))
+    expected = 10.0
+    for sample in (20.0, 20.0):
+        expected += EWMA_ALPHA * (sample - expected)
+    assert stat.samples == 3
+    assert stat.value == pytest.approx(expected)
+
+def test_estimate_progress_from_throughput_stats(settings):
+    """Test session and document fractions and ETAs from stage estimates and elapsed time."""
+    from datetime import timedelta
+    from types import SimpleNamespace
+    from django.utils import timezone
+    from research_app.progress import CHARS_PER_TOKEN, SUMMARY_PROMPT_CHARS_PER_DOCUMENT, estimate_progress, llm_size_bucket
+
+    settings.LLM_MAX_CONCURRENCY = 4
+    now = timezone.now()
+    stats = {
+        ("extract", ".txt"): 1000.0, # bytes/s
+        ("llm", llm_size_bucket(5000 * CHARS_PER_TOKEN)): 30.0,
+        ("llm", llm_size_bucket(SUMMARY_PROMPT_CHARS_PER_DOCUMENT * 2)): 10.0,
+    }
+    def doc(pk, status, started_ago=None):
+        return SimpleNamespace(
+            id=pk, original_filename="a.txt", file_size=10000, estimated_tokens=5000, status=status,
+            stage_started_at=now - timedelta(seconds=started_ago) if started_ago is not None else None,
+        )
+    session = SimpleNamespace(status="processing", updated_at=now)
+
+    progress = estimate_progress(session, [doc(1, "processed"), doc(2, "processing", started_ago=20)], stats, now)
+
+    assert progress["documents"][1] == {"fraction": 1.0, "percent": 100, "eta_seconds": None, "eta_display": None}
+    assert progress["documents"][2]["fraction"] == pytest.approx(30 / 40) # Extraction 10s + 20s of 30s LLM
+    assert progress["documents"][2]["eta_seconds"] == pytest.approx(10)
+    assert progress["eta_seconds"] == pytest.approx(10 + 10) # Rest of the LLM call, then the summary
+    assert progress["fraction"] == pytest.approx((40 + 30) / 90)
+
+def test_process_research_sync_records_quote_check(research_session_factory, media_root_temp_dir, monkeypatch):
+    """Test that processed documents store which quotes were found in their text."""
+    async def fake_generate_async(prompt, model):
+        return 'It says "the committee approved the budget" and "the budget was rejected outright".'
+
+    monkeypatch.setattr("research_app.utils.gemini_generate_async", fake_generate_async)
+    session = research_session_factory(query="What did the committee approve?")
+    os.makedirs(os.path.join(media_root_temp_dir, "uploads"))
+    with open(os.path.join(media_root_temp_dir, "uploads", "minutes.txt"), "w") as f:
+        f.write("In March the Committee approved the budget.")
+    doc = UploadedDocument.objects.create(session=session, file="uploads/minutes.txt", original_filename="minutes.txt")
+
+    process_research_sync(session.session_id)
+
+    doc.refresh_from_db()
+    assert [(r["quote"], r["verified"]) for r in doc.quote_check] == [
+        ("the committee approved the budget", True),
+        ("the budget was rejected outright", False),
+    ]
+
+@pytest.mark.django_db
+@pytest.mark.parametrize("profiler", ["sampling", "cprofile"])
+def test_profiled_session_stores_profile_viewable_in_admin(
+    admin_client, research_session_factory, media_root_temp_dir, settings, monkeypatch, profiler,
+):
+    """Test that an opted-in session is profiled and its profile is shown and downloadable in the admin."""
+    async def fake_generate_async(prompt, model):
+        return "Answer."
+
+    monkeypatch.setattr("research_app.utils.gemini_generate_async", fake_generate_async)
+    settings.SESSION_PROFILER = profiler
+    session = research_session_factory()
+    ResearchSession.objects.filter(pk=session.pk).update(profile_requested=True)
+    unprofiled = research_session_factory()
+    os.makedirs(os.path.join(media_root_temp_dir, "uploads"))
+    with open(os.path.join(media_root_temp_dir, "uploads", "notes.txt"), "w") as f:
+        f.write("Some notes.")
+    for s in (session, unprofiled):
+        UploadedDocument.objects.create(session=s, file="uploads/notes.txt", original_filename="notes.txt")
+
+    process_research_sync(session.session_id)
+    process_research_sync(unprofiled.session_id)
+
+    session.refresh_from_db()
+    unprofiled.refresh_from_db()
+    assert session.status == "completed" and session.profile_filename
+    assert unprofiled.profile_filename is None
+    page = admin_client.get(reverse("admin:research_app_researchsession_change", args=[session.pk]))
+    assert "_process_research" in page.content.decode()
+    download = admin_client.get(reverse("admin:research_app_researchsession_profile", args=[session.pk]))
+    assert download.status_code == 200
+    assert b"".join(download.streaming_content)
+
+@pytest.mark.django_db
+def test_incremental_summary_starts_before_last_document(research_session_factory, media_root_temp_dir, settings, monkeypatch):
+    """Test that partial summaries run while documents are still querying and the final call only merges."""
+    import asyncio
+    import re
+    settings.SUMMARY_PARTIAL_DOCUMENTS = 2
+    settings.SUMMARY_MERGE_FANIN = 2
+    events = []
+
+    async def fake_generate_async(prompt, model):
+        if "Tekst dokumentu" in prompt:
+            index = int(re.search(r"doc(\d)\.txt", prompt).group(1))
+            await asyncio.sleep(0.05 * index) # doc0 answers first, doc4 last
+            events.append(f"doc{index}")
+            return f"Finding {index}."
+        kind = "merge" if "Połącz częściowe" in prompt else "partial"
+        events.append(kind)
+        return f"{kind} covering " + ", ".join(f"Finding {i}" for i in range(5) if f"Finding {i}" in prompt)
+
+    monkeypatch.setattr("research_app.utils.gemini_generate_async", fake_generate_async)
+    session = research_session_factory(query="What does each document contain?")
+    os.makedirs(os.path.join(media_root_temp_dir, "uploads"))
+    for i in range(5):
+        with open(os.path.join(media_root_temp_dir, "uploads", f"doc{i}.txt"), "w") as f:
+            f.write(f"Contents of document {i}.")
+        UploadedDocument.objects.create(session=session, file=f"uploads/doc{i}.txt", original_filename=f"doc{i}.txt")
+
+    process_research_sync(session.session_id)
+
+    session.refresh_from_db()
+    assert session.status == "completed"
+    assert events.index("partial") < events.index("doc4")
+    # Two partials (doc0+1, doc2+3) merged in the background, then a final merge with doc4's answer
+    assert events.count("partial") == 2 and events.count("merge") == 2
+    assert events[-1] == "merge"
+
+def test_incremental_summary_finish_cancels_background_merges(settings, monkeypatch):
+    """Test that cancelling finish() (the session ran out of time) cancels the merge it was waiting for."""
+    import asyncio
+    from research_app.llm import run_llm_coroutine
+    from research_app.summary import IncrementalSummarizer
+    settings.SUMMARY_PARTIAL_DOCUMENTS = 1
+    settings.SUMMARY_MERGE_FANIN = 2
+    cancelled = []
+
+    async def fake_summary(prompt, on_text=None):
+        if "Partial summary of" in prompt: # The merge of the two partials
+            try:
+                await asyncio.sleep(60)
+            except asyncio.CancelledError:
+                cancelled.append(prompt)
+                raise
+        return "Partial."
+
+    monkeypatch.setattr("research_app.summary.agenerate_summary", fake_summary)
+
+    async def run():
+        summarizer = IncrementalSummarizer("Query")
+        summarizer.add("a.txt", "A")
+        summarizer.add("b.txt", "B")
+        with pytest.raises(TimeoutError):
+            await asyncio.wait_for(summarizer.finish(), 0.5)
+        return summarizer
+
+    summarizer = run_llm_coroutine(run())
+    assert len(cancelled) == 1
+    assert not summarizer._tasks
+
+@pytest.mark.django_db
+def test_documents_are_queried_while_later_ones_extract(research_session_factory, media_root_temp_dir, monkeypatch):
+    """Test that a document's LLM query starts before the next document has been extracted."""
+    import threading
+    from research_app import views
+    query_started = {name: threading.Event() for name in ("a.txt", "b.txt")}
+
+    async def fake_generate_async(prompt, model):
+        for name, started in query_started.items():
+            if f"Źródło dokumentu: {name}" in prompt:
+                started.set()
+        return "Odpowiedź."
+
+    monkeypatch.setattr("research_app.utils.gemini_generate_async", fake_generate_async)
+    extracted, overlapped = [], []
+    real_extract_text = views.extract_text
+
+    def extract_text(doc):
+        if extracted: # The first document's query should be running by now
+            overlapped.append(query_started[extracted[0]].wait(timeout=5))
+        extracted.append(doc.original_filename)
+        return real_extract_text(doc)
+
+    monkeypatch.setattr(views, "extract_text", extract_text)
+    os.makedirs(os.path.join(media_root_temp_dir, "uploads"))
+    session = research_session_factory(query="Inflacja", analyze_all=True)
+    for name in ("a.txt", "b.txt"):
+        with open(os.path.join(media_root_temp_dir, "uploads", name), "w", encoding="utf-8") as f:
+            f.write(f"Inflacja w dokumencie {name}.")
+        UploadedDocument.objects.create(session=session, file=f"uploads/{name}", original_filename=name)
+
+    process_research_sync(session.session_id)
+
+    assert overlapped == [True]
+    assert set(session.documents.values_list("status", flat=True)) == {"processed"}
+
+@pytest.mark.django_db
+def test_relevance_prescreen_skips_unrelated_documents(research_session_factory, media_root_temp_dir, monkeypatch):
+    """Test that documents sharing no terms with the query skip the LLM unless the session analyzes everything."""
+    from docx import Document as DocxDocument
+    prompts = []
+
+    async def fake_generate_async(prompt, model):
+        prompts.append(prompt)
+        return "Odpowiedź."
+
+    monkeypatch.setattr("research_app.utils.gemini_generate_async", fake_generate_async)
+    os.makedirs(os.path.join(media_root_temp_dir, "uploads"))
+    texts = {
+        "raport.txt": "Inflacja w Polsce spowolniła wzrost płac; rynek pracy pozostał napięty.",
+        "przepis.txt": "Sernik: twaróg, jajka, cukier. Piec godzinę w 170 stopniach.",
+    }
+    for name, text in texts.items():
+        with open(os.path.join(media_root_temp_dir, "uploads", name), "w", encoding="utf-8") as f:
+            f.write(text)
+    query = "Jaki jest wpływ inflacji na rynek pracy?"
+    screened, analyze_all = research_session_factory(query=query), research_session_factory(query=query, analyze_all=True)
+    for session in (screened, analyze_all):
+        for name in texts:
+            UploadedDocument.objects.create(session=session, file=f"uploads/{name}", original_filename=name)
+
+    process_research_sync(screened.session_id)
+
+    screened.refresh_from_db()
+    assert screened.status == "completed"
+    skipped = screened.documents.get(original_filename="przepis.txt")
+    relevant = screened.documents.get(original_filename="raport.txt")
+    assert (skipped.status, skipped.relevance_score) == ("skipped", 0.0)
+    assert skipped.answer.startswith("Ten dokument nie zawiera informacji")
+    assert relevant.status == "processed" and relevant.relevance_score > 0.3
+    assert not any("przepis.txt" in prompt for prompt in prompts) # Neither queried nor summarized
+    report = DocxDocument(screened.get_report_path())
+    assert "Analiza: przepis.txt" in [p.text for p in report.paragraphs]
+
+    prompts.clear()
+    process_research_sync(analyze_all.session_id)
+    assert not analyze_all.documents.filter(status="skipped").exists()
+    assert sum("Źródło dokumentu" in prompt for prompt in prompts) == 2
+
+def test_relevance_screen_skips_only_documents_without_query_terms(settings):
+    """Test that any query term anywhere in the text keeps a document, and the score cutoff is opt-in."""
+    from research_app.relevance import RelevanceScreen
+    query = "Wpływ inflacji na płace"
+    filler = "Sprawozdanie omawia budżet gminy, drogi i szkoły.\n" * 25_000 # Over 1M characters
+    late_match, unrelated = filler + "Inflacja wzrosła.", filler
+
+    screen = RelevanceScreen(query)
+    assert screen.check(late_match)[1] is False
+    assert screen.check(unrelated) == (0, True)
+
+    settings.RELEVANCE_MIN_SCORE = 0.5
+    assert RelevanceScreen(query).check(late_match)[1] is True
+    settings.RELEVANCE_SCREEN = False
+    assert RelevanceScreen(query).check(unrelated)[1] is False
+
+@pytest.mark.django_db
+def test_relevance_report_replays_thresholds(research_session_factory):
+    """Test Polish normalization and the tuning report's skip rates and misses."""
+    from django.core.management import call_command
+    from research_app.relevance import query_terms, relevance_score
+    terms = query_terms("Wpływ inflacji na płace")
+    assert terms == {"wplyw", "infla", "plac"}
+    assert relevance_score("Inflacja i PŁACE rosną", terms) > relevance_score("Inflacyjny", terms) > 0
+
+    session = research_session_factory(query="Wpływ inflacji na płace")
+    for text, answer in (
+        ("Inflacja podniosła płace.", "Płace wzrosły."),
+        ("Inflacja w strefie euro.", "Ten dokument nie zawiera informacji dotyczących pytania."),
+        ("Zupełnie inny temat.", "Wspomina o płacach pośrednio."),
+    ):
+        UploadedDocument.objects.create(session=session, original_filename="d.txt", status="processed", extracted_text=text, answer=answer)
+
+    out = StringIO()
+    call_command("relevance_report", threshold=[0.2], stdout=out)
+    lines = out.getvalue().splitlines()
+    assert lines[0].startswith("3 document(s) re-scored")
+    # Below 0.2: the unrelated text (the LLM found something: a miss) and the euro one (LLM agreed)
+    assert lines[2].split() == ["0.2", "66.7%", "1", "1"]
+
+@pytest.mark.django_db
+def test_long_documents_send_the_passages_closest_to_the_query(
+    research_session_factory, media_root_temp_dir, settings, monkeypatch,
+):
+    """Test that long documents are cut to the best-matching chunks, from an index built once per text."""
+    from research_app import passages
+    settings.PASSAGE_SELECTION_CHARS = 3000
+    settings.PASSAGE_CHUNK_CHARS = 500
+    settings.PASSAGE_EMBED_BATCH = 4 # Several batches per document
+    prompts = []
+
+    async def fake_generate_async(prompt, model):
+        prompts.append(prompt)
+        return "Odpowiedź."
+
+    monkeypatch.setattr("research_app.utils.gemini_generate_async", fake_generate_async)
+    filler = "Sprawozdanie omawia budżet gminy, drogi i szkoły w kolejnych latach.\n" * 300
+    text = filler[:10_000] + "Eksport zbóż do Egiptu spadł po wprowadzeniu sankcji.\n" + filler[10_000:]
+    os.makedirs(os.path.join(media_root_temp_dir, "uploads"))
+    with open(os.path.join(media_root_temp_dir, "uploads", "long.txt"), "w", encoding="utf-8") as f:
+        f.write(text)
+    builds = []
+    original_build = passages.build_index
+    monkeypatch.setattr(passages, "build_index", lambda *args: builds.append(args[1]) or original_build(*args))
+
+    for _ in range(2): # The second session reuses the first one's index
+        session = research_session_factory(query="Jak sankcje wpłynęły na eksport zbóż?")
+        UploadedDocument.objects.create(session=session, file="uploads/long.txt", original_filename="long.txt")
+        process_research_sync(session.session_id)
+
+    document_prompts = [p for p in prompts if "Źródło dokumentu" in p]
+    assert len(document_prompts) == 2 and len(builds) == 1
+    assert all("Eksport zbóż do Egiptu" in p for p in document_prompts)
+    sent = document_prompts[0].split("--- POCZĄTEK TEKSTU ---")[1]
+    assert len(sent) < 3500 and passages.PASSAGE_GAP in sent
+    import numpy as np
+    vectors_path, spans_path = passages.index_paths(builds[0])
+    vectors, spans = np.load(vectors_path, mmap_mode="r"), np.load(spans_path)
+    assert isinstance(vectors, np.memmap) and vectors.shape == (len(spans), passages.EMBEDDING_DIM)
+    assert len(spans) > 20
+
+    # A long document the pre-screen rules out is never indexed
+    settings.PASSAGE_CHUNK_CHARS = 400 # A new index key, so a build would show
+    session = research_session_factory(query="Przepis na sernik z twarogu")
+    UploadedDocument.objects.create(session=session, file="uploads/long.txt", original_filename="long.txt")
+    process_research_sync(session.session_id)
+    assert session.documents.get().status == "skipped"
+    assert len(builds) == 1
+
+    # A new document adds its own index files and leaves the existing one alone
+    before = os.stat(vectors_path)
+    passages.select_passages("Inny dokument o eksporcie zbóż.\n" * 100, "eksport zbóż", 500, chunk_chars=200)
+    assert len(builds) == 2 and os.path.exists(passages.index_paths(builds[1])[0])
+    assert (os.stat(vectors_path).st_ino, os.stat(vectors_path).st_size) == (before.st_ino, before.st_size)
+
+def test_guard_stalls_cancels_a_stalled_stream():
+    """Test that a stream that stops sending is cancelled after the stall timeout, not the read timeout."""
+    import asyncio
+    import time
+    from research_app.llm import LLMStreamStalled, LocalStreamingLLM, guard_stalls
+
+    async def generate(prompt, model):
+        return "one two three four five six seven eight"
+
+    stand_in = LocalStreamingLLM(generate, words_per_chunk=2, stall_after=2)
+    received = []
+
+    async def consume():
+        async for chunk in guard_stalls(stand_in.stream("prompt", "model"), first_chunk_timeout=1, stall_timeout=0.1):
+            received.append(chunk)
+
+    started = time.monotonic()
+    with pytest.raises(LLMStreamStalled):
+        asyncio.run(consume())
+    assert received == ["one two ", "three four "]
+    assert time.monotonic() - started < 1
+
+def test_streamed_answers_are_saved_while_generating(
+    research_session_factory, media_root_temp_dir, settings, monkeypatch, local_llm_stream,
+):
+    """Test that partial answers reach the database mid-stream and are cleared once the answer is final."""
+    from research_app.streaming import LiveText
+    settings.LLM_STREAM_SAVE_INTERVAL = 0.01
+    local_llm_stream.words_per_chunk = 1
+    local_llm_stream.delay = 0.02
+    answer = "The committee approved the budget in March after a long debate."
+
+    async def fake_generate_async(prompt, model):
+        return answer
+
+    monkeypatch.setattr("research_app.utils.gemini_generate_async", fake_generate_async)
+    seen_in_db = []
+    original_save = LiveText.save
+    def recording_save(self):
+        original_save(self)
+        seen_in_db.extend(UploadedDocument.objects.exclude(partial_answer=None).values_list("partial_answer", flat=True))
+    monkeypatch.setattr(LiveText, "save", recording_save)
+
+    session = research_session_factory(query="What was decided at the March meeting?")
+    os.makedirs(os.path.join(media_root_temp_dir, "uploads"))
+    with open(os.path.join(media_root_temp_dir, "uploads", "minutes.txt"), "w") as f:
+        f.write("Minutes of the March meeting.")
+    doc = UploadedDocument.objects.create(session=session, file="uploads/minutes.txt", original_filename="minutes.txt")
+
+    process_research_sync(session.session_id)
+
+    doc.refresh_from_db()
+    assert (doc.answer, doc.partial_answer) == (answer, None)
+    partials = [text for text in seen_in_db if text != answer]
+    assert partials and all(answer.startswith(text) for text in partials)
+
+def test_session_memory_budget_spills_large_text():
+    """Test that text over the budget is spilled and read back through the mmap."""
+    budget = SessionMemoryBudget(budget_bytes=1024)
+
+    small = budget.hold("short text")
+    large = budget.hold("zażółć " * 1000)
+
+    assert small == "short text"
+    assert isinstance(large, SpilledText)
+    assert large.head(7) == "zażółć "
+    budget.release(small)
+    budget.release(large)
+    assert budget.used_bytes == 0
+
+def test_process_research_sync_stays_within_memory_budget(media_root_temp_dir, settings, monkeypatch):
+    """Test that peak Python memory stays under the session budget for a corpus larger than it."""
+    import tracemalloc
+    budget = 32 * 1024 * 1024
+    settings.SESSION_MEMORY_BUDGET_BYTES = budget
+    prompt_sizes = []
+
+    async def fake_generate_async(prompt, model):
+        prompt_sizes.append(len(prompt))
+        return 'Answer with "a supporting quote".'
+
+    monkeypatch.setattr("research_app.utils.gemini_generate_async", fake_generate_async)
+
+    # 12 documents x 4 MB = 48 MB of text, well over the budget
+    session = ResearchSession.objects.create(query="What is inside each document?")
+    upload_dir = os.path.join(media_root_temp_dir, "uploads", str(session.session_id))
+    os.makedirs(upload_dir)
+    line = "x" * 399 + "\n"
+    for i in range(12):
+        with open(os.path.join(upload_dir, f"doc{i}.txt"), "w") as f:
+            f.write(f"Document {i}\n" + line * 10_000)
+        UploadedDocument.objects.create(
+            session=session,
+            file=f"uploads/{session.session_id}/doc{i}.txt",
+            original_filename=f"doc{i}.txt",
+        )
+
+    tracemalloc.start()
+    process_research_sync(session.session_id)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    session.refresh_from_db()
+    assert session.status == "completed"
+    assert len(prompt_sizes) == 14 # 12 documents + partial summary of the first 8 + final merge
+    assert peak < budget
+
+def test_views_import_does_not_load_heavy_modules(settings):
+    """Test that a cold import of the views loads neither the parsers nor NumPy."""
+    import subprocess
+    import sys
+
+    code = (
+        "import sys, django; django.setup(); import research_app.views; "
+        "print(','.join(m for m in ('fitz', 'docx', 'pptx', 'lxml', 'numpy') if m in sys.modules))"
+    )
+    result = subprocess.run(
+        [sys.executable, "-c", code],
+        cwd=settings.BASE_DIR,
+        env={**os.environ, "DJANGO_SETTINGS_MODULE": "desk_research_project.settings"},
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+
+    assert result.stdout.strip() == ""
+
+def test_gemini_generate_async_uses_pooled_client(monkeypatch):
+    """Test the REST calls (plain and streamed) made through the shared async HTTP client."""
+    import httpx
+    from research_app import llm
+
+    requests_seen = []
+
+    def handler(request):
+        requests_seen.append(request)
+        if request.url.path.endswith(":streamGenerateContent"):
+            events = "".join(
+                f'data: {{"candidates": [{{"content": {{"parts": [{{"text": "{text}"}}]}}}}]}}\r\n\r\n'
+                for text in ("Odpo", "wiedź")
+            )
+            return httpx.Response(200, text=events, headers={"content-type": "text/event-stream"})
+        return httpx.Response(200, json={"candidates": [{"content": {"parts": [{"text": "Odpowiedź"}]}}]})
+
+    async def call():
+        monkeypatch.setattr(llm, "_http_client", httpx.AsyncClient(
+            base_url=llm.GEMINI_API_BASE_URL, transport=httpx.MockTransport(handler),
+        ))
+        text = await llm.gemini_generate_async("prompt", "gemini-2.0-flash")
+        return text, [chunk async for chunk in llm.gemini_stream_async("prompt", "gemini-2.0-flash")]
+
+    assert llm.run_llm_coroutine(call()) == ("Odpowiedź", ["Odpo", "wiedź"])
+    assert requests_seen[0].url.path == "/v1beta/models/gemini-2.0-flash:generateContent"
+    assert requests_seen[1].url.params["alt"] == "sse"
+
+def test_aquery_documents_caps_concurrency_and_keeps_order(settings, monkeypatch):
+    """Test that document queries run concurrently, capped by LLM_MAX_CONCURRENCY."""
+    import asyncio
+    from research_app.llm import run_llm_coroutine
+
+    settings.LLM_MAX_CONCURRENCY = 3
+    in_flight = {"now": 0, "max": 0}
+
+    async def fake_generate_async(prompt, model):
+        in_flight["now"] += 1
+        in_flight["max"] = max(in_flight["max"], in_flight["now"])
+        await asyncio.sleep(0.01)
+        in_flight["now"] -= 1
+        return prompt.split("Źródło dokumentu: ")[1].split("\n")[0]
+
+    monkeypatch.setattr("research_app.utils.gemini_generate_async", fake_generate_async)
+    items = [(f"text {i}", f"doc{i}.txt", None) for i in range(10)]
+    results = run_llm_coroutine(aquery_documents(items, "query"))
+
+    assert [answer for answer, _ in results] == [f"doc{i}.txt" for i in range(10)]
+    assert in_flight["max"] == 3
+
+@pytest.mark.django_db
+def test_session_time_budget_completes_with_a_partial_report(research_session_factory, media_root_temp_dir, settings, monkeypatch):
+    """Test that documents and a summary still running at the session deadline are cut off, not waited for."""
+    import asyncio
+    import time
+    from docx import Document as DocxDocument
+    from research_app.deadlines import DOCUMENT_TIMED_OUT_NOTE, SUMMARY_TIMED_OUT_NOTE
+    settings.SESSION_TIME_BUDGET = 1.5
+    settings.SESSION_SUMMARY_RESERVE = 0.75
+
+    async def fake_generate_async(prompt, model):
+        if "Źródło dokumentu: szybki.txt" in prompt:
+            return "Inflacja spowolniła płace."
+        await asyncio.sleep(60) # A hung request: the other document and the summary
+        return "Za późno."
+
+    monkeypatch.setattr("research_app.utils.gemini_generate_async", fake_generate_async)
+    os.makedirs(os.path.join(media_root_temp_dir, "uploads"))
+    session = research_session_factory(query="Jak inflacja wpływa na płace?")
+    for name in ("szybki.txt", "wolny.txt"):
+        with open(os.path.join(media_root_temp_dir, "uploads", name), "w", encoding="utf-8") as f:
+            f.write("Inflacja a płace w Polsce.")
+        UploadedDocument.objects.create(session=session, file=f"uploads/{name}", original_filename=name)
+
+    started = time.monotonic()
+    process_research_sync(session.session_id)
+
+    assert time.monotonic() - started < 10
+    session.refresh_from_db()
+    assert session.status == "completed" and session.deadline_at is not None
+    assert "1 document(s) not analyzed" in session.error_message and "summary incomplete" in session.error_message
+    assert session.documents.get(original_filename="szybki.txt").status == "processed"
+    assert session.documents.get(original_filename="wolny.txt").status == "timed_out"
+    paragraphs = [p.text for p in DocxDocument(session.get_report_path()).paragraphs]
+    assert DOCUMENT_TIMED_OUT_NOTE in paragraphs
+    assert any(SUMMARY_TIMED_OUT_NOTE in text for text in paragraphs)
+
+def test_hedged_call_returns_the_first_answer(settings, monkeypatch):
+    """Test that a call running past the latency percentile gets a duplicate, and the slow one is cancelled."""
+    import asyncio
+    from collections import defaultdict, deque
+    from research_app import deadlines
+    from research_app.llm import run_llm_coroutine
+
+    settings.LLM_HEDGING = True
+    settings.LLM_HEDGE_MIN_SAMPLES = 3
+    monkeypatch.setattr(deadlines, "_latencies", defaultdict(lambda: deque(maxlen=deadlines.LATENCY_WINDOW)))
+    for seconds in (0.01, 0.02, 0.05):
+        deadlines.note_latency(1000, seconds)
+    cancelled = []
+
+    async def call(primary):
+        if primary:
+            try:
+                await asyncio.sleep(60)
+            except asyncio.CancelledError:
+                cancelled.append(True)
+                raise
+        return "hedge"
+
+    assert deadlines.hedge_delay(1000) == 0.05
+    assert run_llm_coroutine(deadlines.hedged(call, 1000)) == "hedge"
+    run_llm_coroutine(asyncio.sleep(0.01)) # Let the cancellation land
+    assert cancelled == [True] and deadlines._hedges_in_flight == 0
+
+def test_extraction_stores_an_offsets_index_for_page_lookups(client, research_session_factory, media_root_temp_dir):
+    """Test that extraction stores page ranges, used by the text API and to label selected passages."""
+    from research_app.offsets import PAGE, TextOffsets
+    from research_app.passages import select_passages
+    from research_app.utils import extract_text
+
+    pages = [
+        f"--- Page {i} ---\nRozdział {i} opisuje inwestycje drogowe w powiecie numer {i}.\n"
+        f"Wydatki w roku {2000 + i} wyniosły {i * 7} milionów złotych według danych urzędu.\n"
+        for i in range(1, 41)
+    ]
+    pages[16] += "Eksport zbóż do Egiptu spadł po wprowadzeniu sankcji w tym okresie.\n"
+    os.makedirs(os.path.join(media_root_temp_dir, "uploads"))
+    with open(os.path.join(media_root_temp_dir, "uploads", "pages.txt"), "w", encoding="utf-8") as f:
+        f.write("".join(pages))
+    session = research_session_factory(query="Jak sankcje wpłynęły na eksport zbóż?")
+    doc = UploadedDocument.objects.create(session=session, file="uploads/pages.txt", original_filename="pages.txt")
+
+    text, _ = extract_text(doc)
+    doc.refresh_from_db()
+    assert doc.status == "converted" and not doc.processing_log # Kept for errors
+    offsets = TextOffsets.from_bytes(doc.text_offsets)
+    assert len(offsets) == 40 and offsets.labels[16] == "Page 17"
+    start, end = offsets.span(offsets.find(PAGE, 17))
+    assert text[start:end].startswith("--- Page 17 ---") and "Eksport zbóż" in text[start:end]
+
+    url = reverse("research_app:api_document_text", args=[session.session_id, doc.id])
+    body = client.get(url, {"page": 17}).json()
+    assert (body["label"], body["text"]) == ("Page 17", text[start:end])
+    assert client.get(url, {"at": text.index("Eksport zbóż")}).json()["label"] == "Page 17"
+    assert client.get(url, {"page": 99}).status_code == 404
+
+    # A passage starting inside page 17 carries its marker, so quotes can still be placed
+    sent = select_passages(text, "eksport zbóż sankcje", 200, chunk_chars=100, offsets=offsets)
+    assert "Eksport zbóż" in sent
+    assert sent.rindex("--- Page 17 ---") < sent.index("Eksport zbóż")
+
+def test_model_routing_by_task_and_size_with_fallback(settings, monkeypatch):
+    """Test that calls go to the model for their task and size, retries to the fallback, and latencies are recorded."""
+    from collections import defaultdict, deque
+    from research_app import routing
+    from research_app.llm import run_llm_coroutine
+    from research_app.models import ThroughputStat
+    from research_app.progress import flush_throughput_samples
+    from research_app.utils import agenerate_summary, aquery_gemini_single_doc
+
+    settings.LLM_MODEL = "big"
+    settings.LLM_SMALL_MODEL = "small"
+    settings.LLM_SMALL_PROMPT_CHARS = 5000
+    settings.LLM_SUMMARY_MODEL = "summary"
+    settings.LLM_FALLBACK_MODEL = "fallback"
+    settings.LLM_ROUTE_MIN_SAMPLES = 3
+    for name in ("_outcomes", "_latencies"):
+        monkeypatch.setattr(routing, name, defaultdict(lambda: deque(maxlen=routing.HEALTH_WINDOW_CALLS)))
+    calls = []
+
+    async def fake_generate_async(prompt, model):
+        calls.append(model)
+        if model == "small" and calls.count("small") == 1:
+            raise RuntimeError("500 Internal error")
+        return f"Answer from {model}."
+
+    monkeypatch.setattr("research_app.utils.gemini_generate_async", fake_generate_async)
+    run_llm_coroutine(aquery_gemini_single_doc("Krótka notatka.", "query", "note.txt"))
+    run_llm_coroutine(aquery_gemini_single_doc("Długi raport. " * 1000, "query", "report.txt"))
+    run_llm_coroutine(aquery_gemini_single_doc("Krótka notatka.", "query", "note.txt"))
+    summary = run_llm_coroutine(agenerate_summary("Summarize."))
+
+    assert calls == ["small", "fallback", "big", "small", "summary"] # The failed call was retried on the fallback
+    assert summary == "Answer from summary."
+    flush_throughput_samples()
+    assert ThroughputStat.objects.filter(stage="model", bucket__startswith="small ").get().samples == 1
+    assert 0 < ThroughputStat.objects.get(stage="model_errors", bucket="small").value < 1
+
+    # A model failing most of its recent calls is avoided until they age out
+    for _ in range(3):
+        routing.record_call("small", 100, 1.0, failed=True)
+    assert routing.pick_model(routing.DOCUMENT, 100) == "fallback"
+    settings.LLM_ROUTE_WINDOW_SECONDS = 0
+    assert routing.pick_model(routing.DOCUMENT, 100) == "small"
+
+def test_fair_share_scheduler_interleaves_sessions():
+    """Test that a small session isn't starved by a large batch queued before it."""
+    import asyncio
+    from research_app.scheduler import FairShareScheduler, PRIORITY_INTERACTIVE
+
+    completed = []
+
+    async def work(name):
+        await asyncio.sleep(0.001)
+        completed.append(name)
+
+    async def main():
+        scheduler = FairShareScheduler(max_concurrency=2, quantum=10)
+        batch = [scheduler.run("batch", lambda i=i: work(f"batch-{i}"), cost=10) for i in range(40)]
+        other = [scheduler.run("other", lambda i=i: work(f"other-{i}"), cost=10) for i in range(3)]
+        tasks = [asyncio.ensure_future(c) for c in batch + other]
+        await asyncio.sleep(0) # Let the batch queue up first
+        interactive = [
+            asyncio.ensure_future(scheduler.run("small", lambda i=i: work(f"small-{i}"), cost=10, priority=PRIORITY_INTERACTIVE))
+            for i in range(3)
+        ]
+        await asyncio.gather(*tasks, *interactive)
+        return scheduler
+
+    scheduler = asyncio.run(main())
+
+    # The interactive session runs ahead of the batch, and "other" shares the batch class fairly
+    assert max(completed.index(f"small-{i}") for i in range(3)) < 10
+    assert max(completed.index(f"other-{i}") for i in range(3)) < 12
+    assert scheduler.running == 0
+    assert scheduler.stats("small")["queued"] == 0
+    assert scheduler.stats("batch")["wait_max"] >= scheduler.stats("small")["wait_max"]
+
+def test_fair_share_scheduler_caps_a_session_without_idling_others():
+    """Test that a session's own max_running cap holds while other sessions use the free slots."""
+    import asyncio
+    from research_app.scheduler import FairShareScheduler
+
+    in_flight = {"capped": 0, "other": 0}
+    peak = dict(in_flight)
+
+    async def work(name):
+        in_flight[name] += 1
+        peak[name] = max(peak[name], in_flight[name])
+        await asyncio.sleep(0.001)
+        in_flight[name] -= 1
+
+    async def main():
+        scheduler = FairShareScheduler(max_concurrency=4, quantum=10)
+        await asyncio.gather(
+            *(scheduler.run("capped", lambda: work("capped"), cost=10, max_running=1) for _ in range(6)),
+            *(scheduler.run("other", lambda: work("other"), cost=10) for _ in range(6)),
+        )
+        return scheduler
+
+    scheduler = asyncio.run(main())
+    assert peak == {"capped": 1, "other": 3}
+    assert scheduler.running == 0
+
 def test_initialize_report():
     """Test initializing a report document."""
     query = "What are the key findings?"
@@ -1,5 +1,5 @@
 from django.urls import path
-from . import views
+from . import api, views
 
 app_name = 'research_app'
 
@@ -8,4 +8,9 @@ urlpatterns = [
     path('start_research/', views.start_research_session, name='start_research'),
     path('session_status/<uuid:session_id>/', views.get_session_status, name='session_status'),
     path('download_report/<uuid:session_id>/', views.download_report, name='download_report'),
+    # JSON API, see api.py
+    path('api/sessions/', api.sessions, name='api_sessions'),
+    path('api/sessions/status/', api.session_status, name='api_session_status'),
+    path('api/sessions/<uuid:session_id>/documents/', api.session_documents, name='api_session_documents'),
+    path('api/sessions/<uuid:session_id>/documents/<uuid:document_id>/text/', api.document_text, name='api_document_text'),
 ]
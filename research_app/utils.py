@@ -1,39 +1,114 @@
+import asyncio
+import json
+import logging
+import mmap
 import os
+import posixpath
+import re
+import multiprocessing
+import sys
+import tempfile
+import threading
 import time
+import zipfile
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 
-import fitz  # PyMuPDF
 from django.conf import settings
-from docx import Document as DocxDocument # Avoid confusion with Django Document
-from docx.shared import Inches
-from google import genai
-from pptx import Presentation
 
-# -- Global Variables --
+from .deadlines import TIMED_OUT, hedged, within
+from .llm import gemini_generate_async, gemini_stream_async, guard_stalls
+from .offsets import build_offsets, label_key
+from .progress import note_llm_call
+from .routing import DOCUMENT, SUMMARY, pick_model, record_call
+from .scheduler import PRIORITY_BATCH, get_scheduler
 
-GEMINI_MODEL = "gemini-2.0-flash"
-GEMINI_CLIENT = genai.Client(api_key=settings.GEMINI_API_KEY)
+logger = logging.getLogger(__name__)
+
+# The document parsers (fitz, docx, pptx, lxml) are heavy to import,
+# so they are imported inside the functions that use them. Web workers that only
+# render pages or answer status polls never load them.
 
 # --- Text Extraction ---
 
-def extract_text_from_pdf(file_path):
-    """Extracts text from a PDF file."""
+# One process pool for sharded PDF extraction, shared by every thread of this process
+_pdf_pool = None
+_pdf_pool_workers = 0
+_pdf_pool_lock = threading.Lock()
+
+def _get_pdf_pool(workers):
+    """
+    The shared PDF extraction pool, with `workers` processes. They are started with
+    forkserver (spawn where that's missing), never forked from this multithreaded
+    process, so they can't inherit a lock some other thread held at fork time.
+    """
+    global _pdf_pool, _pdf_pool_workers
+    with _pdf_pool_lock:
+        if _pdf_pool is None or _pdf_pool_workers != workers: # PDF_SHARD_WORKERS changed (benchmarks)
+            if _pdf_pool is not None:
+                _pdf_pool.shutdown(wait=False) # Shards already submitted still finish
+            method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+            _pdf_pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context(method))
+            _pdf_pool_workers = workers
+        return _pdf_pool
+
+def _drop_pdf_pool(pool):
+    """Forgets a pool that broke (a worker died), so the next extraction starts a new one."""
+    global _pdf_pool
+    with _pdf_pool_lock:
+        if _pdf_pool is pool:
+            _pdf_pool = None
+
+def _extract_pdf_page_range(file_path, start, stop):
+    """
+    Extracts pages [start, stop) of a PDF. Runs in worker processes for sharded
+    extraction, so every call opens its own fitz document.
+    """
+    import fitz  # PyMuPDF
+
+    doc = fitz.open(file_path)
     try:
-        doc = fitz.open(file_path)
-        text = ""
-        metadata = doc.metadata
-        for page_num in range(len(doc)):
+        parts = []
+        for page_num in range(start, stop):
             page = doc.load_page(page_num)
             page_text = page.get_text("text")
-             # Simple attempt to get chapter/section titles (heuristic)
-            blocks = page.get_text("blocks")
-            current_title = f"Page {page_num + 1}" # Default context
-            # Look for larger font sizes maybe indicating titles - highly heuristic
-            # A more robust solution would involve analyzing font styles, layout etc.
-            # This is a basic placeholder for context.
-            # for b in blocks:
-            #     # You might analyze b[4] (text), b[5] (font size info is complex)
-            #     pass # Add logic here if needed
-            text += f"\n--- {current_title} ---\n{page_text}\n"
+            # Section titles would need font/layout analysis; use the page number as context
+            current_title = f"Page {page_num + 1}"
+            parts.append(f"\n--- {current_title} ---\n{page_text}\n")
+        return ''.join(parts)
+    finally:
+        doc.close()
+
+def extract_text_from_pdf(file_path):
+    """
+    Extracts text from a PDF file. PDFs longer than PDF_SHARD_PAGES are split into
+    page ranges extracted in parallel worker processes and stitched back in page order.
+    All extractions share one pool of PDF_SHARD_WORKERS processes, so concurrent
+    sessions queue their shards instead of each starting their own processes.
+    """
+    import fitz  # PyMuPDF
+
+    try:
+        with fitz.open(file_path) as doc:
+            metadata = doc.metadata
+            page_count = len(doc)
+
+        shard_pages = max(1, settings.PDF_SHARD_PAGES)
+        workers = settings.PDF_SHARD_WORKERS or os.cpu_count() or 1
+        if page_count <= shard_pages or workers <= 1:
+            return _extract_pdf_page_range(file_path, 0, page_count), metadata
+
+        starts = range(0, page_count, shard_pages)
+        stops = [min(start + shard_pages, page_count) for start in starts]
+        print(f"Extracting {os.path.basename(file_path)} in {len(starts)} shards of {shard_pages} pages")
+        pool = _get_pdf_pool(workers)
+        try:
+            # map() yields results in submission order, so pages stay in order
+            text = ''.join(pool.map(_extract_pdf_page_range, [file_path] * len(starts), starts, stops))
+        except BrokenProcessPool:
+            _drop_pdf_pool(pool)
+            raise
         return text, metadata
     except Exception as e:
         print(f"Error extracting PDF {os.path.basename(file_path)}: {e}")
@@ -41,6 +116,8 @@ def extract_text_from_pdf(file_path):
 
 def extract_text_from_docx(file_path):
     """Extracts text and attempts to identify headings from a DOCX file."""
+    from docx import Document as DocxDocument # Avoid confusion with Django Document
+
     try:
         doc = DocxDocument(file_path)
         text = ""
@@ -61,6 +138,8 @@ def extract_text_from_docx(file_path):
 
 def extract_text_from_pptx(file_path):
     """Extracts text from a PPTX file, including slide titles."""
+    from pptx import Presentation
+
     try:
         prs = Presentation(file_path)
         text = ""
@@ -90,6 +169,181 @@ def extract_text_from_pptx(file_path):
         print(f"Error extracting PPTX {os.path.basename(file_path)}: {e}")
         return None, None
 
+# --- Fast-path OOXML Extraction ---
+# These stream the XML parts straight out of the zip with lxml.etree.iterparse instead
+# of building the python-docx / python-pptx object models. They produce the same
+# section/slide markers; extract_text falls back to the object-model extractors above
+# if they fail.
+
+W_NS = 'http://schemas.openxmlformats.org/wordprocessingml/2006/main'
+A_NS = 'http://schemas.openxmlformats.org/drawingml/2006/main'
+P_NS = 'http://schemas.openxmlformats.org/presentationml/2006/main'
+R_NS = 'http://schemas.openxmlformats.org/officeDocument/2006/relationships'
+PKG_REL_NS = 'http://schemas.openxmlformats.org/package/2006/relationships'
+
+def _release(elem):
+    """Frees an iterparse element and its already-processed siblings."""
+    elem.clear()
+    while elem.getprevious() is not None:
+        del elem.getparent()[0]
+
+def _docx_paragraph_text(p_elem):
+    """Joins the runs of a w:p element, honouring tabs and line breaks."""
+    parts = []
+    for node in p_elem.iter(f'{{{W_NS}}}t', f'{{{W_NS}}}tab', f'{{{W_NS}}}br'):
+        if node.tag == f'{{{W_NS}}}t':
+            parts.append(node.text or '')
+        elif node.tag == f'{{{W_NS}}}tab':
+            parts.append('\t')
+        else:
+            parts.append('\n')
+    return ''.join(parts)
+
+def _docx_style_names(zf):
+    """Maps DOCX style ids (e.g. 'Heading1') to style names (e.g. 'Heading 1')."""
+    from lxml import etree
+
+    try:
+        styles_xml = zf.read('word/styles.xml')
+    except KeyError:
+        return {}
+    root = etree.fromstring(styles_xml)
+    names = {}
+    for style in root.iter(f'{{{W_NS}}}style'):
+        name = style.find(f'{{{W_NS}}}name')
+        if name is not None:
+            names[style.get(f'{{{W_NS}}}styleId')] = name.get(f'{{{W_NS}}}val')
+    return names
+
+def extract_text_from_docx_fast(file_path):
+    """Streams text, headings and tables out of word/document.xml."""
+    from lxml import etree
+
+    try:
+        with zipfile.ZipFile(file_path) as zf:
+            style_names = _docx_style_names(zf)
+            text_parts = []
+            table_depth = 0
+            with zf.open('word/document.xml') as xml_file:
+                events = etree.iterparse(
+                    xml_file,
+                    events=('start', 'end'),
+                    tag=(f'{{{W_NS}}}p', f'{{{W_NS}}}tbl', f'{{{W_NS}}}tr'),
+                )
+                for event, elem in events:
+                    if elem.tag == f'{{{W_NS}}}tbl':
+                        table_depth += 1 if event == 'start' else -1
+                        if event == 'end' and table_depth == 0:
+                            _release(elem)
+                    elif event == 'start':
+                        continue
+                    elif elem.tag == f'{{{W_NS}}}tr' and table_depth == 1:
+                        # One line per table row, cells separated by pipes
+                        cells = []
+                        for tc in elem.iterchildren(f'{{{W_NS}}}tc'):
+                            cell_text = ' '.join(
+                                _docx_paragraph_text(p).strip() for p in tc.iter(f'{{{W_NS}}}p')
+                            ).strip()
+                            cells.append(cell_text)
+                        if any(cells):
+                            text_parts.append(' | '.join(cells) + '\n')
+                        _release(elem)
+                    elif elem.tag == f'{{{W_NS}}}p' and table_depth == 0:
+                        para_text = _docx_paragraph_text(elem)
+                        style = elem.find(f'{{{W_NS}}}pPr/{{{W_NS}}}pStyle')
+                        style_id = style.get(f'{{{W_NS}}}val') if style is not None else None
+                        style_name = style_names.get(style_id, style_id) or ''
+                        if style_name.startswith('Heading') or style_name.startswith('heading'):
+                            heading = para_text.strip()
+                            if heading:
+                                text_parts.append(f"\n--- Section: {heading} ---\n")
+                        elif para_text.strip():
+                            text_parts.append(f"{para_text}\n")
+                        _release(elem)
+        return ''.join(text_parts), {"title": os.path.basename(file_path)}
+    except Exception as e:
+        print(f"Fast DOCX extraction failed for {os.path.basename(file_path)}: {e}")
+        return None, None
+
+def _ooxml_rels(zf, part_name):
+    """Returns {rId: (type, target part name)} for an OOXML part."""
+    from lxml import etree
+
+    part_dir, part_file = posixpath.split(part_name)
+    rels_name = posixpath.join(part_dir, '_rels', f'{part_file}.rels')
+    try:
+        root = etree.fromstring(zf.read(rels_name))
+    except KeyError:
+        return {}
+    rels = {}
+    for rel in root.iter(f'{{{PKG_REL_NS}}}Relationship'):
+        target = posixpath.normpath(posixpath.join(part_dir, rel.get('Target')))
+        rels[rel.get('Id')] = (rel.get('Type'), target)
+    return rels
+
+def _pptx_shape_texts(zf, part_name):
+    """Streams a slide/notes part, yielding (placeholder type, text) per shape."""
+    from lxml import etree
+
+    with zf.open(part_name) as xml_file:
+        for _, sp in etree.iterparse(xml_file, events=('end',), tag=f'{{{P_NS}}}sp'):
+            ph = sp.find(f'{{{P_NS}}}nvSpPr/{{{P_NS}}}nvPr/{{{P_NS}}}ph')
+            ph_type = ph.get('type', 'body') if ph is not None else None
+            paragraphs = []
+            for para in sp.iter(f'{{{A_NS}}}p'):
+                parts = []
+                for node in para.iter(f'{{{A_NS}}}t', f'{{{A_NS}}}br'):
+                    if node.tag == f'{{{A_NS}}}t':
+                        parts.append(node.text or '')
+                    else:
+                        parts.append('\n')
+                paragraphs.append(''.join(parts))
+            yield ph_type, '\n'.join(paragraphs).strip()
+            _release(sp)
+
+def extract_text_from_pptx_fast(file_path):
+    """Streams slide and notes text out of the PPTX slide XML parts."""
+    from lxml import etree
+
+    try:
+        with zipfile.ZipFile(file_path) as zf:
+            pres_rels = _ooxml_rels(zf, 'ppt/presentation.xml')
+            pres_root = etree.fromstring(zf.read('ppt/presentation.xml'))
+            slide_parts = [
+                pres_rels[sld_id.get(f'{{{R_NS}}}id')][1]
+                for sld_id in pres_root.iter(f'{{{P_NS}}}sldId')
+            ]
+
+            text_parts = []
+            for i, slide_part in enumerate(slide_parts):
+                slide_title = f"Slide {i + 1}"
+                title_found = False
+                shape_texts = []
+                for ph_type, shape_text in _pptx_shape_texts(zf, slide_part):
+                    if ph_type in ('title', 'ctrTitle') and not title_found:
+                        slide_title = f"Slide {i + 1}: {shape_text}"
+                        title_found = True
+                    if shape_text:
+                        shape_texts.append(f"{shape_text}\n")
+
+                text_parts.append(f"\n--- {slide_title} ---\n")
+                text_parts.extend(shape_texts)
+
+                # Extract text from the notes slide body placeholder if present
+                for rel_type, target in _ooxml_rels(zf, slide_part).values():
+                    if rel_type.endswith('/notesSlide'):
+                        notes_text = '\n'.join(
+                            shape_text for ph_type, shape_text in _pptx_shape_texts(zf, target)
+                            if ph_type == 'body' and shape_text
+                        )
+                        if notes_text:
+                            text_parts.append(f"\n--- Notes for {slide_title} ---\n{notes_text}\n")
+
+        return ''.join(text_parts), {"title": os.path.basename(file_path)}
+    except Exception as e:
+        print(f"Fast PPTX extraction failed for {os.path.basename(file_path)}: {e}")
+        return None, None
+
 def extract_text_from_txt(file_path):
     """Extracts text from a TXT file."""
     try:
@@ -100,6 +354,158 @@ def extract_text_from_txt(file_path):
         print(f"Error reading TXT {os.path.basename(file_path)}: {e}")
         return None, None
 
+# --- Text Normalization ---
+
+# Lines such as "--- Page 3 ---" or "--- Slide 2: Intro ---" added by the extractors
+MARKER_LINE_RE = re.compile(r'^--- .+ ---$')
+BOILERPLATE_MIN_UNITS = 3 # Need at least this many pages/slides to call a line "repeated"
+BOILERPLATE_RATIO = 0.5 # Line must appear on this fraction of pages/slides to be dropped
+
+DIGITS_RE = re.compile(r'\d+')
+# What a page number looks like on its own line (lowercased): "3", "- 3 -", "page 3", "strona 3 z 10", "3 of 10", "3/10"
+PAGE_NUMBER_RE = re.compile(
+    r'^(?:(?:page|strona|str\.|s\.|p\.|slide|slajd) ?)?[-–—(\[]? ?(\d+) ?[-–—)\]]?(?: ?(?:of|z|/) ?\d+)?$'
+)
+TOP, BOTTOM = 'top', 'bottom'
+
+def _boilerplate_key(line):
+    """Normalizes a line for repetition counting (case and spacing only, so different numbers stay different)."""
+    return ' '.join(line.lower().split())
+
+def _page_number_key(key):
+    """
+    The key with its numbers as wildcards, and its page number, for lines that are
+    nothing but a page number ("3", "Page 3", "Strona 3 z 10", "3 of 10"); None for
+    anything else, so headings like "Q3 revenue" or "Step 4" never qualify.
+    """
+    match = PAGE_NUMBER_RE.match(key)
+    if not match:
+        return None
+    return DIGITS_RE.sub('#', key), int(match.group(1))
+
+def _iter_lines(text):
+    """Yields the lines of text without building a list of all of them."""
+    start = 0
+    while True:
+        end = text.find('\n', start)
+        if end == -1:
+            yield text[start:]
+            return
+        yield text[start:end]
+        start = end + 1
+
+def _iter_units(text):
+    """Yields the lines of each page/slide (split at the extractor markers) as a list; markers are units of their own."""
+    unit = []
+    for line in _iter_lines(text):
+        if MARKER_LINE_RE.match(line.strip()):
+            yield unit
+            yield [line]
+            unit = []
+        else:
+            unit.append(line)
+    yield unit
+
+def _iter_pages(text):
+    """
+    Yields (unit, page index) for the units of text. The index is the number in the
+    marker before the unit ("--- Page 7 ---", "--- Slide 7: ... ---"), else its position
+    among the non-empty units; None for marker and empty units.
+    """
+    position = 0
+    marked = None
+    for unit in _iter_units(text):
+        if len(unit) == 1 and MARKER_LINE_RE.match(unit[0].strip()):
+            key = label_key(unit[0].strip()[4:-4].strip())
+            marked = int(key[1]) if key is not None and key[1].isdigit() else None
+            yield unit, None
+        elif any(line.strip() for line in unit):
+            position += 1
+            yield unit, marked if marked is not None else position
+            marked = None
+        else:
+            yield unit, None
+
+def _edge_lines(unit):
+    """{index in unit: TOP/BOTTOM} for the first and last non-empty line of a page/slide."""
+    filled = [i for i, line in enumerate(unit) if line.strip()]
+    if not filled:
+        return {}
+    return {filled[-1]: BOTTOM, filled[0]: TOP} # A one-line unit counts as its top
+
+def _utf8_len(text):
+    return len(text) if text.isascii() else len(text.encode('utf-8'))
+
+def normalize_extracted_text(text):
+    """
+    Removes running headers, footers, page numbers and slide-master text, then
+    collapses whitespace runs. A line is dropped as boilerplate if the exact
+    same line (ignoring case and spacing) occurs on most pages/slides, or if it
+    is a page number: a first or last line that is nothing but a number ("3",
+    "Page 3", "3 of 10") and either equals the page's index or has that form at
+    the same edge of most pages. Lines that only share their wording, like table
+    rows, totals or numbered headings, are kept. The first occurrence of every
+    repeated line is kept, so no content is lost.
+    Returns the normalized text and the number of bytes saved.
+    """
+    if not text:
+        return text, 0
+
+    # Count on how many units (pages/slides) each line occurs, and how often each
+    # page number form occurs at each edge: (edge, wildcard key) -> units
+    counts = Counter()
+    numbered = Counter()
+    unit_count = 0
+    for unit, page in _iter_pages(text):
+        if page is None:
+            continue
+        counts.update({_boilerplate_key(line) for line in unit if line.strip()})
+        unit_count += 1
+        for index, edge in _edge_lines(unit).items():
+            page_number = _page_number_key(_boilerplate_key(unit[index]))
+            if page_number is not None:
+                numbered[edge, page_number[0]] += 1
+
+    repeated, page_number_forms = set(), set()
+    if unit_count >= BOILERPLATE_MIN_UNITS:
+        threshold = max(BOILERPLATE_MIN_UNITS, BOILERPLATE_RATIO * unit_count)
+        repeated = {key for key, count in counts.items() if count >= threshold}
+        page_number_forms = {key for key, count in numbered.items() if count >= threshold}
+    del counts
+
+    normalized = text
+    if repeated or (unit_count >= BOILERPLATE_MIN_UNITS and numbered):
+        kept = []
+        seen = set()
+        for unit, page in _iter_pages(text):
+            edges = _edge_lines(unit) if page is not None and numbered else {}
+            for index, line in enumerate(unit):
+                stripped = line.strip()
+                if stripped and not MARKER_LINE_RE.match(stripped):
+                    key = _boilerplate_key(stripped)
+                    if key not in repeated:
+                        page_number = _page_number_key(key) if index in edges else None
+                        key = (edges[index], page_number[0]) if page_number else None
+                        if key is not None and key not in page_number_forms and page_number[1] != page:
+                            key = None
+                    if key is not None:
+                        if key in seen:
+                            continue # Drop every repeat after the first one
+                        seen.add(key)
+                kept.append(line)
+        normalized = '\n'.join(kept)
+        del kept
+    del numbered
+
+    # Collapse horizontal whitespace runs, trim line ends and collapse blank line runs
+    # (substring checks first: these regexes are slow on multi-MB texts)
+    if '  ' in normalized or '\t' in normalized or '\u00a0' in normalized:
+        normalized = re.sub(r'[ \t\u00a0]{2,}|[\t\u00a0]', ' ', normalized)
+    normalized = normalized.replace(' \n', '\n')
+    normalized = re.sub(r'\n\n\n+', '\n\n', normalized)
+    bytes_saved = _utf8_len(text) - _utf8_len(normalized)
+    return normalized, bytes_saved
+
 def extract_text(document_obj):
     """Main text extraction dispatcher."""
     file_path = document_obj.file.path
@@ -113,9 +519,13 @@ def extract_text(document_obj):
     if extension == '.pdf':
         text, metadata = extract_text_from_pdf(file_path)
     elif extension == '.docx':
-        text, metadata = extract_text_from_docx(file_path)
+        text, metadata = extract_text_from_docx_fast(file_path)
+        if text is None: # Fall back to the python-docx object model
+            text, metadata = extract_text_from_docx(file_path)
     elif extension == '.pptx':
-        text, metadata = extract_text_from_pptx(file_path)
+        text, metadata = extract_text_from_pptx_fast(file_path)
+        if text is None: # Fall back to the python-pptx object model
+            text, metadata = extract_text_from_pptx(file_path)
     elif extension == '.txt':
         text, metadata = extract_text_from_txt(file_path)
     else:
@@ -126,7 +536,13 @@ def extract_text(document_obj):
         return None # Indicate failure
 
     if text:
+        # Strip repeated page furniture before the text reaches the prompt
+        text, bytes_saved = normalize_extracted_text(text)
+        # A statistic, not a problem: processing_log is kept for errors
+        logger.info(f"Normalization saved {bytes_saved} bytes for: {document_obj.original_filename}")
         document_obj.extracted_text = text # Save extracted text if desired (can be large)
+        # Where its pages/sections/slides are, so nothing has to scan the text for them again
+        document_obj.text_offsets = build_offsets(text).to_bytes()
         document_obj.status = 'converted'
         print(f"Extraction successful for: {document_obj.original_filename}")
     else:
@@ -137,16 +553,97 @@ def extract_text(document_obj):
     document_obj.save()
     return text, metadata # Return text for immediate use
 
+# --- Memory Budget ---
+
+# Maximum characters of document text / combined answers sent in a single prompt
+PROMPT_TEXT_CHARS = 1_000_000
+SUMMARY_TEXT_CHARS = 100_000
+
+class SpilledText:
+    """
+    Text kept in an anonymous temporary file instead of RAM. Prompts read only the
+    slice they need back through a memory map, so the full text is never loaded.
+    """
+
+    def __init__(self, text=''):
+        self._file = tempfile.TemporaryFile()
+        self.size = 0 # Size in bytes (UTF-8)
+        if text:
+            self.append(text)
+
+    def append(self, text):
+        data = text.encode('utf-8')
+        self._file.seek(0, os.SEEK_END)
+        self._file.write(data)
+        self.size += len(data)
+
+    def head(self, max_chars):
+        """Returns at most the first max_chars characters."""
+        if not self.size:
+            return ''
+        self._file.flush()
+        with mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            # A character is at most 4 bytes in UTF-8; a split last character is dropped
+            return mm[:max_chars * 4].decode('utf-8', errors='ignore')[:max_chars]
+
+    def close(self):
+        self._file.close()
+
+def text_size(text):
+    """Approximate size of a str or SpilledText (characters or bytes)."""
+    if isinstance(text, SpilledText):
+        return text.size
+    return len(text) if text else 0
+
+def text_head(text, max_chars):
+    """Returns the first max_chars characters of a str or SpilledText."""
+    if isinstance(text, SpilledText):
+        return text.head(max_chars)
+    return text[:max_chars]
+
+class SessionMemoryBudget:
+    """
+    Tracks how much extracted text a session keeps in memory. Texts that would
+    exceed SESSION_MEMORY_BUDGET_BYTES are spilled to memory-mapped temp files.
+    """
+
+    def __init__(self, budget_bytes=None):
+        self.budget_bytes = budget_bytes if budget_bytes is not None else settings.SESSION_MEMORY_BUDGET_BYTES
+        self.used_bytes = 0
+        self.spilled_count = 0
+
+    def hold(self, text):
+        """Returns the text itself if it fits in the budget, otherwise a SpilledText."""
+        size = sys.getsizeof(text)
+        if self.used_bytes + size <= self.budget_bytes:
+            self.used_bytes += size
+            return text
+        self.spilled_count += 1
+        return SpilledText(text)
+
+    def release(self, text):
+        """Gives back the budget held by text (or deletes its spill file)."""
+        if isinstance(text, SpilledText):
+            text.close()
+        elif text is not None:
+            self.used_bytes = max(0, self.used_bytes - sys.getsizeof(text))
+
 # --- Gemini Interaction ---
 
-def query_gemini_single_doc(text, query, filename):
-    """Queries Gemini model for an answer within a single document's text."""
-    if not GEMINI_MODEL:
-        return "Error: Gemini model not configured.", ""
-    if not text or not text.strip():
-         return "Document contains no extractable text.", ""
+def build_single_doc_prompt(text, query, filename, metadata=None):
+    """
+    Builds the per-document prompt, or returns None if there is no text to analyse.
+    text may be a str or a SpilledText; only the part that fits in the prompt is read.
+    """
+    if not text:
+        return None
+    document_text = text_head(text, PROMPT_TEXT_CHARS)
+    if not document_text.strip():
+        return None
+    if metadata is not None:
+        document_text = f"Metadata: {json.dumps(metadata)}\n\nText: {document_text}"
 
-    prompt = f"""
+    return f"""
     Źródło dokumentu: {filename}
 
     Przeanalizuj następujący tekst dokumentu wyłącznie na podstawie podanego tekstu.
@@ -161,42 +658,18 @@ def query_gemini_single_doc(text, query, filename):
 
     Tekst dokumentu:
     --- POCZĄTEK TEKSTU ---
-    {text[:1_000_000]}
+    {document_text}
     --- KONIEC TEKSTU ---
 
     Twoja odpowiedź:
     """
 
-    # Simple retry mechanism
-    max_retries = 2
-    for attempt in range(max_retries):
-        try:
-            response = GEMINI_CLIENT.models.generate_content(
-                model=GEMINI_MODEL,
-                contents=prompt,
-            )
-            answer_text = response.text.strip()
-
-            # Extract quotes for structured data (optional, mainly for summary prompt)
-            quotes = [q.strip() for q in answer_text.split('"') if q.strip() and len(q) > 5] # Simple extraction
-            return answer_text, quotes
-
-        except Exception as e:
-            print(f"Gemini API error (Attempt {attempt + 1}/{max_retries}) on {filename}: {e}")
-            if "quota" in str(e).lower() or "rate limit" in str(e).lower():
-                 time.sleep(5 * (attempt + 1)) # Exponential backoff for rate limits
-            elif attempt == max_retries - 1:
-                return f"Error: Failed to get response from LLM after {max_retries} attempts. Last error: {e}", []
-            time.sleep(2) # General delay between retries
-    return f"Error: Failed to get response from LLM after {max_retries} attempts.", []
-
-
-def query_gemini_summary(all_answers_text, query):
-    """Generates a summary answer based on findings from all documents."""
-    if not GEMINI_MODEL:
-        return "Error: Gemini model not configured."
-
-    prompt = f"""
+def build_summary_prompt(all_answers_text, query):
+    """
+    Builds the synthesis prompt from the per-document answers.
+    all_answers_text may be a str or a SpilledText; the combined text is capped for safety.
+    """
+    return f"""
     Opracuj syntetyczną odpowiedź na pytanie: "{query}"
 
     Podstaw swoją syntezę wyłącznie na podstawie podanych wyników, które zostały wyciągnięte z różnych dokumentów.
@@ -211,35 +684,171 @@ def query_gemini_summary(all_answers_text, query):
 
     Wyniki z dokumentów:
     --- POCZĄTEK WYNIKÓW ---
-    {all_answers_text[:100000]}
+    {text_head(all_answers_text, SUMMARY_TEXT_CHARS)}
     --- KONIEC WYNIKÓW ---
 
     Twoja odpowiedź:
     """
-    # Limit combined text size for safety
+
+def build_merge_prompt(material_text, query):
+    """
+    Builds the final prompt of an incremental summary (see summary.py): partial
+    syntheses of groups of documents, plus answers no partial covers yet.
+    """
+    return f"""
+    Połącz częściowe syntezy w jedną syntetyczną odpowiedź na pytanie: "{query}"
+
+    Każda częściowa synteza obejmuje inną grupę dokumentów. Poniżej mogą się też znajdować wyniki pojedynczych dokumentów, których nie obejmuje jeszcze żadna synteza.
+
+    Instrukcje:
+    1. Utwórz zwięzłą syntezę, która bezpośrednio odpowiada na pytanie i obejmuje wszystkie grupy dokumentów.
+    2. Zachowaj odwołania do konkretnych dokumentów (np. "Zgodnie z 'raport.pdf'...").
+    3. Jeśli różne dokumenty dostarczają sprzecznych informacji, uwzględnij te sprzeczności.
+    4. Jeśli żaden z dokumentów nie zawierał informacji dotyczących pytania, wyraźnie stwierdź to.
+    5. Nie dodawaj informacji, które nie są obecne w podanych materiałach.
+
+    Częściowe syntezy i wyniki:
+    --- POCZĄTEK WYNIKÓW ---
+    {text_head(material_text, SUMMARY_TEXT_CHARS)}
+    --- KONIEC WYNIKÓW ---
+
+    Twoja odpowiedź:
+    """
+
+# "straight", „Polish” and “curly” quotes
+QUOTE_RE = re.compile(r'"([^"]+)"|„([^”"]+)[”"]|“([^”]+)”')
+
+def extract_quotes(answer_text):
+    """Pulls "quoted" fragments out of an answer (mainly for the summary prompt)."""
+    quotes = (''.join(groups).strip() for groups in QUOTE_RE.findall(answer_text))
+    return [q for q in quotes if len(q) > 5]
+
+def _is_rate_limit_error(error):
+    message = str(error).lower()
+    return "quota" in message or "rate limit" in message or "429" in message
+
+# --- Async Gemini Interaction ---
+# Calls go over the pooled httpx transport in research_app.llm, so many document
+# queries can be in flight on one event loop; sync code runs them with run_llm_coroutine.
+# Responses are streamed; on_text(text so far) sees the answer as it is generated.
+# Each attempt has a deadline and may be hedged (see deadlines.py), and goes to the
+# model routing.py picks for it.
+
+async def _agenerate(prompt, model, on_text=None):
+    """The response to prompt, streamed unless LLM_STREAMING is off. A stalled stream raises LLMStreamStalled."""
+    if not settings.LLM_STREAMING:
+        return await gemini_generate_async(prompt, model)
+    parts = []
+    async for chunk in guard_stalls(gemini_stream_async(prompt, model)):
+        parts.append(chunk)
+        if on_text is not None:
+            on_text(''.join(parts))
+    return ''.join(parts)
+
+async def _agenerate_attempt(prompt, task, attempt, on_text=None):
+    """
+    One call attempt on the model routed for it: hedged if it runs long, and cut
+    off after LLM_CALL_TIMEOUT seconds. The outcome is recorded for the routing.
+    """
+    model = pick_model(task, len(prompt), attempt)
+    started = time.monotonic()
+    try:
+        # Only the primary request streams into on_text, so a hedge can't interleave its text
+        call = hedged(lambda primary: _agenerate(prompt, model, on_text if primary else None), len(prompt))
+        text = await asyncio.wait_for(call, settings.LLM_CALL_TIMEOUT or None)
+    except Exception:
+        record_call(model, len(prompt), time.monotonic() - started, failed=True)
+        raise
+    record_call(model, len(prompt), time.monotonic() - started)
+    return text
+
+async def aquery_gemini_single_doc(text, query, filename, metadata=None, on_text=None):
+    """Queries Gemini for an answer within a single document's text. Returns (answer, quotes)."""
+    if not settings.LLM_MODEL:
+        return "Error: Gemini model not configured.", ""
+    prompt = build_single_doc_prompt(text, query, filename, metadata)
+    if prompt is None:
+         return "Document contains no extractable text.", ""
+
+    max_retries = 2
+    for attempt in range(max_retries):
+        try:
+            started = time.monotonic()
+            answer_text = (await _agenerate_attempt(prompt, DOCUMENT, attempt, on_text)).strip()
+            note_llm_call(len(prompt), time.monotonic() - started)
+            return answer_text, extract_quotes(answer_text)
+        except Exception as e:
+            print(f"Gemini API error (Attempt {attempt + 1}/{max_retries}) on {filename}: {e}")
+            if _is_rate_limit_error(e):
+                 await asyncio.sleep(5 * (attempt + 1))
+            elif attempt == max_retries - 1:
+                return f"Error: Failed to get response from LLM after {max_retries} attempts. Last error: {e}", []
+            await asyncio.sleep(2)
+    return f"Error: Failed to get response from LLM after {max_retries} attempts.", []
+
+async def aquery_gemini_summary(all_answers_text, query, on_text=None):
+    """Generates a summary answer based on findings from all documents."""
+    return await agenerate_summary(build_summary_prompt(all_answers_text, query), on_text)
+
+async def agenerate_summary(prompt, on_text=None):
+    """Runs a summary or merge prompt with the summary retry policy."""
+    if not settings.LLM_MODEL:
+        return "Error: Gemini model not configured."
 
     max_retries = 2
     for attempt in range(max_retries):
-         try:
-            response = GEMINI_CLIENT.models.generate_content(
-                model=GEMINI_MODEL,
-                contents=prompt,
-            )
-            return response.text.strip()
-         except Exception as e:
+        try:
+            return (await _agenerate_attempt(prompt, SUMMARY, attempt, on_text)).strip()
+        except Exception as e:
             print(f"Gemini API error during summary (Attempt {attempt + 1}/{max_retries}): {e}")
-            if "quota" in str(e).lower() or "rate limit" in str(e).lower():
-                 time.sleep(5 * (attempt + 1))
+            if _is_rate_limit_error(e):
+                 await asyncio.sleep(5 * (attempt + 1))
             elif attempt == max_retries - 1:
                 return f"Error: Failed to get summary response from LLM after {max_retries} attempts. Last error: {e}"
-            time.sleep(2)
+            await asyncio.sleep(2)
     return f"Error: Failed to get summary response from LLM after {max_retries} attempts."
 
+async def aquery_documents(items, query, session_key=None, priority=PRIORITY_BATCH, on_result=None, on_text=None,
+                           timeout=None, max_running=None):
+    """
+    Queries Gemini for many documents concurrently. items is a list of
+    (text, filename, metadata) tuples; the (answer, quotes) results are returned in
+    the same order. Requests go through the fair-share scheduler, which caps
+    in-flight LLM calls across all sessions and interleaves them fairly.
+    on_result(index, result), if given, is called on the event loop as each document finishes,
+    and on_text(index, text so far) as its answer streams in. Documents not answered
+    within timeout seconds (queueing and retries included) get (TIMED_OUT, []).
+    max_running caps this session's in-flight calls below the global cap.
+    """
+    scheduler = get_scheduler()
+    session_key = session_key if session_key is not None else object()
+
+    async def _query(index, text, filename, metadata):
+        result = await within(scheduler.run(
+            session_key,
+            lambda: aquery_gemini_single_doc(
+                text, query, filename, metadata=metadata,
+                on_text=None if on_text is None else lambda partial: on_text(index, partial),
+            ),
+            cost=text_size(text),
+            priority=priority,
+            max_running=max_running,
+        ), timeout)
+        if result == TIMED_OUT:
+            result = (TIMED_OUT, [])
+        elif on_result is not None:
+            on_result(index, result)
+        return result
+
+    return await asyncio.gather(*(_query(index, *item) for index, item in enumerate(items)))
+
 
 # --- Docx Generation ---
 
 def initialize_report(query):
     """Creates a new docx document and adds initial title and query."""
+    from docx import Document as DocxDocument
+
     doc = DocxDocument()
     doc.add_heading(f'Raport dotyczący pytania: "{query}"', level=0)
     doc.add_paragraph(query)
@@ -256,6 +865,12 @@ def add_answer_to_report(doc, filename, answer_text):
     doc.add_paragraph("---")
     doc.add_paragraph() # Add some space
 
+def add_unverified_quotes_to_report(doc, quotes):
+    """Flags quotes from an answer that could not be found in the source document."""
+    paragraph = doc.add_paragraph()
+    paragraph.add_run("Uwaga: nie znaleziono w dokumencie cytatów: ").bold = True
+    paragraph.add_run("; ".join(f'"{quote}"' for quote in quotes))
+
 def add_summary_to_report(doc, summary_text):
     """Adds the final summary section to the report."""
     doc.add_heading('Odpowiedź syntetyczna', level=1)
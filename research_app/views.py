@@ -1,24 +1,48 @@
+import asyncio
 import logging
-from django.shortcuts import render, redirect, get_object_or_404
-from django.http import JsonResponse, HttpResponse, FileResponse, HttpResponseBadRequest, HttpResponseServerError
+import mimetypes
+from asgiref.sync import sync_to_async
+from django.shortcuts import render, aget_object_or_404
+from django.http import HttpResponse, FileResponse, HttpResponseBadRequest, HttpResponseServerError, StreamingHttpResponse
+from django.utils.http import content_disposition_header
+from django.utils import timezone
 from django.conf import settings
-from django.urls import reverse
 from django.views.decorators.http import require_POST, require_GET
-from django.views.decorators.csrf import csrf_exempt # Use carefully, consider alternatives if needed
-import json
 import os
 import time # For simulating delays if not using Celery
 
 from .models import ResearchSession, UploadedDocument
 from .forms import ResearchForm
+from .admission import (
+    ADMIT, QUEUE, REJECT, admit_session, aqueue_position, decide_admission, estimate_tokens, processes_in_process, start_session_processing,
+)
+from .deadlines import (
+    DOCUMENT_TIMED_OUT_NOTE, SUMMARY_TIMED_OUT_NOTE, TIMED_OUT, documents_seconds_left, seconds_left, session_deadline, within,
+)
+from .llm import run_llm_coroutine, submit_llm_coroutine, wait_llm_futures
+from .scheduler import PRIORITY_BATCH, PRIORITY_INTERACTIVE, aget_queue_stats, get_queue_stats
+from .profiling import profile_session
+from .progress import aload_throughput_stats, estimate_progress, flush_throughput_samples, note_extraction
+from .offsets import TextOffsets
+from .passages import prompt_text
+from .quotes import unverified_quotes, verify_quotes
+from .relevance import RelevanceScreen, skipped_answer
+from .storage import release_blob, store_upload
+from .streaming import DOCUMENT, SESSION, LiveText
+from .summary import IncrementalSummarizer, format_answer
 from .utils import (
+    PROMPT_TEXT_CHARS,
+    SessionMemoryBudget,
+    SpilledText,
     add_answer_to_report,
     add_summary_to_report,
+    add_unverified_quotes_to_report,
+    aquery_documents,
+    aquery_gemini_summary,
     extract_text,
     initialize_report,
-    query_gemini_single_doc,
-    query_gemini_summary,
     save_report,
+    text_head,
 )
 
 # Create logger
@@ -27,45 +51,90 @@ logger = logging.getLogger(__name__)
 def index(request):
     """Displays the main upload form."""
     form = ResearchForm()
-    return render(request, 'research_app/index.html', {'form': form})
-
-@require_POST # Only allow POST requests
-def start_research_session(request):
-    """Handles form submission, creates session, saves files, and starts processing."""
-    form = ResearchForm(request.POST, request.FILES)
+    # ?profile=1 makes the upload run under the profiler (see profiling.py)
+    return render(request, 'research_app/index.html', {'form': form, 'profile': request.GET.get('profile') == '1'})
 
-    if form.is_valid():
-        query = form.cleaned_data['query']
-        uploaded_files = form.cleaned_data['documents'] # Already validated list of files
+async def acreate_research_session(query, uploaded_files, profile=False, analyze_all=False):
+    """Admits a submission, creating its session and documents, and starts it if admitted.
 
-        # 1. Create Research Session
-        session = ResearchSession.objects.create(query=query)
-
-        # 2. Create UploadedDocument entries
-        for uploaded_file in uploaded_files:
-            # Sanitize filename (optional but good practice)
+    Returns (session, queue_position); session is None if the submission was rejected,
+    queue_position is None unless the session was queued.
+    """
+    # 0. Admission control: a quick check first, so a busy server doesn't store files it turns away
+    if await sync_to_async(decide_admission)(uploaded_files) == REJECT:
+        return None, None
+
+    # 1. Store the files; stored once by content, identical uploads share the blob file
+    blobs = [await sync_to_async(store_upload)(uploaded_file) for uploaded_file in uploaded_files]
+
+    # 2. Create the Research Session and its UploadedDocument entries with the binding decision
+    def create_session(decision):
+        session = ResearchSession.objects.create(
+            query=query,
+            status='queued' if decision == QUEUE else 'pending',
+            in_process=decision == ADMIT and processes_in_process(),
+            profile_requested=profile,
+            analyze_all=analyze_all,
+        )
+        for uploaded_file, blob in zip(uploaded_files, blobs):
             original_filename = uploaded_file.name
             doc = UploadedDocument.objects.create(
                 session=session,
-                file=uploaded_file,
+                file=blob.file.name,
+                blob=blob,
                 original_filename=original_filename,
-                status='uploaded'
+                status='uploaded',
+                file_size=uploaded_file.size,
+                estimated_tokens=estimate_tokens(original_filename, uploaded_file.size),
             )
             logger.info(f"Saved document record: {doc.id} for session {session.session_id}")
+        return session
+
+    decision, session = await sync_to_async(admit_session)(uploaded_files, create_session)
+    if session is None:
+        # Others got in between the two checks; give back the blob references
+        for blob in blobs:
+            await sync_to_async(release_blob)(blob.pk)
+        return None, None
+
+    # 3. Trigger background processing
+    # ****** PRODUCTION NOTE ******
+    # Sessions run on an in-process thread pool (see admission.py). In production,
+    # replace it with a task queue, e.g. process_research_task.delay(session.session_id)
+    # ****************************
+    queue_position = None
+    if decision == ADMIT:
+        logger.info(f"Starting background processing for session {session.session_id}...")
+        start_session_processing(session.session_id)
+    else:
+        queue_position = await aqueue_position(session)
+        logger.info(f"Session {session.session_id} queued at position {queue_position}")
+    return session, queue_position
 
 
-        # 3. Trigger background processing (Simulated Synchronously Here)
-        # ****** PRODUCTION NOTE ******
-        # In production, replace the direct call below with:
-        # process_research_task.delay(session.session_id)
-        # You'd need to define this Celery task in tasks.py
-        # ****************************
-        logger.info(f"Starting synchronous processing for session {session.session_id}...")
-        process_research_sync(session.session_id) # Call the synchronous version directly
+@require_POST # Only allow POST requests
+async def start_research_session(request):
+    """Handles form submission, creates session, saves files, and starts processing."""
+    form = ResearchForm(request.POST, request.FILES)
+
+    if form.is_valid():
+        query = form.cleaned_data['query']
+        uploaded_files = form.cleaned_data['documents'] # Already validated list of files
+
+        # Admission control: start now, wait in the bounded queue, or push back
+        session, queue_position = await acreate_research_session(
+            query, uploaded_files,
+            profile=form.cleaned_data['profile'], analyze_all=form.cleaned_data['analyze_all'],
+        )
+        if session is None:
+            response = HttpResponse("The server is busy. Please try again in a moment.", status=429)
+            response['Retry-After'] = str(settings.ADMISSION_RETRY_AFTER_SECONDS)
+            return response
 
         # Respond with HTMX to start polling for status
         # Render the initial state of the progress area
-        context = {'session': session, 'documents': session.documents.all()}
+        documents = [doc async for doc in session.documents.all()]
+        context = {'session': session, 'documents': documents, 'queue_position': queue_position}
         return render(request, 'research_app/_progress_area.html', context)
 
     else:
@@ -80,97 +149,212 @@ def start_research_session(request):
 
 
 # --- Synchronous Processing Function (Replace with Celery Task) ---
+def finalize_session(session, documents, unknown_state_ids=(), summarizer=None):
+    """
+    Writes the report from the documents' answers, adds the summary and sets the final status.
+    With a summarizer that was fed the answers as they came in, only its final merge is left to do.
+    """
+    report_doc = initialize_report(session.query)
+    # Answers for a from-scratch summary live on disk
+    all_answers_text_for_summary = SpilledText() if summarizer is None else None
+
+    # Add results to the report in document order
+    for doc in documents:
+        if doc.answer is not None:
+            add_answer_to_report(report_doc, doc.original_filename, doc.answer)
+            if unverified_quotes(doc.quote_check):
+                add_unverified_quotes_to_report(report_doc, unverified_quotes(doc.quote_check))
+            if doc.status == 'skipped':
+                continue # In the report only; the summary has nothing to learn from it
+            if all_answers_text_for_summary is not None:
+                all_answers_text_for_summary.append(format_answer(doc.original_filename, doc.answer))
+        elif doc.status == 'timed_out':
+            add_answer_to_report(report_doc, doc.original_filename, DOCUMENT_TIMED_OUT_NOTE)
+        elif doc.id in unknown_state_ids:
+            add_answer_to_report(report_doc, doc.original_filename, "Error: Unknown processing state.")
+        else:
+            # Add error note to report
+            add_answer_to_report(report_doc, doc.original_filename, f"Error processing document: {doc.processing_log or 'Extraction failed'}")
+
+    # Create summary
+    logger.info(f"Generating summary for session {session.session_id}")
+    session.status = 'summarizing'; session.save()
+    time.sleep(0.1)
+
+    # The summary text shows up in the progress view while it streams
+    live = LiveText()
+    streamed = [''] # What the summary had reached, in case the session budget runs out
+    def on_text(text):
+        streamed[0] = text
+        live.update(SESSION, session.session_id, text)
+    if summarizer is not None:
+        summary_coro = summarizer.finish(on_text)
+    else:
+        summary_coro = aquery_gemini_summary(all_answers_text_for_summary, session.query, on_text)
+    summary_answer = run_llm_coroutine(
+        within(summary_coro, seconds_left(session.deadline_at)),
+        tick=live.save, tick_seconds=settings.LLM_STREAM_SAVE_INTERVAL,
+    )
+    if all_answers_text_for_summary is not None:
+        all_answers_text_for_summary.close()
+    session.partial_summary = None
+    flush_throughput_samples() # The summary calls' model statistics
+    summary_timed_out = summary_answer == TIMED_OUT
+    if summary_timed_out:
+        logger.warning(f"Session {session.session_id} ran out of time during the summary")
+        summary_answer = f"{SUMMARY_TIMED_OUT_NOTE}\n\n{streamed[0]}".strip()
+    add_summary_to_report(report_doc, summary_answer)
+
+    # Save the final report
+    saved_path = save_report(report_doc, session) # Updates session filename
+
+    timed_out_count = sum(1 for doc in documents if doc.status == 'timed_out')
+    if saved_path and (timed_out_count or summary_timed_out):
+         # A partial report beats none: the session completes and says what is missing
+         session.status = 'completed'
+         session.error_message = "Session time budget ran out: " + ", ".join(filter(None, [
+             f"{timed_out_count} document(s) not analyzed" if timed_out_count else None,
+             "summary incomplete" if summary_timed_out else None,
+         ]))
+         logger.info(f"Session {session.session_id} completed with a partial report.")
+    elif saved_path and "Error:" not in summary_answer:
+         session.status = 'completed'
+         session.error_message = None
+         logger.info(f"Session {session.session_id} completed successfully.")
+    elif "Error:" in summary_answer:
+        session.status = 'failed'
+        session.error_message = f"Failed during summary generation: {summary_answer}"
+        logger.info(f"Session {session.session_id} failed during summary.")
+    else: # Error during saving is handled in save_report
+         session.status = 'failed' # Already set if save_report failed
+         logger.info(f"Session {session.session_id} failed during report saving.")
+
+    session.save()
+
+
 def process_research_sync(session_id):
     """
     Synchronous version of the processing logic.
     *** DO NOT USE IN PRODUCTION *** Use Celery instead.
     """
+    with profile_session(session_id): # No-op unless the session opted in
+        _process_research(session_id)
+
+
+def _process_research(session_id):
     try:
         session = ResearchSession.objects.get(pk=session_id)
         session.status = 'processing'
+        session.deadline_at = session_deadline()
         session.save()
 
-        # Initialize report
-        report_doc = initialize_report(session.query)
-        all_individual_answers = []
-        all_answers_text_for_summary = ""
-
-        documents = session.documents.all()
-
-        # 5. Loop over documents
+        # Extracted texts beyond the budget live on disk
+        memory_budget = SessionMemoryBudget()
+
+        documents = list(session.documents.all())
+        pending_queries = [] # (doc, text, metadata) for documents sent to the LLM
+        queries = [] # Their LLM futures, in the same order
+        unknown_state_ids = set()
+        # Documents that share no vocabulary with the query skip the LLM (and passage selection)
+        relevance = None if session.analyze_all else RelevanceScreen(session.query)
+        interactive_limit = settings.SCHEDULER_INTERACTIVE_MAX_DOCUMENTS
+        priority = PRIORITY_INTERACTIVE if len(documents) <= interactive_limit else PRIORITY_BATCH
+        # Answers are folded into partial summaries while the other documents are still querying
+        summarizer = None
+        if settings.SUMMARY_PARTIAL_DOCUMENTS:
+            summarizer = IncrementalSummarizer(session.query, session_key=session.session_id, priority=priority)
+        live = LiveText() # Answers as they stream, saved for the progress view while we wait
+
+        def submit_query(doc, text, metadata):
+            """Queues the document's LLM query on the shared event loop; extraction goes on meanwhile."""
+            on_result = None
+            if summarizer is not None:
+                on_result = lambda _, result: summarizer.add(doc.original_filename, result[0])
+            return submit_llm_coroutine(aquery_documents(
+                [(text, doc.original_filename, metadata)],
+                session.query,
+                session_key=session.session_id,
+                priority=priority,
+                on_result=on_result,
+                on_text=lambda _, partial: live.update(DOCUMENT, doc.id, partial),
+                timeout=documents_seconds_left(session.deadline_at),
+            ))
+
+        # 5. Extract text from every document, querying the LLM for each as soon as it is ready
         for doc in documents:
+            remaining = documents_seconds_left(session.deadline_at)
+            if remaining is not None and remaining <= 0:
+                doc.status = 'timed_out'; doc.save()
+                continue
             logger.info(f"Processing document: {doc.original_filename}")
             # Update status for UI feedback
-            doc.status = 'converting'; doc.save()
+            doc.status = 'converting'; doc.stage_started_at = timezone.now(); doc.save()
             time.sleep(0.1) # Simulate work / allow UI update if polling fast
 
             # Extract text
+            started = time.monotonic()
             text, metadata = extract_text(doc) # This updates doc status internally
-            metadata_string = json.dumps(metadata)
-            extracted_text = f"Metadata: {metadata_string}\n\nText: {text}"
+            if doc.status == 'converted':
+                note_extraction(os.path.splitext(doc.file.name)[1].lower(), doc.file_size, time.monotonic() - started)
 
             if doc.status == 'converted':
-                doc.status = 'processing'; doc.save()
-                time.sleep(0.1)
-
-                # Make Gemini call
-                logger.info(f"Querying LLM for: {doc.original_filename}")
-                answer, quotes = query_gemini_single_doc(
-                    extracted_text,
-                    session.query,
-                    doc.original_filename
-                )
-
-                # Save answer to report and list
-                add_answer_to_report(report_doc, doc.original_filename, answer)
-                answer_with_source = f"--- Document: {doc.original_filename} ---\n{answer}\n\n"
-                all_individual_answers.append({
-                    'filename': doc.original_filename,
-                    'answer': answer,
-                    'quotes': quotes,
-                })
-                all_answers_text_for_summary += answer_with_source
-
-                if "Error:" in answer:
-                     doc.status = 'error'
-                     doc.processing_log = answer
+                # The text is persisted in the DB now; drop the instance's copy (Django
+                # treats the field as deferred, so later saves leave the column alone)
+                del doc.extracted_text
+                skipped = False
+                if relevance is not None:
+                    doc.relevance_score, skipped = relevance.check(text)
+                if skipped:
+                    doc.status = 'skipped'
+                    doc.answer = skipped_answer(session.query, doc.relevance_score)
+                    doc.save()
                 else:
-                     doc.status = 'processed'
-                doc.save()
-            elif doc.status == 'error':
-                # Add error note to report
-                add_answer_to_report(report_doc, doc.original_filename, f"Error processing document: {doc.processing_log or 'Extraction failed'}")
-            else: # Should not happen if extract_text works correctly
+                    # Only the part that goes into the prompt is needed from here on
+                    offsets = TextOffsets.from_bytes(doc.text_offsets)
+                    prompt = memory_budget.hold(prompt_text(text, session.query, offsets))
+                    doc.status = 'processing'; doc.stage_started_at = timezone.now(); doc.save()
+                    pending_queries.append((doc, prompt, metadata))
+                    queries.append(submit_query(doc, prompt, metadata))
+                text = None
+            elif doc.status != 'error': # Should not happen if extract_text works correctly
                 doc.status = 'error'
                 doc.processing_log = "Unknown processing error after conversion attempt."
                 doc.save()
-                add_answer_to_report(report_doc, doc.original_filename, "Error: Unknown processing state.")
-
-
-        # Create summary
-        logger.info(f"Generating summary for session {session.session_id}")
-        session.status = 'summarizing'; session.save()
-        time.sleep(0.1)
-
-        summary_answer = query_gemini_summary(all_answers_text_for_summary, session.query)
-        add_summary_to_report(report_doc, summary_answer)
-
-        # Save the final report
-        saved_path = save_report(report_doc, session) # Updates session filename
-
-        if saved_path and "Error:" not in summary_answer:
-             session.status = 'completed'
-             session.error_message = None
-             logger.info(f"Session {session.session_id} completed successfully.")
-        elif "Error:" in summary_answer:
-            session.status = 'failed'
-            session.error_message = f"Failed during summary generation: {summary_answer}"
-            logger.info(f"Session {session.session_id} failed during summary.")
-        else: # Error during saving is handled in save_report
-             session.status = 'failed' # Already set if save_report failed
-             logger.info(f"Session {session.session_id} failed during report saving.")
-
-        session.save()
+                unknown_state_ids.add(doc.id)
+            live.save()
+
+        if relevance is not None:
+            relevance.log()
+
+        # 6. Wait for the LLM answers still outstanding
+        flush_throughput_samples()
+        logger.info(f"Waiting for the LLM on {len(pending_queries)} document(s) in session {session.session_id}")
+        results = [result[0] for result in wait_llm_futures(queries, tick=live.save, tick_seconds=settings.LLM_STREAM_SAVE_INTERVAL)]
+        queue_stats = get_queue_stats(session.session_id)
+        if queue_stats and queue_stats['wait_p95'] is not None:
+            logger.info(f"Session {session.session_id} queue wait p95: {queue_stats['wait_p95']:.2f}s")
+        for (doc, text, _), (answer, quotes) in zip(pending_queries, results):
+            # Check the quotes against the text the LLM actually saw
+            doc.quote_check = verify_quotes(text_head(text, PROMPT_TEXT_CHARS), quotes)
+            memory_budget.release(text)
+            doc.answer = answer
+            doc.partial_answer = None
+            if answer == TIMED_OUT:
+                 doc.status = 'timed_out'
+                 doc.answer = None
+                 doc.processing_log = "Session time budget ran out"
+            elif "Error:" in answer:
+                 doc.status = 'error'
+                 doc.processing_log = answer
+            else:
+                 doc.status = 'processed'
+            doc.save()
+        pending_queries = None
+        flush_throughput_samples()
+        if memory_budget.spilled_count:
+            logger.info(f"Session {session.session_id} spilled {memory_budget.spilled_count} document(s) to disk")
+
+        finalize_session(session, documents, unknown_state_ids, summarizer=summarizer)
 
     except ResearchSession.DoesNotExist:
          logger.error(f"Error: Session {session_id} not found during processing.")
@@ -190,12 +374,27 @@ def process_research_sync(session_id):
 # --- Status and Download Views ---
 
 @require_GET
-def get_session_status(request, session_id):
+async def get_session_status(request, session_id):
     """Returns the current status of the session and documents for HTMX polling."""
     try:
-        session = ResearchSession.objects.get(pk=session_id)
-        documents = session.documents.all().order_by('original_filename')
-        context = {'session': session, 'documents': documents}
+        session = await ResearchSession.objects.aget(pk=session_id)
+        # Fetch the documents here; templates can't run ORM queries in async views
+        documents = [doc async for doc in session.documents.all().order_by('original_filename')]
+        queue_stats = await aget_queue_stats(session.session_id)
+        queue_position = await aqueue_position(session) if session.status == 'queued' else None
+        progress = estimate_progress(session, documents, await aload_throughput_stats())
+        for doc in documents:
+            doc.progress = progress['documents'][doc.id]
+        # Poll faster while answers are streaming in
+        streaming = bool(session.partial_summary) or any(doc.partial_answer for doc in documents)
+        context = {
+            'streaming': streaming,
+            'session': session,
+            'documents': documents,
+            'queue_stats': queue_stats,
+            'queue_position': queue_position,
+            'progress': progress,
+        }
 
         # Decide which partial to render based on status
         if session.status == 'completed':
@@ -217,20 +416,38 @@ def get_session_status(request, session_id):
          return HttpResponseServerError("An error occurred while fetching status.")
 
 
+async def _aiter_file(path, chunk_size=FileResponse.block_size):
+    """Streams a file in chunks without blocking the event loop on disk reads."""
+    f = await asyncio.to_thread(open, path, 'rb')
+    try:
+        while chunk := await asyncio.to_thread(f.read, chunk_size):
+            yield chunk
+    finally:
+        f.close()
+
 @require_GET
-def download_report(request, session_id):
+async def download_report(request, session_id):
     """Serves the generated DOCX report file for download."""
-    session = get_object_or_404(ResearchSession, pk=session_id, status='completed')
+    session = await aget_object_or_404(ResearchSession, pk=session_id, status='completed')
 
     if not session.report_filename:
         return HttpResponse("Report file not found for this session.", status=404)
 
     report_path = session.get_report_path()
 
-    if report_path and os.path.exists(report_path):
+    if report_path and await asyncio.to_thread(os.path.exists, report_path):
+        # Recently downloaded reports are the last to go when storage is over budget
+        await ResearchSession.objects.filter(pk=session.pk).aupdate(last_accessed_at=timezone.now())
         try:
-            # Use FileResponse for efficient file serving
-            return FileResponse(open(report_path, 'rb'), as_attachment=True, filename=session.report_filename)
+            # Stream the file asynchronously instead of tying up a thread per download
+            content_type, _ = mimetypes.guess_type(report_path)
+            response = StreamingHttpResponse(
+                _aiter_file(report_path),
+                content_type=content_type or 'application/octet-stream',
+            )
+            response['Content-Length'] = str(await asyncio.to_thread(os.path.getsize, report_path))
+            response['Content-Disposition'] = content_disposition_header(True, session.report_filename)
+            return response
         except Exception as e:
              logger.error(f"Error serving file {report_path}: {e}")
              return HttpResponseServerError("Error serving the report file.")
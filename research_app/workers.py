@@ -0,0 +1,346 @@
+"""
+Lease-based document workers for running processing on several nodes.
+
+With PROCESSING_MODE = 'workers', the web process only stores sessions and
+documents; any number of 'manage.py run_worker' processes, on any machine sharing
+the database and MEDIA_ROOT, claim documents and process them.
+
+A claim is a lease: the worker's owner id plus an expiry time, written with a
+conditional UPDATE that only matches documents with no lease or an expired one,
+so two workers can never hold the same document. A heartbeat thread keeps
+extending the leases of the work in hand. If a worker dies, its leases run out
+and another worker reclaims the documents. Every write to a document (status
+changes and extracted text included) is a conditional UPDATE on the lease, and a
+worker stops working on a document as soon as one matches no row, so a worker
+that lost its lease can't overwrite the work of the one that took over. Sessions
+dispatched to a web process's thread pool (PROCESSING_MODE = 'inprocess') take
+no leases, so workers never claim their documents or finalize them. When the last document of a session is done, one worker
+claims the session the same way and writes the summary and report.
+"""
+import asyncio
+import logging
+import os
+import socket
+import threading
+import time
+import uuid
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import close_old_connections
+from django.db.models import Q
+from django.utils import timezone
+
+from .admission import dispatch_queued_sessions
+from .deadlines import TIMED_OUT, documents_seconds_left, session_deadline
+from .llm import run_llm_coroutine
+from .models import ResearchSession, UploadedDocument
+from .offsets import TextOffsets
+from .passages import prompt_text
+from .profiling import profile_session
+from .progress import flush_throughput_samples, note_extraction
+from .quotes import verify_quotes
+from .relevance import RelevanceScreen, skipped_answer
+from .streaming import DOCUMENT, LiveText
+from .utils import aquery_documents, extract_text
+
+logger = logging.getLogger(__name__)
+
+# Document statuses that still need work; a worker that died mid-way leaves one of these
+UNFINISHED_STATUSES = ('uploaded', 'converting', 'converted', 'processing')
+# Sessions whose documents workers may pick up
+WORKABLE_SESSION_STATUSES = ('pending', 'processing')
+
+
+class LeaseLost(Exception):
+    """A write matched no row: another worker holds the document now."""
+
+
+def make_owner_id():
+    """A worker id unique across machines and processes."""
+    return f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+
+def _lease_free(now):
+    return Q(lease_owner__isnull=True) | Q(lease_expires_at__lt=now)
+
+
+def claim_documents(owner, limit, lease_seconds):
+    """Leases up to `limit` unfinished documents to `owner`. Returns the claimed ids."""
+    now = timezone.now()
+    candidates = list(
+        UploadedDocument.objects.filter(
+            _lease_free(now),
+            session__status__in=WORKABLE_SESSION_STATUSES,
+            session__in_process=False,
+            status__in=UNFINISHED_STATUSES,
+        ).order_by('session__created_at', 'id').values_list('id', flat=True)[:limit * 4]
+    )
+    claimed = []
+    for doc_id in candidates:
+        # The WHERE clause repeats the free-lease test, so only one worker's UPDATE matches
+        updated = UploadedDocument.objects.filter(
+            _lease_free(now), pk=doc_id, status__in=UNFINISHED_STATUSES,
+        ).update(lease_owner=owner, lease_expires_at=now + timedelta(seconds=lease_seconds))
+        if updated:
+            claimed.append(doc_id)
+            if len(claimed) == limit:
+                break
+    return claimed
+
+
+def renew_leases(owner, doc_ids, session_ids, lease_seconds):
+    """Extends the leases `owner` still holds. Returns the document ids it lost."""
+    expires_at = timezone.now() + timedelta(seconds=lease_seconds)
+    held = set(
+        UploadedDocument.objects.filter(pk__in=doc_ids, lease_owner=owner).values_list('id', flat=True)
+    )
+    UploadedDocument.objects.filter(pk__in=held, lease_owner=owner).update(lease_expires_at=expires_at)
+    ResearchSession.objects.filter(pk__in=session_ids, lease_owner=owner).update(lease_expires_at=expires_at)
+    return set(doc_ids) - held
+
+
+def complete_document(owner, doc_id, **fields):
+    """Writes a document's results and releases its lease, if `owner` still holds it."""
+    return UploadedDocument.objects.filter(pk=doc_id, lease_owner=owner).update(
+        lease_owner=None, lease_expires_at=None, **fields,
+    ) == 1
+
+
+def claim_finished_sessions(owner, lease_seconds):
+    """Leases sessions whose documents are all done, or whose finalizing worker died."""
+    now = timezone.now()
+    lease = {'lease_owner': owner, 'lease_expires_at': now + timedelta(seconds=lease_seconds)}
+    ready = ResearchSession.objects.filter(
+        Q(status__in=WORKABLE_SESSION_STATUSES) | Q(status='summarizing', lease_expires_at__lt=now),
+        documents__isnull=False, in_process=False,
+    ).exclude(documents__status__in=UNFINISHED_STATUSES).distinct().values_list('pk', flat=True)
+
+    claimed = []
+    for session_id in ready:
+        updated = ResearchSession.objects.filter(
+            Q(status__in=WORKABLE_SESSION_STATUSES) | Q(status='summarizing', lease_expires_at__lt=now),
+            pk=session_id, in_process=False,
+        ).update(status='summarizing', **lease)
+        if updated:
+            claimed.append(session_id)
+    return claimed
+
+
+class DocumentWorker:
+    """Claims documents under a lease, processes them and finalizes finished sessions."""
+
+    def __init__(self, owner=None, batch_size=None, lease_seconds=None, poll_interval=None):
+        self.owner = owner or make_owner_id()
+        self.batch_size = batch_size or settings.WORKER_BATCH_SIZE
+        self.lease_seconds = lease_seconds or settings.WORKER_LEASE_SECONDS
+        self.poll_interval = settings.WORKER_POLL_INTERVAL if poll_interval is None else poll_interval
+        self._held_documents = set()
+        self._held_sessions = set()
+        self._lost_documents = set()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+
+    # --- Heartbeat ---
+
+    def _heartbeat(self):
+        while not self._stop.wait(self.lease_seconds / 3):
+            with self._lock:
+                doc_ids, session_ids = list(self._held_documents), list(self._held_sessions)
+            if not doc_ids and not session_ids:
+                continue
+            try:
+                lost = renew_leases(self.owner, doc_ids, session_ids, self.lease_seconds)
+            except Exception as e:
+                logger.error(f"Worker {self.owner} heartbeat failed: {e}")
+                continue
+            if lost:
+                logger.warning(f"Worker {self.owner} lost the lease on document(s) {sorted(lost)}")
+                with self._lock:
+                    self._lost_documents |= lost
+        close_old_connections()
+
+    # --- Main loop ---
+
+    def run(self, once=False):
+        """Processes work until stopped, or with once=True until nothing is left to claim."""
+        heartbeat = threading.Thread(target=self._heartbeat, name='worker-heartbeat', daemon=True)
+        heartbeat.start()
+        logger.info(f"Worker {self.owner} started")
+        try:
+            while not self._stop.is_set():
+                dispatch_queued_sessions()
+                doc_ids = claim_documents(self.owner, self.batch_size, self.lease_seconds)
+                if doc_ids:
+                    self.process_documents(doc_ids)
+                finalized = self.finalize_sessions()
+                if not doc_ids and not finalized:
+                    if once:
+                        break
+                    self._stop.wait(self.poll_interval)
+        finally:
+            self._stop.set()
+            heartbeat.join()
+            close_old_connections()
+        logger.info(f"Worker {self.owner} stopped")
+
+    def stop(self):
+        self._stop.set()
+
+    def _still_held(self, doc_id):
+        with self._lock:
+            return doc_id not in self._lost_documents
+
+    def process_documents(self, doc_ids):
+        """Extracts and queries the LLM for leased documents, grouped by session."""
+        with self._lock:
+            self._held_documents |= set(doc_ids)
+        try:
+            # Leave the lease columns out of the instances, so save() never rewrites them
+            documents = list(
+                UploadedDocument.objects.filter(pk__in=doc_ids).select_related('session')
+                .defer('lease_owner', 'lease_expires_at').order_by('id')
+            )
+            session_ids = {doc.session_id for doc in documents}
+            ResearchSession.objects.filter(pk__in=session_ids, status='pending').update(
+                status='processing', deadline_at=session_deadline(),
+            )
+            # The first worker to start a session set its deadline; every worker goes by that one
+            deadlines = dict(ResearchSession.objects.filter(pk__in=session_ids).values_list('pk', 'deadline_at'))
+            by_session = {}
+            screens = {} # Session -> its RelevanceScreen; sessions with analyze_all aren't screened
+            for doc in documents:
+                if not self._still_held(doc.id):
+                    continue
+                remaining = documents_seconds_left(deadlines[doc.session_id])
+                if remaining is not None and remaining <= 0:
+                    complete_document(self.owner, doc.id, status='timed_out')
+                    continue
+                self._guard_saves(doc)
+                try:
+                    doc.status = 'converting'; doc.stage_started_at = timezone.now(); doc.save()
+                    started = time.monotonic()
+                    text, metadata = extract_text(doc) # Updates doc status internally
+                    if doc.status == 'converted':
+                        note_extraction(os.path.splitext(doc.file.name)[1].lower(), doc.file_size, time.monotonic() - started)
+                        del doc.extracted_text
+                        if self._skip_irrelevant(doc, text, screens):
+                            continue
+                        offsets = TextOffsets.from_bytes(doc.text_offsets)
+                        doc.status = 'processing'; doc.stage_started_at = timezone.now(); doc.save()
+                        by_session.setdefault(doc.session, []).append((doc, prompt_text(text, doc.session.query, offsets), metadata))
+                    else:
+                        if doc.status != 'error':
+                            doc.processing_log = "Unknown processing error after conversion attempt."
+                        complete_document(self.owner, doc.id, status='error', processing_log=doc.processing_log)
+                except LeaseLost:
+                    logger.warning(f"Worker {self.owner} stopped work on {doc.original_filename}: lease lost")
+                    with self._lock:
+                        self._lost_documents.add(doc.id)
+                finally:
+                    text = None
+
+            for relevance in screens.values():
+                relevance.log()
+            if by_session:
+                self._query(by_session, deadlines)
+            flush_throughput_samples()
+        finally:
+            with self._lock:
+                self._held_documents -= set(doc_ids)
+                self._lost_documents -= set(doc_ids)
+
+    def _guard_saves(self, doc):
+        """
+        Makes doc.save() (the one inside extract_text() too) a conditional UPDATE on
+        this worker's lease, raising LeaseLost if another worker holds it now.
+        """
+        def save(*args, **kwargs):
+            deferred = doc.get_deferred_fields()
+            fields = {
+                field.attname: getattr(doc, field.attname) for field in doc._meta.concrete_fields
+                if not field.primary_key and field.attname not in deferred
+            }
+            if not UploadedDocument.objects.filter(pk=doc.pk, lease_owner=self.owner).update(**fields):
+                raise LeaseLost(doc.pk)
+
+        doc.save = save
+
+    def _skip_irrelevant(self, doc, text, screens):
+        """Completes doc as skipped if the relevance pre-screen rules it out, before any passage selection."""
+        session = doc.session
+        if session.analyze_all:
+            return False
+        if session not in screens:
+            screens[session] = RelevanceScreen(session.query)
+        doc.relevance_score, skipped = screens[session].check(text)
+        if skipped:
+            complete_document(
+                self.owner, doc.id, status='skipped', answer=skipped_answer(session.query, doc.relevance_score),
+                relevance_score=doc.relevance_score,
+            )
+        return skipped
+
+    def _query(self, by_session, deadlines):
+        live = LiveText()
+
+        def on_text(items):
+            return lambda index, text: live.update(DOCUMENT, items[index][0].id, text)
+
+        async def query_all():
+            return await asyncio.gather(*(
+                aquery_documents(
+                    [(text, doc.original_filename, metadata) for doc, text, metadata in items],
+                    session.query,
+                    session_key=session.session_id,
+                    on_text=on_text(items),
+                    timeout=documents_seconds_left(deadlines[session.pk]),
+                )
+                for session, items in by_session.items()
+            ))
+
+        all_results = run_llm_coroutine(query_all(), tick=live.save, tick_seconds=settings.LLM_STREAM_SAVE_INTERVAL)
+        for items, results in zip(by_session.values(), all_results):
+            for (doc, text, _), (answer, quotes) in zip(items, results):
+                if answer == TIMED_OUT:
+                    fields = {'status': 'timed_out', 'partial_answer': None, 'processing_log': "Session time budget ran out"}
+                    complete_document(self.owner, doc.id, relevance_score=doc.relevance_score, **fields)
+                    continue
+                failed = "Error:" in answer
+                fields = {
+                    'answer': answer,
+                    'partial_answer': None,
+                    'quote_check': verify_quotes(text, quotes),
+                    'relevance_score': doc.relevance_score,
+                    'status': 'error' if failed else 'processed',
+                }
+                if failed:
+                    fields['processing_log'] = answer
+                if not complete_document(self.owner, doc.id, **fields):
+                    logger.warning(f"Worker {self.owner} dropped the result for {doc.original_filename}: lease lost")
+
+    def finalize_sessions(self):
+        """Writes the summary and report for every session this worker manages to claim."""
+        from .views import finalize_session # Avoid a circular import
+
+        session_ids = claim_finished_sessions(self.owner, self.lease_seconds)
+        for session_id in session_ids:
+            with self._lock:
+                self._held_sessions.add(session_id)
+            try:
+                session = ResearchSession.objects.defer('lease_owner', 'lease_expires_at').get(pk=session_id)
+                documents = list(session.documents.defer('extracted_text').order_by('id'))
+                with profile_session(session_id): # Documents ran on several workers; only this stage is profiled
+                    finalize_session(session, documents)
+            except Exception as e:
+                logger.error(f"Worker {self.owner} failed to finalize session {session_id}: {e}")
+                ResearchSession.objects.filter(pk=session_id).update(
+                    status='failed', error_message=f"Unexpected processing error: {e}",
+                )
+            finally:
+                ResearchSession.objects.filter(pk=session_id, lease_owner=self.owner).update(
+                    lease_owner=None, lease_expires_at=None,
+                )
+                with self._lock:
+                    self._held_sessions.discard(session_id)
+        return session_ids